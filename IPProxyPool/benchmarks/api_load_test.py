@@ -0,0 +1,79 @@
+'''
+代理池API的压力测试
+
+目标：对比Flask开发服务器和asgi方式运行的API服务的每秒请求数和p99延迟.
+步骤：
+    1. 分别使用 API_SERVER = 'flask' 和 API_SERVER = 'asgi' 启动API服务(可以修改API_PORT让两个服务同时运行，
+       不要使用其他服务的端口，比如JUDGE_PORT，GATEWAY_PORT)
+    2. 运行本脚本，传入要对比的URL，例如asgi服务使用16898端口：
+        python benchmarks/api_load_test.py http://127.0.0.1:16888/random http://127.0.0.1:16898/random -c 100 -n 20000
+    3. 对每个URL：开启c个并发的keep-alive连接，一共发送n个请求，记录每个请求的耗时
+    4. 打印每秒请求数，p50，p99延迟和失败的请求数量
+'''
+
+import argparse
+import asyncio
+import time
+
+import aiohttp
+
+
+def get_percentile(latencies, percentile):
+    """计算延迟的百分位数，latencies已经排好序"""
+    if not latencies:
+        return 0
+    index = min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+    return latencies[index]
+
+
+async def load_test(url, concurrency, total):
+    """对一个URL进行压力测试"""
+    latencies = []
+    errors = 0
+    # 还需要发送的请求数量
+    remaining = total
+
+    async def worker(session):
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start_time = time.perf_counter()
+            try:
+                async with session.get(url) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors += 1
+                        continue
+            except Exception:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - start_time)
+
+    # 每个并发使用一个keep-alive连接
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start_time = time.perf_counter()
+        await asyncio.gather(*[worker(session) for i in range(concurrency)])
+        elapsed = time.perf_counter() - start_time
+
+    latencies.sort()
+    print(url)
+    print('    请求数：{}，失败：{}，耗时：{:.2f}s'.format(total, errors, elapsed))
+    print('    每秒请求数：{:.0f}'.format(len(latencies) / elapsed))
+    print('    p50：{:.1f}ms，p99：{:.1f}ms'.format(
+        get_percentile(latencies, 50) * 1000, get_percentile(latencies, 99) * 1000))
+
+
+async def main(urls, concurrency, total):
+    for url in urls:
+        await load_test(url, concurrency, total)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='代理池API的压力测试')
+    parser.add_argument('urls', nargs='+', help='要对比的URL')
+    parser.add_argument('-c', '--concurrency', type=int, default=100, help='并发连接数量')
+    parser.add_argument('-n', '--total', type=int, default=10000, help='每个URL的请求数量')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.urls, args.concurrency, args.total))
@@ -0,0 +1,82 @@
+'''
+代理IP列表编码格式的对比
+
+目标：对比 /proxies 的json，msgpack和packed格式，编码10000个代理IP的耗时和数据大小.
+步骤：
+    1. 在IPProxyPool目录下运行：python -m benchmarks.encode_benchmark -n 10000 -r 20
+    2. 随机生成n个代理IP
+    3. 每种格式编码r次，记录耗时的中位数，数据大小和gzip压缩后的大小
+        json(全部字段)：和以前的 /proxies 一样，使用Proxy.__dict__
+        json：只包含 ip，port，protocol，score
+        msgpack：只包含 ip，port，protocol，score，没有安装msgpack时跳过
+        packed：每个代理IP固定8个字节
+'''
+
+import argparse
+import gzip
+import json
+import random
+import statistics
+import time
+
+from core.proxy_codec import encode_msgpack, iter_packed
+from domain import Proxy
+
+# 消费者常用的字段
+FIELDS = ['ip', 'port', 'protocol', 'score']
+
+
+def create_proxies(n):
+    """随机生成n个代理IP"""
+    proxies = []
+    for i in range(n):
+        ip = '.'.join(str(random.randint(1, 254)) for j in range(4))
+        proxy = Proxy(ip, str(random.randint(1, 65535)), protocol=random.randint(0, 2), nick_type=random.randint(0, 2),
+                      speed=round(random.uniform(0.1, 10), 2), area='广东省广州市 电信', score=random.randint(1, 50),
+                      disable_domains=['jd.com', 'taobao.com'][:random.randint(0, 2)])
+        proxies.append(proxy)
+    return proxies
+
+
+def get_fields(proxy):
+    return {field: getattr(proxy, field) for field in FIELDS}
+
+
+def get_encoders():
+    """格式名称 -> 编码方法"""
+    encoders = {
+        'json(全部字段)': lambda proxies: json.dumps([proxy.__dict__ for proxy in proxies]).encode(),
+        'json': lambda proxies: json.dumps([get_fields(proxy) for proxy in proxies]).encode(),
+        'msgpack': lambda proxies: encode_msgpack([get_fields(proxy) for proxy in proxies]),
+        'packed': lambda proxies: b''.join(iter_packed(proxies)),
+    }
+    try:
+        import msgpack
+    except ImportError:
+        print('没有安装msgpack，跳过msgpack格式')
+        encoders.pop('msgpack')
+    return encoders
+
+
+def run(n, repeat):
+    proxies = create_proxies(n)
+    encoders = get_encoders()
+    print('代理IP数量：{}，重复次数：{}'.format(n, repeat))
+    print('{:<16}{:>12}{:>14}{:>14}'.format('格式', '耗时(ms)', '大小(bytes)', 'gzip(bytes)'))
+    for name, encode in encoders.items():
+        elapsed = []
+        for i in range(repeat):
+            start_time = time.perf_counter()
+            data = encode(proxies)
+            elapsed.append(time.perf_counter() - start_time)
+        print('{:<16}{:>12.2f}{:>14}{:>14}'.format(name, statistics.median(elapsed) * 1000, len(data),
+                                                   len(gzip.compress(data))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='代理IP列表编码格式的对比')
+    parser.add_argument('-n', '--count', type=int, default=10000, help='代理IP数量')
+    parser.add_argument('-r', '--repeat', type=int, default=20, help='每种格式的重复次数')
+    args = parser.parse_args()
+
+    run(args.count, args.repeat)
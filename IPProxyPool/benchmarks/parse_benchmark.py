@@ -0,0 +1,96 @@
+'''
+爬虫解析页面的性能测试
+
+目标：不访问网络，使用保存的页面(benchmarks/fixtures/爬虫类名.html)，测试每个爬虫每秒解析的行数.
+      数据源爬虫(FeedSpider)保存的是文本或者json(爬虫类名.txt，爬虫类名.json)，按照chunk_size分块解析.
+      保存的页面和网站的结构一样，每个页面15个有效的行和4个不合法的行(ip为空，端口号不是数字，ip超出范围，端口号超出范围)；
+      网站改版后需要同时更新爬虫的XPATH和保存的页面.
+步骤：
+    1. 在IPProxyPool目录下运行：python -m benchmarks.parse_benchmark -r 200
+    2. 对PROXIES_SPIDERS中的每个爬虫，读取对应的页面
+    3. 每种解析方式重复解析r次，计算每秒解析的行数
+        旧的方式：每一行都使用字符串XPATH，不校验ip和端口号
+        get_proxies_from_page：使用编译好的XPATH，丢弃不合法的行
+        数据源爬虫没有旧的方式，使用parse流式解析
+    4. 打印每个爬虫的有效行数和每秒解析的行数
+'''
+
+import argparse
+import importlib
+import os
+import time
+
+from lxml import etree
+
+from core.proxy_spider.feed_spider import FeedSpider
+from settings import PROXIES_SPIDERS
+
+# 保存的页面所在的目录
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def legacy_parse(spider, page):
+    """旧的解析方式：每一行都使用字符串XPATH"""
+    rows = []
+    for tr in etree.HTML(page).xpath(spider.group_xpath):
+        rows.append([tr.xpath(spider.detail_xpath[field]) for field in ('ip', 'port', 'area')])
+    return rows
+
+
+def get_fixture_name(cls):
+    """保存的页面的文件名"""
+    if issubclass(cls, FeedSpider):
+        return '{}.{}'.format(cls.__name__, 'json' if cls.feed_format == 'json' else 'txt')
+    return '{}.html'.format(cls.__name__)
+
+
+def feed_parse(spider, page):
+    """数据源爬虫：按照chunk_size分块，流式解析"""
+    text = page.decode(spider.encoding, 'ignore')
+    size = spider.chunk_size
+    return spider.parse(text[i:i + size] for i in range(0, len(text), size))
+
+
+def get_spiders():
+    """获取PROXIES_SPIDERS中的爬虫对象和对应的页面"""
+    for full_class_name in PROXIES_SPIDERS:
+        module_name, class_name = full_class_name.rsplit('.', maxsplit=1)
+        cls = getattr(importlib.import_module(module_name), class_name)
+        path = os.path.join(FIXTURES_DIR, get_fixture_name(cls))
+        if not os.path.exists(path):
+            print('{}：没有保存的页面 {}'.format(class_name, path))
+            continue
+        with open(path, 'rb') as f:
+            yield cls(), f.read()
+
+
+def measure(parse, page, repeat):
+    """重复解析repeat次，返回 (每次解析的行数, 每秒解析的行数)"""
+    count = len(list(parse(page)))
+    start_time = time.perf_counter()
+    for i in range(repeat):
+        for row in parse(page):
+            pass
+    elapsed = time.perf_counter() - start_time
+    return count, count * repeat / elapsed
+
+
+def run(repeat):
+    print('{:<22}{:>10}{:>16}{:>10}{:>16}'.format('爬虫', '旧的行数', '旧的行/秒', '有效行数', '现在的行/秒'))
+    for spider, page in get_spiders():
+        if isinstance(spider, FeedSpider):
+            count, rate = measure(lambda page: feed_parse(spider, page), page, repeat)
+            print('{:<22}{:>10}{:>16}{:>10}{:>16.0f}'.format(type(spider).__name__, '-', '-', count, rate))
+            continue
+        legacy_count, legacy_rate = measure(lambda page: legacy_parse(spider, page), page, repeat)
+        count, rate = measure(spider.get_proxies_from_page, page, repeat)
+        print('{:<22}{:>10}{:>16.0f}{:>10}{:>16.0f}'.format(type(spider).__name__, legacy_count, legacy_rate,
+                                                           count, rate))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='爬虫解析页面的性能测试')
+    parser.add_argument('-r', '--repeat', type=int, default=200, help='每个页面的重复次数')
+    args = parser.parse_args()
+
+    run(args.repeat)
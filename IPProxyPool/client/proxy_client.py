@@ -0,0 +1,453 @@
+'''
+实现代理池的客户端
+
+目标：爬虫不用每个请求都调用 /random，从本地缓存中获取代理IP，没有网络请求；
+      同步的爬虫和asyncio的爬虫都可以使用.
+思路：
+    1. 从 /proxies 批量预取代理IP，保存到本地的环形缓冲区中
+    2. 获取代理IP时按照顺序轮流返回(round_robin)，或者按照分数和响应速度加权随机返回(weighted)
+    3. 可用的代理IP少于 refill_ratio，或者超过 refresh_interval 秒没有更新时，在后台重新获取，
+       只有本地没有代理IP时才等待获取完成；本地可用的代理IP足够时，重新获取时带上ETag，代理IP没有变化时服务端返回304，
+       可用的代理IP不够时不带ETag，否则服务端返回304，失败的代理IP一直不能恢复
+    4. 爬虫报告代理IP的使用结果，失败的代理IP从本地缓冲区中移除；
+       使用结果每隔 report_interval 秒批量发送到 /report
+    5. 客户端不依赖代理池的其他模块(settings，utils.log等)，可以单独复制到爬虫项目中使用；
+       配置都是构造方法的参数，日志使用logging.getLogger(__name__)，由使用者配置
+步骤：
+    1. 定义ProxyBuffer类，本地的环形缓冲区，不做网络请求
+    2. 定义BaseProxyClient类，实现同步和异步客户端共用的请求参数，解析响应和汇总使用结果
+    3. 定义ProxyClient类，同步的客户端，使用requests和后台线程
+    4. 定义AsyncProxyClient类，asyncio的客户端，使用aiohttp和后台任务，只有使用时才需要安装aiohttp
+
+使用：
+    with ProxyClient(protocol='https', domain='jd.com') as client:
+        proxy = client.get_proxy()
+        requests.get(url, proxies=get_proxies_dict(proxy))
+        client.report(proxy, ok=True, latency=0.5)
+
+    async with AsyncProxyClient(protocol='https', domain='jd.com') as client:
+        proxy = await client.get_proxy()
+        ...
+        client.report(proxy, ok=False)
+'''
+
+from threading import Lock, Thread
+import asyncio
+import bisect
+import json
+import logging
+import random
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+# 代理池API的地址
+DEFAULT_API_URL = 'http://127.0.0.1:16888'
+# 每次从 /proxies 预取的代理IP数量
+DEFAULT_BATCH_SIZE = 200
+# 本地可用的代理IP少于这个比例，或者超过 DEFAULT_REFRESH_INTERVAL 秒没有更新时，在后台重新获取
+DEFAULT_REFILL_RATIO = 0.3
+DEFAULT_REFRESH_INTERVAL = 60
+# 批量报告使用结果的间隔，单位s，和每次最多报告的数量
+DEFAULT_REPORT_INTERVAL = 5
+DEFAULT_REPORT_BATCH_SIZE = 1000
+# 请求代理池API的超时时间，单位s
+DEFAULT_TIMEOUT = 10
+# 获取代理IP的策略
+STRATEGIES = ('round_robin', 'weighted')
+# 从 /proxies 获取的字段
+PROXY_FIELDS = 'ip,port,protocol,nick_type,speed,score'
+# 按照权重选择时，选中已经移除的代理IP的最大尝试次数，超过后按照顺序选择
+MAX_SAMPLE_TRIES = 10
+# 计算权重时，没有响应速度(检测失败)的代理IP按照这个速度计算，单位s
+UNKNOWN_SPEED = 10
+
+
+class ClientProxy(object):
+    """客户端的代理IP，只包含 /proxies 返回的字段"""
+
+    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, score=0, **kwargs):
+        self.ip = ip
+        self.port = port
+        self.protocol = protocol
+        self.nick_type = nick_type
+        self.speed = speed
+        self.score = score
+
+    def __str__(self):
+        return str(self.__dict__)
+
+
+def get_weight(proxy):
+    """代理IP的权重：分数越高，响应速度越快，权重越大"""
+    speed = proxy.speed if proxy.speed > 0 else UNKNOWN_SPEED
+    return max(proxy.score, 0) / max(speed, 0.1)
+
+
+def get_proxy_url(proxy):
+    """代理IP的URL，比如 http://1.2.3.4:8080"""
+    return 'http://{}:{}'.format(proxy.ip, proxy.port)
+
+
+def get_proxies_dict(proxy):
+    """requests的proxies参数"""
+    url = get_proxy_url(proxy)
+    return {'http': url, 'https': url}
+
+
+class NoProxyError(Exception):
+    """代理池中没有可用的代理IP"""
+
+
+class ProxyBuffer(object):
+    """本地的代理IP环形缓冲区"""
+
+    def __init__(self, strategy='round_robin'):
+        if strategy not in STRATEGIES:
+            raise ValueError('不支持的策略：{}'.format(strategy))
+        self.strategy = strategy
+        self.proxies = []
+        # 每个代理IP是否可用，使用失败后标记为不可用
+        self.alive = []
+        self.alive_count = 0
+        # ip:port -> 下标
+        self.index = {}
+        # 下一个返回的下标
+        self.position = 0
+        # 按照权重选择时使用的累计权重
+        self.cum_weights = None
+        # 最后一次更新的时间
+        self.loaded_at = 0
+        self.lock = Lock()
+
+    def replace(self, proxies):
+        """使用新获取的代理IP替换缓冲区中的代理IP"""
+        cum_weights = None
+        if self.strategy == 'weighted':
+            cum_weights = []
+            total = 0
+            for proxy in proxies:
+                total += get_weight(proxy)
+                cum_weights.append(total)
+        with self.lock:
+            self.proxies = proxies
+            self.alive = [True] * len(proxies)
+            self.alive_count = len(proxies)
+            self.index = {'{}:{}'.format(proxy.ip, proxy.port): i for i, proxy in enumerate(proxies)}
+            self.position = 0
+            self.cum_weights = cum_weights
+            self.loaded_at = time.time()
+
+    def touch(self):
+        """代理IP没有变化，只更新时间"""
+        self.loaded_at = time.time()
+
+    def get(self):
+        """获取一个可用的代理IP，没有时返回None"""
+        with self.lock:
+            if not self.alive_count:
+                return None
+            if self.cum_weights and self.cum_weights[-1] > 0:
+                for i in range(MAX_SAMPLE_TRIES):
+                    i = bisect.bisect_right(self.cum_weights, random.random() * self.cum_weights[-1])
+                    if i < len(self.proxies) and self.alive[i]:
+                        return self.proxies[i]
+            # 按照顺序轮流返回，跳过不可用的代理IP
+            n = len(self.proxies)
+            for i in range(n):
+                i = (self.position + i) % n
+                if self.alive[i]:
+                    self.position = (i + 1) % n
+                    return self.proxies[i]
+            return None
+
+    def remove(self, proxy):
+        """把代理IP标记为不可用"""
+        with self.lock:
+            i = self.index.get('{}:{}'.format(proxy.ip, proxy.port))
+            if i is not None and self.alive[i]:
+                self.alive[i] = False
+                self.alive_count -= 1
+
+    def is_low(self, refill_ratio=DEFAULT_REFILL_RATIO):
+        """可用的代理IP是否不够"""
+        return not self.proxies or self.alive_count < len(self.proxies) * refill_ratio
+
+    def need_refill(self, refill_ratio=DEFAULT_REFILL_RATIO, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """是否需要重新获取代理IP"""
+        return self.is_low(refill_ratio) or time.time() - self.loaded_at > refresh_interval
+
+
+class BaseProxyClient(object):
+
+    def __init__(self, api_url=DEFAULT_API_URL, protocol=None, domain=None, strategy='round_robin',
+                 batch_size=DEFAULT_BATCH_SIZE, refill_ratio=DEFAULT_REFILL_RATIO,
+                 refresh_interval=DEFAULT_REFRESH_INTERVAL, report_interval=DEFAULT_REPORT_INTERVAL,
+                 report_batch_size=DEFAULT_REPORT_BATCH_SIZE, timeout=DEFAULT_TIMEOUT):
+        """
+        :param api_url: 代理池API的地址
+        :param protocol: 代理IP支持的协议，http或者https，可选
+        :param domain: 要访问的域名，不返回在这个域名下不可用的代理IP，可选
+        :param strategy: 获取代理IP的策略，round_robin或者weighted
+        :param batch_size: 每次预取的代理IP数量
+        :param refill_ratio: 本地可用的代理IP少于这个比例时重新获取
+        :param refresh_interval: 超过这个时间(单位s)没有更新时重新获取
+        :param report_interval: 批量报告使用结果的间隔，单位s
+        :param report_batch_size: 每次最多报告的数量
+        :param timeout: 请求代理池API的超时时间，单位s
+        """
+        self.api_url = api_url.rstrip('/')
+        self.protocol = protocol
+        self.domain = domain
+        self.batch_size = batch_size
+        self.refill_ratio = refill_ratio
+        self.refresh_interval = refresh_interval
+        self.report_interval = report_interval
+        self.report_batch_size = report_batch_size
+        self.timeout = timeout
+        self.buffer = ProxyBuffer(strategy)
+        # 上次获取的ETag
+        self.etag = None
+        # 还没有发送的使用结果
+        self.reports = []
+        self.report_lock = Lock()
+
+    def get_params(self):
+        """/proxies 的请求参数"""
+        params = {'limit': self.batch_size, 'fields': PROXY_FIELDS}
+        if self.protocol:
+            params['protocol'] = self.protocol
+        if self.domain:
+            params['domain'] = self.domain
+        return params
+
+    def get_headers(self):
+        """只有本地可用的代理IP足够时才带上ETag，可用的不够时需要服务端返回新的代理IP"""
+        return {'If-None-Match': self.etag} if self.etag and not self.buffer.is_low(self.refill_ratio) else {}
+
+    def load(self, status, etag, body):
+        """处理 /proxies 的响应"""
+        if status == 304:
+            self.buffer.touch()
+            return
+        if status != 200:
+            raise NoProxyError('获取代理IP失败：{} {}'.format(status, body[:100]))
+        self.etag = etag
+        self.buffer.replace([ClientProxy(**dic) for dic in json.loads(body)])
+
+    def need_refill(self):
+        return self.buffer.need_refill(self.refill_ratio, self.refresh_interval)
+
+    def report(self, proxy, ok=True, latency=None, domain=None):
+        """
+        报告代理IP的使用结果，失败的代理IP从本地缓冲区中移除，使用结果在后台批量发送
+        :param proxy: 代理IP
+        :param ok: 访问是否成功
+        :param latency: 访问的延迟，单位s，可选
+        :param domain: 访问的域名，默认使用创建客户端时的域名
+        """
+        if not ok:
+            self.buffer.remove(proxy)
+        event = {'ip': proxy.ip, 'port': proxy.port, 'ok': ok}
+        if latency is not None:
+            event['latency'] = latency
+        if domain or self.domain:
+            event['domain'] = domain or self.domain
+        with self.report_lock:
+            self.reports.append(event)
+
+    def take_reports(self):
+        """取出一批还没有发送的使用结果"""
+        with self.report_lock:
+            reports = self.reports[:self.report_batch_size]
+            self.reports = self.reports[self.report_batch_size:]
+        return reports
+
+
+class ProxyClient(BaseProxyClient):
+    """同步的客户端，可以在多个线程中使用"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        # 是否正在后台获取代理IP
+        self.refilling = False
+        self.refill_lock = Lock()
+        self.closed = False
+        Thread(target=self.__report_loop, daemon=True).start()
+
+    def refill(self):
+        """从 /proxies 获取代理IP"""
+        response = self.session.get(self.api_url + '/proxies', params=self.get_params(), headers=self.get_headers(),
+                                    timeout=self.timeout)
+        self.load(response.status_code, response.headers.get('ETag'), response.text)
+
+    def __refill_in_background(self):
+        try:
+            self.refill()
+        except Exception as ex:
+            logger.warning('获取代理IP失败：{}'.format(ex))
+        finally:
+            self.refilling = False
+
+    def get_proxy(self):
+        """
+        获取一个代理IP，需要时在后台重新获取
+        :return: 代理IP
+        """
+        proxy = self.buffer.get()
+        if proxy is None:
+            # 本地没有可用的代理IP，只能等待获取完成
+            self.refill()
+            proxy = self.buffer.get()
+            if proxy is None:
+                raise NoProxyError('没有可用的代理IP')
+        elif self.need_refill():
+            with self.refill_lock:
+                start = not self.refilling
+                self.refilling = True
+            if start:
+                Thread(target=self.__refill_in_background, daemon=True).start()
+        return proxy
+
+    def flush(self):
+        """发送所有还没有发送的使用结果"""
+        while True:
+            reports = self.take_reports()
+            if not reports:
+                return
+            self.session.post(self.api_url + '/report', json=reports, timeout=self.timeout)
+
+    def __report_loop(self):
+        while not self.closed:
+            time.sleep(self.report_interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.warning('报告使用结果失败：{}'.format(ex))
+
+    def close(self):
+        """发送剩下的使用结果，关闭连接"""
+        self.closed = True
+        self.flush()
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class AsyncProxyClient(BaseProxyClient):
+    """asyncio的客户端，需要在事件循环中创建"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        # 后台获取代理IP的任务
+        self.refill_task = None
+        self.report_task = None
+
+    async def start(self):
+        import aiohttp
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        self.report_task = asyncio.ensure_future(self.__report_loop())
+
+    async def refill(self):
+        """从 /proxies 获取代理IP"""
+        async with self.session.get(self.api_url + '/proxies', params=self.get_params(),
+                                    headers=self.get_headers()) as response:
+            self.load(response.status, response.headers.get('ETag'), await response.text())
+
+    async def __refill_in_background(self):
+        try:
+            await self.refill()
+        except Exception as ex:
+            logger.warning('获取代理IP失败：{}'.format(ex))
+
+    async def get_proxy(self):
+        """
+        获取一个代理IP，需要时在后台重新获取
+        :return: 代理IP
+        """
+        proxy = self.buffer.get()
+        if proxy is None:
+            # 本地没有可用的代理IP，只能等待获取完成；后台正在获取时等待后台的任务
+            if self.refill_task is not None and not self.refill_task.done():
+                await self.refill_task
+            if self.buffer.get() is None:
+                await self.refill()
+            proxy = self.buffer.get()
+            if proxy is None:
+                raise NoProxyError('没有可用的代理IP')
+        elif self.need_refill() and (self.refill_task is None or self.refill_task.done()):
+            self.refill_task = asyncio.ensure_future(self.__refill_in_background())
+        return proxy
+
+    async def flush(self):
+        """发送所有还没有发送的使用结果"""
+        while True:
+            reports = self.take_reports()
+            if not reports:
+                return
+            async with self.session.post(self.api_url + '/report', json=reports) as response:
+                await response.read()
+
+    async def __report_loop(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            try:
+                await self.flush()
+            except Exception as ex:
+                logger.warning('报告使用结果失败：{}'.format(ex))
+
+    async def close(self):
+        """发送剩下的使用结果，关闭连接"""
+        if self.report_task is not None:
+            self.report_task.cancel()
+        if self.refill_task is not None:
+            self.refill_task.cancel()
+        await self.flush()
+        await self.session.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+
+if __name__ == '__main__':
+    # 所有代理IP都失败后，get_proxy能重新获取代理IP
+    class FakeResponse(object):
+        def __init__(self, status_code, text=''):
+            self.status_code = status_code
+            self.headers = {'ETag': '"v1"'}
+            self.text = text
+
+    class FakeSession(object):
+        """代理IP一直没有变化的服务端：带上ETag时返回304"""
+        def get(self, url, params=None, headers=None, timeout=None):
+            if (headers or {}).get('If-None-Match') == '"v1"':
+                return FakeResponse(304)
+            return FakeResponse(200, json.dumps([{'ip': '1.2.3.{}'.format(i), 'port': '80'} for i in range(3)]))
+
+        def post(self, *args, **kwargs):
+            return FakeResponse(200)
+
+        def close(self):
+            pass
+
+    logging.basicConfig(level=logging.INFO)
+    with ProxyClient() as client:
+        client.session = FakeSession()
+        proxies = [client.get_proxy() for i in range(3)]
+        for proxy in proxies:
+            client.report(proxy, ok=False)
+        assert client.buffer.get() is None
+        assert client.get_proxy() is not None
+        print('ok')
@@ -0,0 +1,54 @@
+'''
+查看标准API查询的执行计划
+
+目标：随着代理池变大，确认API的查询使用了索引，排序直接由索引完成，没有在内存中排序(SORT阶段).
+步骤：
+    1. 准备标准的API查询：/random 和 /proxies 使用的协议类型和域名组合
+    2. 调用MongoPool的explain_proxies方法，获取执行计划
+    3. 打印获胜计划的各个阶段，使用的索引，扫描的索引数量和文档数量，返回数量和耗时
+'''
+
+from core.db.mongo_pool import MongoPool
+from settings import MAX_PROXIES_COUNT
+
+# 标准API查询：(名称, get_proxies的参数)
+STANDARD_QUERIES = [
+    ('protocol=None', {'protocol': None}),
+    ('protocol=http', {'protocol': 'http'}),
+    ('protocol=https', {'protocol': 'https'}),
+    ('protocol=https, domain=jd.com', {'protocol': 'https', 'domain': 'jd.com'}),
+]
+
+
+def get_stages(plan):
+    """遍历执行计划，获取所有阶段的名称和使用的索引"""
+    stages = []
+    while plan:
+        stage = plan['stage']
+        if 'indexName' in plan:
+            stage = '{}({})'.format(stage, plan['indexName'])
+        stages.append(stage)
+        # 合并排序等阶段有多个子阶段
+        for child in plan.get('inputStages', []):
+            stages.extend(get_stages(child))
+        plan = plan.get('inputStage')
+    return stages
+
+
+def explain_queries(mongo_pool):
+    """打印标准API查询的执行计划"""
+    for name, kwargs in STANDARD_QUERIES:
+        explain = mongo_pool.explain_proxies(count=MAX_PROXIES_COUNT, **kwargs)
+        stages = get_stages(explain['queryPlanner']['winningPlan'])
+        stats = explain.get('executionStats', {})
+
+        print(name)
+        print('    阶段：{}'.format(' <- '.join(stages)))
+        print('    内存排序：{}'.format('是' if 'SORT' in stages else '否'))
+        print('    扫描索引：{}，扫描文档：{}，返回：{}，耗时：{}ms'.format(
+            stats.get('totalKeysExamined'), stats.get('totalDocsExamined'),
+            stats.get('nReturned'), stats.get('executionTimeMillis')))
+
+
+if __name__ == '__main__':
+    explain_queries(MongoPool())
@@ -9,60 +9,242 @@
 1.在init中，建立数据连接，获取要操作的集合，在del方法中关闭数据库连接
 
 2.提供基础的增删改查功能
-    实现插入功能
+    实现插入功能：使用upsert，代理IP已经存在就不插入
     实现修改该功能
     实现删除代理：根据代理的IP删除代理
     查询所有代理IP的功能
+    查询所有代理IP的 ip 集合的功能，用于爬虫去重；_id就是ip，同一个ip只保存一个代理IP，去重也按照ip
+    查询到期需要检测的代理IP的功能
 
 3.提供代理API模块使用的功能
     实现查询功能：根据条件进行查询，可以指定查询数量，先分数降序，速度升序排，保证优质的代理IP在上面.
     实现根据协议类型和要访问网站的域名，获取代理IP列表
     实现根据协议类型和要访问完整的域名，随机获取一个代理IP
-    实现把指定域名添加到指定IP的disable_domain列表中.
+    实现把指定域名添加到指定IP的不可用域名中.
+        不可用域名保存在单独的domain_exclusions集合中，每条记录是 (域名, IP, 过期时间)，
+        使用TTL索引，过期后自动删除，代理IP自动恢复可用；按照域名查询可以使用索引，
+        代替以前保存在代理IP中不断增长的disable_domains列表
+
+    实现爬虫来源统计的查询和保存，保存在source_stats集合中，每个爬虫一条记录，用于调度爬虫
+    爬虫的页面缓存保存在page_cache集合中，每个URL一条记录，超过 PAGE_CACHE_EXPIRE 秒没有更新的自动删除
+
+4.索引管理
+    在INDEXES中声明API查询和检测模块调度使用的索引，在init中创建
+    API查询的条件是 nick_type相等，protocol使用$in，然后按照score降序，speed升序排序，
+    复合索引 (nick_type, protocol, score, speed) 可以让排序直接使用索引，不需要在内存中排序
+    可以运行 core/db/explain_queries.py 查看标准API查询的执行计划
+
+5.提供批量写入的功能
+    检测模块每检测一个代理IP就要修改或者删除一次，代理IP很多的时候，大部分时间都花在了数据库的往返上
+    BulkWriter把修改和删除操作先放到缓冲区中，达到数量或者时间间隔后，使用无序的bulk_write一次写入
+    使用MongoPool(buffered=True)创建对象后，update_one，delete_one和save_check_result会写入缓冲区，使用完毕后调用flush方法
+6.提供保存检测结果的功能
+    检测一个代理IP需要几秒钟，期间使用结果报告(ReportAggregator)可能已经更新了分数和速度；
+    检测模块只$set自己负责的字段，分数和速度使用聚合管道在数据库中的值的基础上调整，不覆盖整个代理IP
 '''
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, DeleteOne
+from pymongo.errors import BulkWriteError
+from threading import Lock
 import pymongo
 import random
+import time
 
-from settings import MONGO_URL
+from datetime import datetime, timedelta
+
+from settings import MONGO_URL, WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, DOMAIN_EXCLUSION_TTL, PAGE_CACHE_EXPIRE, \
+    MAX_SCORE, TEST_SUCCESS_SCORE, TEST_SPEED_WEIGHT
 from utils.log import logger
 from domain import Proxy
 
+class BulkWriter(object):
+    """批量写入缓冲区：达到数量或者时间间隔后，把缓冲区中的操作使用无序的bulk_write一次写入"""
+
+    def __init__(self, collection, batch_size=WRITE_BATCH_SIZE, flush_interval=WRITE_FLUSH_INTERVAL):
+        self.collection = collection
+        # 缓冲区中的操作达到这个数量就写入
+        self.batch_size = batch_size
+        # 距离上次写入超过这个时间就写入，单位s
+        self.flush_interval = flush_interval
+        self.operations = []
+        self.lock = Lock()
+        self.last_flush_time = time.time()
+        # 写入的统计信息
+        self.stats = {'batches': 0, 'operations': 0, 'errors': 0, 'total_latency': 0, 'max_latency': 0}
+
+    def add(self, operation):
+        """把一个操作放到缓冲区中"""
+        with self.lock:
+            self.operations.append(operation)
+            full = len(self.operations) >= self.batch_size
+        if full or time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """把缓冲区中的操作写入数据库"""
+        with self.lock:
+            operations, self.operations = self.operations, []
+            self.last_flush_time = time.time()
+        if not operations:
+            return
+
+        start_time = time.time()
+        errors = 0
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as ex:
+            # 无序写入时，一个操作失败不影响其他操作
+            errors = len(ex.details.get('writeErrors', []))
+            logger.error("批量写入{}个操作，失败{}个：{}".format(
+                len(operations), errors, ex.details.get('writeErrors', [])[:3]))
+        except Exception as ex:
+            errors = len(operations)
+            logger.exception(ex)
+        latency = time.time() - start_time
+
+        self.stats['batches'] += 1
+        self.stats['operations'] += len(operations)
+        self.stats['errors'] += errors
+        self.stats['total_latency'] += latency
+        self.stats['max_latency'] = max(self.stats['max_latency'], latency)
+        logger.info("批量写入{}个操作，耗时{:.3f}s".format(len(operations), latency))
+
+    def get_stats(self):
+        """获取写入的统计信息，包括平均每批的写入耗时"""
+        stats = dict(self.stats)
+        stats['avg_latency'] = stats['total_latency'] / stats['batches'] if stats['batches'] else 0
+        return stats
+
+
 class MongoPool(object):
-    def __init__(self):
+
+    # proxies集合的索引：(索引的字段列表, 索引名称)
+    INDEXES = [
+        # API查询：get_proxies
+        ([('nick_type', pymongo.ASCENDING), ('protocol', pymongo.ASCENDING),
+          ('score', pymongo.DESCENDING), ('speed', pymongo.ASCENDING)], 'api_query'),
+        # 检测模块调度：iter_due 和 get_next_check_at
+        ([('next_check_at', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)], 'next_check'),
+    ]
+
+    # domain_exclusions集合的索引：(索引的字段列表, 索引名称, 其他参数)
+    EXCLUSION_INDEXES = [
+        # 过期后自动删除
+        ([('expire_at', pymongo.ASCENDING)], 'expire', {'expireAfterSeconds': 0}),
+        # 按照域名查询不可用的IP
+        ([('domain', pymongo.ASCENDING), ('expire_at', pymongo.ASCENDING)], 'domain', {}),
+    ]
+
+    # page_cache集合的索引：(索引的字段列表, 索引名称, 其他参数)
+    PAGE_CACHE_INDEXES = [
+        # 爬虫不再爬取的URL，过期后自动删除
+        ([('updated_at', pymongo.ASCENDING)], 'expire', {'expireAfterSeconds': PAGE_CACHE_EXPIRE}),
+    ]
+
+    def __init__(self, buffered=False):
         # 建立数据连接
         self.client = MongoClient(MONGO_URL)
         # 获取要操作的集合
         self.proxies = self.client['proxies_pool']['proxies']
+        # 获取不可用域名的集合
+        self.exclusions = self.client['proxies_pool']['domain_exclusions']
+        # 获取爬虫来源统计的集合
+        self.source_stats = self.client['proxies_pool']['source_stats']
+        # 获取爬虫页面缓存的集合
+        self.page_cache = self.client['proxies_pool']['page_cache']
+        # 创建索引
+        self.create_indexes()
+        # 如果使用批量写入，update_one和delete_one先写入缓冲区
+        self.bulk_writer = BulkWriter(self.proxies) if buffered else None
 
     def __del__(self):
         # 关闭数据库连接
         self.client.close()
 
+    def create_indexes(self):
+        """创建INDEXES中声明的索引，索引已经存在时不会重复创建"""
+        for keys, name in self.INDEXES:
+            self.proxies.create_index(keys, name=name, background=True)
+        for keys, name, options in self.EXCLUSION_INDEXES:
+            self.exclusions.create_index(keys, name=name, background=True, **options)
+        for keys, name, options in self.PAGE_CACHE_INDEXES:
+            self.page_cache.create_index(keys, name=name, background=True, **options)
+
     def insert_one(self, proxy):
-        '''实现插入功能'''
-        count = self.proxies.count_documents({"_id": proxy.ip})
-        if count == 0:
-            # 我们使用proxy.id作为 MongoDB数据库中的主键：_id
-            dic = proxy.__dict__
-            dic["_id"] = proxy.ip
-            print(dic)
-            self.proxies.insert_one(dic)
+        '''实现插入功能：使用upsert，只有代理IP不存在的时候才插入，一次往返，没有先查询再插入的竞争'''
+        # 我们使用proxy.ip作为 MongoDB数据库中的主键：_id
+        conditions = {"_id": proxy.ip}
+        document = {"$setOnInsert": dict(proxy.__dict__)}
+        if self.bulk_writer:
+            self.bulk_writer.add(UpdateOne(conditions, document, upsert=True))
+            return
+        result = self.proxies.update_one(conditions, document, upsert=True)
+        if result.upserted_id is not None:
             logger.info("新插入的代理是：{}".format(proxy))
         else:
             logger.warning("已存在的代理：{}".format(proxy))
 
     def update_one(self, proxy):
         '''实现修改该功能'''
+        if self.bulk_writer:
+            self.bulk_writer.add(UpdateOne({"_id": proxy.ip}, {"$set": dict(proxy.__dict__)}))
+            return
         self.proxies.update_one({"_id":proxy.ip}, {"$set":proxy.__dict__})
         logger.info("更新后的代理是：{}".format(proxy))
 
+    def get_check_operations(self, proxy, ok):
+        """
+        生成保存检测结果的操作
+        :param proxy: 检测后的代理IP，检测模块负责的字段已经修改
+        :param ok: 检测是否成功
+        :return: 操作列表；检测失败时还有一个删除操作，分数减到0时删除
+        """
+        # 检测模块负责的字段
+        fields = {field: getattr(proxy, field) for field in
+                  ('next_check_at', 'check_interval', 'fail_count', 'speed_history', 'protocol', 'nick_type')}
+        if ok:
+            fields['score'] = {'$min': [MAX_SCORE, {'$add': ['$score', TEST_SUCCESS_SCORE]}]}
+            # 检测失败的代理IP速度是-1，直接使用检测的速度
+            fields['speed'] = {'$round': [{'$cond': [
+                {'$gt': ['$speed', 0]},
+                {'$add': [{'$multiply': ['$speed', 1 - TEST_SPEED_WEIGHT]}, proxy.speed * TEST_SPEED_WEIGHT]},
+                proxy.speed,
+            ]}, 2]}
+            return [UpdateOne({'_id': proxy.ip}, [{'$set': fields}])]
+        fields['score'] = {'$max': [0, {'$add': ['$score', -1]}]}
+        fields['speed'] = -1
+        # 批量写入是无序的，删除可能在更新之前执行，这时分数减到0的代理IP在下次检测失败时删除
+        return [UpdateOne({'_id': proxy.ip}, [{'$set': fields}]),
+                DeleteOne({'_id': proxy.ip, 'score': {'$lte': 0}})]
+
+    def save_check_result(self, proxy, ok):
+        """保存检测结果，只修改检测模块负责的字段，分数和速度在数据库中的值的基础上调整"""
+        operations = self.get_check_operations(proxy, ok)
+        if self.bulk_writer:
+            for operation in operations:
+                self.bulk_writer.add(operation)
+            return
+        self.proxies.bulk_write(operations, ordered=True)
+        logger.info("检测结果：{} {}".format(proxy.ip, '可用' if ok else '不可用'))
+
     def delete_one(self, proxy):
         '''实现删除代理：根据代理的IP删除代理'''
-        self.proxies.delete_one({"id": proxy.ip})
+        if self.bulk_writer:
+            self.bulk_writer.add(DeleteOne({"_id": proxy.ip}))
+            return
+        self.proxies.delete_one({"_id": proxy.ip})
         logger.info("删除代理IP：{}".format(proxy))
 
+    def flush(self):
+        """把缓冲区中的操作写入数据库"""
+        if self.bulk_writer:
+            self.bulk_writer.flush()
+
+    def get_proxy_ips(self):
+        """查询所有代理IP的 ip 集合，用于爬虫去重；插入时使用ip作为_id，已有的ip换一个端口号也不会插入"""
+        cursor = self.proxies.find({}, {'_id': 1})
+        return {item['_id'] for item in cursor}
+
     def find_all(self):
         """查询所有代理IP的功能"""
         cursor = self.proxies.find()
@@ -71,6 +253,43 @@ class MongoPool(object):
             proxy = Proxy(**item)
             yield proxy
 
+    def iter_due(self, now, batch_size=1000):
+        """
+        查询到期需要检测的代理IP的功能，最早到期的代理IP在前面
+        每次只从数据库中读取batch_size个代理IP，按照(next_check_at, _id)分页查询，
+        不会长时间占用一个游标，检测时间再长游标也不会超时
+        :param now: 当前时间戳，next_check_at小于等于这个时间的代理IP需要检测
+        :param batch_size: 每次从数据库中读取代理IP的数量
+        :return: 到期的代理IP（Proxy对象）生成器
+        """
+        conditions = {'next_check_at': {'$lte': now}}
+        while True:
+            cursor = self.proxies.find(conditions, limit=batch_size).sort([
+                ('next_check_at', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)
+            ])
+            items = list(cursor)
+            for item in items:
+                item.pop("_id")
+                yield Proxy(**item)
+
+            if len(items) < batch_size:
+                break
+            # 下一页从本页最后一个代理IP之后开始，_id就是代理IP的ip
+            last = items[-1]
+            conditions = {'next_check_at': {'$lte': now}, '$or': [
+                {'next_check_at': {'$gt': last['next_check_at']}},
+                {'next_check_at': last['next_check_at'], '_id': {'$gt': last['ip']}},
+            ]}
+
+    def get_next_check_at(self):
+        """获取最早的下次检测时间，没有代理IP时返回None"""
+        item = self.proxies.find_one({}, {'next_check_at': 1}, sort=[('next_check_at', pymongo.ASCENDING)])
+        return item['next_check_at'] if item else None
+
+    def init_next_check_at(self):
+        """以前存入数据库的代理IP没有next_check_at字段，设置为0，让它们立即被检测"""
+        self.proxies.update_many({'next_check_at': {'$exists': False}}, {'$set': {'next_check_at': 0}})
+
     def find(self, conditions={}, count=0):
         """
         实现查询功能：根据条件进行查询，可以指定查询数量，先分数降序，速度升序排，保证优质的代理IP在上面
@@ -78,9 +297,7 @@ class MongoPool(object):
         :param count: 限制最多取出多少个代理IP
         :return: 满足条件的代理IP（Proxy对象）列表
         """
-        cursor = self.proxies.find(conditions, limit=count).sort([
-            ('score', pymongo.DESCENDING),('speed', pymongo.ASCENDING)
-        ])
+        cursor = self.find_cursor(conditions, count)
 
         # 准备列表，用于存储查询处理代理IP
         proxy_list = []
@@ -93,6 +310,12 @@ class MongoPool(object):
         # 返回满足条件的代理IP（Proxy对象）列表
         return proxy_list
 
+    def find_cursor(self, conditions={}, count=0):
+        """根据条件创建查询的游标，先分数降序，速度升序排"""
+        return self.proxies.find(conditions, limit=count).sort([
+            ('score', pymongo.DESCENDING),('speed', pymongo.ASCENDING)
+        ])
+
     def get_proxies(self, protocol=None, domain=None, count=0, nick_type=0):
         """
         实现根据协议类型和要访问网站的域名，获取代理IP列表
@@ -102,6 +325,16 @@ class MongoPool(object):
         :param nick_type: 匿名类型，默认高匿
         :return: 满足条件的代理IP
         """
+        conditions = self.get_conditions(protocol, domain, nick_type)
+        return self.find(conditions, count=count)
+
+    def explain_proxies(self, protocol=None, domain=None, count=0, nick_type=0):
+        """获取get_proxies查询的执行计划"""
+        conditions = self.get_conditions(protocol, domain, nick_type)
+        return self.find_cursor(conditions, count).explain()
+
+    def get_conditions(self, protocol=None, domain=None, nick_type=0):
+        """根据协议类型，域名和匿名类型，生成get_proxies的查询条件"""
 
         # 定义查询条件
         conditions = {}
@@ -116,13 +349,14 @@ class MongoPool(object):
             conditions['protocol'] = {"$in": [1,2]}
 
         if domain:
-            conditions['disable_domains'] = {"$nin": [domain]}
+            # 排除不能访问这个域名的代理IP
+            excluded_ips = self.get_excluded_ips(domain)
+            if excluded_ips:
+                conditions['_id'] = {"$nin": list(excluded_ips)}
 
-        conditions['nick_type'] = 0
+        conditions['nick_type'] = nick_type
 
-        print(conditions)
-
-        return self.find(conditions, count=count)
+        return conditions
 
     def random_proxy(self, protocol=None, domain=None, count=0, nick_type=0):
         """
@@ -136,19 +370,51 @@ class MongoPool(object):
         proxy_list = self.get_proxies(protocol=protocol, domain=domain, count=count, nick_type=nick_type)
         return random.choice(proxy_list)
 
-    def disable_domain(self, ip, domain):
+    def get_exclusion_operation(self, ip, domain, ttl=DOMAIN_EXCLUSION_TTL):
+        """生成把指定域名添加到指定IP的不可用域名中的操作，已经存在时更新过期时间"""
+        return UpdateOne({"_id": "{}|{}".format(domain, ip)},
+                         {"$set": {"domain": domain, "ip": ip, "expire_at": datetime.utcnow() + timedelta(seconds=ttl)}},
+                         upsert=True)
+
+    def disable_domain(self, ip, domain, ttl=DOMAIN_EXCLUSION_TTL):
         """
-        实现把指定域名添加到指定IP的disable_domain列表中
+        实现把指定域名添加到指定IP的不可用域名中，过期后自动恢复
         :param ip: ip地址
         :param domain: 域名
-        :return: true，添加成功；false，添加失败
+        :param ttl: 不可用的时间，单位s
+        :return: true，添加成功
         """
+        self.exclusions.bulk_write([self.get_exclusion_operation(ip, domain, ttl)])
+        return True
+
+    def get_excluded_ips(self, domain):
+        """获取不能访问指定域名的IP集合，TTL索引每分钟才删除一次，这里需要过滤掉已经过期的"""
+        cursor = self.exclusions.find({"domain": domain, "expire_at": {"$gt": datetime.utcnow()}}, {"ip": 1})
+        return {item['ip'] for item in cursor}
+
+    def find_exclusions(self):
+        """查询所有没有过期的不可用域名，返回 (域名, IP, 过期时间戳) 的生成器"""
+        cursor = self.exclusions.find({"expire_at": {"$gt": datetime.utcnow()}})
+        for item in cursor:
+            # expire_at是UTC时间
+            expire_at = (item['expire_at'] - datetime(1970, 1, 1)).total_seconds()
+            yield item['domain'], item['ip'], expire_at
 
-        if self.proxies.count_documents({"_id": ip, "disable_domains": domain}) == 0:
-            # 如果disable_domains字段中没有这个域名,再去添加
-            self.proxies.update_one({"_id": ip}, {'$push': {"disable_domains": domain}})
-            return  True
-        return False
+    def find_source_stats(self):
+        """查询所有爬虫来源的统计，返回 爬虫名称 -> 统计字典"""
+        return {item['_id']: item for item in self.source_stats.find()}
+
+    def save_source_stats(self, name, stats):
+        """保存一个爬虫来源的统计"""
+        self.source_stats.update_one({'_id': name}, {'$set': stats}, upsert=True)
+
+    def migrate_disable_domains(self):
+        """把以前保存在代理IP中的disable_domains列表迁移到domain_exclusions集合中"""
+        cursor = self.proxies.find({"disable_domains.0": {"$exists": True}}, {"disable_domains": 1})
+        for item in cursor:
+            operations = [self.get_exclusion_operation(item['_id'], domain) for domain in item['disable_domains']]
+            self.exclusions.bulk_write(operations, ordered=False)
+            self.proxies.update_one({"_id": item['_id']}, {"$set": {"disable_domains": []}})
 
 
 if __name__ == '__main__':
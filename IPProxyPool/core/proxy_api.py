@@ -14,24 +14,77 @@
 
     实现初始方法
         初始一个Flask的Web服务
+        创建进程内的代理IP缓存，/random 和 /proxies 从缓存中获取代理IP，不用每次请求都查询数据库
         实现根据协议类型和域名，提供随机的获取高可用代理IP的服务
             可用通过protocol和domain参数对IP进行过滤
             protocol：当前请求的协议类型
             domain：当前请求域名
         实现根据协议类型和域名，提供获取多个高可用代理IP的服务·
             可用通过protocol和domain参数对IP进行过滤
+            支持使用游标分页，指定返回的字段，流式返回ndjson或者文本格式
+            支持msgpack和每个代理IP固定8个字节的packed格式，可以通过format参数或者Accept请求头选择
+            msgpack是可选的依赖，没有安装时format=msgpack返回400，Accept请求头只接受msgpack时返回406
+            支持ETag，代理IP没有变化时返回304
+        实现租用代理IP和归还代理IP的服务
+            限制每个代理IP同时被租用的数量，同一个代理IP归还后一段时间内不能再访问同一个域名
+            租用的状态保存在进程的内存中，asgi方式运行多个工作进程时不提供租用服务，返回501
+        实现批量报告代理IP使用结果的服务
+            汇总后定期批量更新代理IP的score和speed，归还租用的代理IP时报告的结果也会汇总
         实现给指定的IP上追加不可用域名的服务
             如果在获取IP的时候，有指定域名参数，将不在获取该IP从而进一步提高代理IP的可用性.
     实现run方法，用于启动Flask的WEB服务
     实现start的类方法，用于通过类名，启动服务
+        API_SERVER配置为asgi时，使用uvicorn启动多进程的异步服务，支持keep-alive；
+        Flask应用通过WsgiToAsgi在线程池中运行，数据库访问不会阻塞事件循环
+    实现create_asgi_app方法，用于uvicorn的每个进程创建ASGI应用
 '''
 
 from flask import Flask
 from flask import request
+from flask import Response
+from itertools import islice
+import hashlib
 import json
 
 from core.db.mongo_pool import MongoPool
-from settings import MAX_PROXIES_COUNT
+from core.proxy_cache import ProxyCache, encode_cursor, decode_cursor
+from core.proxy_codec import encode_msgpack, iter_packed, has_msgpack
+from core.proxy_lease import LeaseManager
+from core.proxy_report import ReportAggregator
+from domain import Proxy
+from settings import MAX_PROXIES_COUNT, PROXIES_PAGE_MAX_SIZE, LEASE_TTL, REPORT_MAX_EVENTS, API_HOST, API_PORT, API_SERVER, API_WORKERS, API_KEEP_ALIVE_TIMEOUT
+
+# /proxies支持的格式和对应的mimetype
+PROXIES_FORMATS = {
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'text': 'text/plain',
+    'msgpack': 'application/msgpack',
+    'packed': 'application/x-proxy-packed',
+}
+# msgpack格式的mimetype
+MSGPACK_MIMETYPES = ['application/msgpack', 'application/x-msgpack']
+# msgpack是可选的依赖，没有安装时不支持msgpack格式
+if not has_msgpack():
+    del PROXIES_FORMATS['msgpack']
+# Accept请求头中的mimetype对应的格式，没有format参数时使用
+MIMETYPE_FORMATS = {mimetype: fmt for fmt, mimetype in PROXIES_FORMATS.items()}
+if 'msgpack' in PROXIES_FORMATS:
+    MIMETYPE_FORMATS['application/x-msgpack'] = 'msgpack'
+# 需要一次生成整个响应的格式
+BUFFERED_FORMATS = {'json', 'msgpack'}
+# asgi方式运行多个工作进程时，租用接口返回的信息
+LEASE_DISABLED_MESSAGE = "租用的状态保存在进程的内存中，asgi方式运行时需要把API_WORKERS设置为1才能使用租用接口"
+# /proxies可以指定返回的字段
+PROXY_FIELDS = set(Proxy('', '').__dict__)
+
+
+def get_proxy_fields(proxy, fields=None):
+    """获取代理IP指定的字段，没有指定字段时返回所有字段"""
+    if not fields:
+        return proxy.__dict__
+    return {field: getattr(proxy, field) for field in fields}
+
 
 class ProxyApi(object):
 
@@ -40,6 +93,14 @@ class ProxyApi(object):
         self.app = Flask(__name__)
         # 创建MOngoPool对象，用于操作数据库
         self.mongo_pool = MongoPool()
+        # 创建代理IP缓存，启动后台刷新
+        self.proxy_cache = ProxyCache(self.mongo_pool)
+        self.proxy_cache.start()
+        # 创建代理IP的租用管理；租用的状态保存在进程的内存中，多个工作进程时不能使用
+        self.lease_manager = None if API_SERVER == 'asgi' and API_WORKERS > 1 else LeaseManager(self.proxy_cache)
+        # 创建使用结果的汇总，启动后台写入
+        self.report_aggregator = ReportAggregator(self.mongo_pool, self.proxy_cache.exclusions)
+        self.report_aggregator.start()
 
         @self.app.route('/random')
         def random():
@@ -55,7 +116,8 @@ class ProxyApi(object):
             # print(protocol)
             # print(domain)
 
-            proxy = self.mongo_pool.random_proxy(protocol, domain, count=MAX_PROXIES_COUNT)
+            # 在所有可用的代理IP中，按照分数和响应速度加权随机选择
+            proxy = self.proxy_cache.random_proxy(protocol, domain)
 
             if protocol:
                 return "{}://{}:{}".format(protocol, proxy.ip, proxy.port)
@@ -66,18 +128,172 @@ class ProxyApi(object):
         def proxies():
             """
             实现根据协议类型和域名，提供获取多个高可用代理IP的服务
+                cursor：分页的游标，从上一页的响应头 X-Next-Cursor 中获取，没有这个响应头说明已经是最后一页
+                limit：每页的数量，默认MAX_PROXIES_COUNT，最大PROXIES_PAGE_MAX_SIZE；ndjson和text格式下为0表示返回所有
+                fields：返回的字段，用逗号分隔，比如 ip,port,protocol
+                format：json(默认)，ndjson(每行一个json)，text(每行一个代理IP，字段用':'分隔，默认ip:port)，
+                        msgpack(和json的结构一样)，packed(每个代理IP固定8个字节，见proxy_codec，忽略fields)
+                        没有format参数时，根据Accept请求头选择格式
+                请求头If-None-Match和上次响应的ETag相同时，说明代理IP没有变化，返回304
             :return:
             """
             protocol = request.args.get('protocol')
             domain = request.args.get('domain')
+            cursor = request.args.get('cursor')
+            fmt = request.args.get('format')
+            if fmt is None:
+                # 内容协商，Accept是*/*或者没有时使用json；只接受msgpack，但是没有安装msgpack时返回406
+                mimetype = request.accept_mimetypes.best_match(list(MIMETYPE_FORMATS))
+                if mimetype is None:
+                    if any(request.accept_mimetypes[mimetype] for mimetype in MSGPACK_MIMETYPES):
+                        return "不支持的格式：msgpack，服务端没有安装msgpack", 406
+                    mimetype = 'application/json'
+                fmt = MIMETYPE_FORMATS[mimetype]
+            fields = request.args.get('fields')
+            limit = request.args.get('limit', MAX_PROXIES_COUNT, type=int)
 
-            proxies = self.mongo_pool.get_proxies(protocol, domain, count=MAX_PROXIES_COUNT)
+            if fmt not in PROXIES_FORMATS:
+                return "不支持的格式：{}{}".format(fmt, '，服务端没有安装msgpack' if fmt == 'msgpack' else ''), 400
+            fields = fields.split(',') if fields else None
+            if fields and not PROXY_FIELDS.issuperset(fields):
+                return "不支持的字段：{}".format(','.join(set(fields) - PROXY_FIELDS)), 400
+            if cursor:
+                try:
+                    decode_cursor(cursor)
+                except ValueError as ex:
+                    return str(ex), 400
+            # json和msgpack格式需要一次生成整个响应，限制每页的数量
+            if fmt in BUFFERED_FORMATS or limit > 0:
+                limit = min(limit if limit > 0 else MAX_PROXIES_COUNT, PROXIES_PAGE_MAX_SIZE)
+
+            # 代理IP和请求参数都没有变化，返回304
+            entry = self.proxy_cache.get_entry(self.proxy_cache.get_key(protocol))
+            etag = entry.etag + fmt + request.query_string.decode()
+            excluded = None
+            if domain:
+                # 不可用域名变化后，按照域名过滤的结果也会变化
+                etag += str(self.proxy_cache.exclusions.get_version())
+                excluded = self.proxy_cache.exclusions.get_ips(domain)
+            etag = hashlib.md5(etag.encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            proxies = entry.iter_proxies(cursor, excluded)
+            headers = {}
+            if limit > 0:
+                # 取出一页的代理IP，如果取满了，下一页从这一页最后一个代理IP之后开始
+                proxies = list(islice(proxies, limit))
+                if len(proxies) == limit:
+                    headers['X-Next-Cursor'] = encode_cursor(proxies[-1])
+
+            if fmt == 'json':
+                # proxies 是一个Proxy对象的列表，不能够直接json序列化，需要转换成dict列表
+                body = json.dumps([get_proxy_fields(proxy, fields) for proxy in proxies])
+            elif fmt == 'msgpack':
+                body = encode_msgpack([get_proxy_fields(proxy, fields) for proxy in proxies])
+            elif fmt == 'packed':
+                body = iter_packed(proxies)
+            elif fmt == 'ndjson':
+                # 流式返回，不需要生成整个列表
+                body = (json.dumps(get_proxy_fields(proxy, fields)) + '\n' for proxy in proxies)
+            else:
+                text_fields = fields or ['ip', 'port']
+                body = (':'.join(str(getattr(proxy, field)) for field in text_fields) + '\n' for proxy in proxies)
 
-            # proxies 是一个Proxy对象的列表，不能够直接json序列化，需要转换成dict列表
-            proxies = [proxy.__dict__ for proxy in proxies]
+            # 格式可能由Accept请求头决定
+            headers['Vary'] = 'Accept'
+            response = Response(body, mimetype=PROXIES_FORMATS[fmt], headers=headers)
+            response.set_etag(etag)
+            return response
+
+        @self.app.route('/lease/acquire')
+        def lease_acquire():
+            """
+            实现租用代理IP的服务
+                protocol：当前请求的协议类型
+                domain：当前请求域名
+                ttl：租约的有效时间，单位s，超时没有归还自动收回
+            :return: json，包含租约ID，代理IP和过期时间
+            """
+            if self.lease_manager is None:
+                return LEASE_DISABLED_MESSAGE, 501
+            protocol = request.args.get('protocol')
+            domain = request.args.get('domain')
+            try:
+                ttl = float(request.args.get('ttl', LEASE_TTL))
+                lease = self.lease_manager.acquire(protocol, domain, ttl=ttl)
+            except ValueError as ex:
+                return "ttl参数不正确：{}".format(ex), 400
+            if lease is None:
+                return "没有可用的代理IP", 503
 
-            # 返回json序列化字符串
-            return json.dumps(proxies)
+            proxy = lease.proxy
+            return Response(json.dumps({
+                'lease_id': lease.id,
+                'proxy': '{}://{}:{}'.format(protocol, proxy.ip, proxy.port) if protocol
+                         else '{}:{}'.format(proxy.ip, proxy.port),
+                'ip': proxy.ip,
+                'port': proxy.port,
+                'expires_at': lease.expires_at,
+            }), mimetype='application/json')
+
+        @self.app.route('/lease/release')
+        def lease_release():
+            """
+            实现归还代理IP的服务
+                lease_id：租约ID
+                ok：使用这个代理IP访问是否成功，1成功，0失败，默认成功
+                latency：访问的延迟，单位s，可选
+            :return:
+            """
+            if self.lease_manager is None:
+                return LEASE_DISABLED_MESSAGE, 501
+            lease_id = request.args.get('lease_id')
+            ok = request.args.get('ok', '1') != '0'
+            latency = request.args.get('latency', type=float)
+
+            if lease_id is None:
+                return "请提供lease_id参数", 400
+            lease = self.lease_manager.release(lease_id, ok)
+            if lease is None:
+                return "租约 {} 不存在或者已经过期".format(lease_id), 404
+            # 汇总使用结果
+            self.report_aggregator.add(lease.proxy.ip, lease.proxy.port, lease.domain, ok, latency)
+            return "归还 {}:{} 成功".format(lease.proxy.ip, lease.proxy.port)
+
+        @self.app.route('/report', methods=['POST'])
+        def report():
+            """
+            实现批量报告代理IP使用结果的服务
+                请求体是json列表，每个元素是 {"ip": "1.2.3.4", "port": "8080", "domain": "jd.com", "ok": true, "latency": 0.5}
+                domain和latency是可选的，ok可选，默认为true，必须是json的true或者false，否则拒绝这个结果
+            :return: json，接收和拒绝的结果数量
+            """
+            events = request.get_json(silent=True)
+            if not isinstance(events, list):
+                return "请求体需要是json列表", 400
+            if len(events) > REPORT_MAX_EVENTS:
+                return "一次最多报告{}个结果".format(REPORT_MAX_EVENTS), 400
+
+            accepted = 0
+            for event in events:
+                if not isinstance(event, dict) or not event.get('ip') or not event.get('port'):
+                    continue
+                # "false"，"0"这样的字符串不能当作成功
+                ok = event.get('ok', True)
+                if not isinstance(ok, bool):
+                    continue
+                latency = event.get('latency')
+                if not isinstance(latency, (int, float)):
+                    latency = None
+                self.report_aggregator.add(event['ip'], event['port'], event.get('domain'),
+                                           ok, latency)
+                accepted += 1
+
+            return Response(json.dumps({'accepted': accepted, 'rejected': len(events) - accepted}),
+                            mimetype='application/json')
 
         @self.app.route('/disable_domain')
         def disable_domain():
@@ -95,6 +311,7 @@ class ProxyApi(object):
                 return "请提供域名domain参数"
 
             self.mongo_pool.disable_domain(ip, domain)
+            self.proxy_cache.disable_domain(ip, domain)
             return "{} 禁用域名 {} 成功".format(ip, domain)
 
             # if self.mongo_pool.disable_domain(ip, domain):
@@ -104,13 +321,29 @@ class ProxyApi(object):
 
     def run(self):
         """用于启动Flask的WEB服务"""
-        self.app.run('0.0.0.0', port=16888)
+        self.app.run(API_HOST, port=API_PORT)
 
     @classmethod
     def start(cls):
         """用于通过类名，启动服务"""
+        if API_SERVER == 'asgi':
+            run_asgi_server()
+            return
         proxy_api = cls()
         proxy_api.run()
 
+
+def create_asgi_app():
+    """创建ASGI应用，Flask应用在线程池中运行"""
+    from asgiref.wsgi import WsgiToAsgi
+    return WsgiToAsgi(ProxyApi().app)
+
+
+def run_asgi_server():
+    """使用uvicorn启动多进程的异步服务，每个进程通过create_asgi_app创建自己的ProxyApi对象"""
+    import uvicorn
+    uvicorn.run('core.proxy_api:create_asgi_app', factory=True, host=API_HOST, port=API_PORT,
+                workers=API_WORKERS, timeout_keep_alive=API_KEEP_ALIVE_TIMEOUT, access_log=False)
+
 if __name__ == '__main__':
     ProxyApi.start()
\ No newline at end of file
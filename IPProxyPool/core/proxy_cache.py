@@ -0,0 +1,265 @@
+'''
+实现代理池API进程内的代理IP缓存
+
+目标：/random 和 /proxies 不再每次请求都查询数据库，直接从内存中按照排名获取代理IP.
+思路：
+    1. 按照 (协议类型, 匿名类型) 缓存排好序(先分数降序，速度升序)的代理IP列表
+    2. 后台线程每隔 PROXY_CACHE_REFRESH_INTERVAL 秒刷新一次；如果开启了 PROXY_CACHE_WATCH，
+       监听MongoDB的变更流，数据变化后立即刷新
+    3. 第一次访问某个key时才从数据库中加载，同一个key的并发加载合并成一次数据库查询
+    4. 域名过滤在内存中进行，使用DomainExclusions判断代理IP能不能访问这个域名，刷新缓存时一起从数据库中重新加载
+    5. 随机获取代理IP时，按照分数和响应速度加权选择，使用别名表，每次选择O(1)；
+       并且有 RANDOM_EXPLORATION_RATE 的概率在所有代理IP中等概率选择，让排名靠后的代理IP也能分到流量
+    6. 分页使用游标：游标是上一页最后一个代理IP的排名 (-score, speed, ip)，刷新缓存后也能接着上一页获取；
+       每个缓存的内容对应一个ETag，内容不变时客户端可以直接使用上次的结果
+步骤：
+    1. 定义CacheEntry类，保存一个key的代理IP列表，加载时间，按照权重选择的别名表和ETag
+        实现iter_proxies方法，从游标之后开始，按照排名遍历代理IP
+    2. 定义ProxyCache类
+        实现get_proxies方法，根据协议类型和域名，获取代理IP列表
+        实现random_proxy方法，根据协议类型和域名，按照权重随机获取一个代理IP
+        实现disable_domain方法，同步添加到内存中的不可用域名
+        实现refresh方法，刷新所有已经加载的key
+        实现start方法，启动后台刷新线程
+'''
+
+from threading import Lock, Event, Thread
+import base64
+import bisect
+import hashlib
+import json
+import random
+import time
+
+from core.proxy_exclusion import DomainExclusions
+from settings import PROXY_CACHE_REFRESH_INTERVAL, PROXY_CACHE_MAX_SIZE, PROXY_CACHE_WATCH, \
+    RANDOM_EXPLORATION_RATE, MAX_SCORE, TEST_TIMEOUT
+from utils.alias_table import AliasTable
+from utils.log import logger
+
+# 按照域名过滤时，加权选择的最大尝试次数，超过后在过滤后的列表中等概率选择
+MAX_SAMPLE_TRIES = 10
+
+
+def get_weight(proxy):
+    """代理IP的权重：分数越高，响应速度越快，权重越大"""
+    # 检测失败的代理IP响应速度是-1，按照最慢计算
+    speed = proxy.speed if proxy.speed > 0 else TEST_TIMEOUT
+    return (proxy.score / MAX_SCORE) / max(speed, 0.1)
+
+
+def get_rank_key(proxy):
+    """代理IP的排名：先分数降序，速度升序，相同时按照ip排序，保证分页的顺序是确定的"""
+    return -proxy.score, proxy.speed, proxy.ip
+
+
+def encode_cursor(proxy):
+    """把代理IP的排名编码成分页的游标"""
+    return base64.urlsafe_b64encode(json.dumps(get_rank_key(proxy)).encode()).decode()
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def decode_cursor(cursor):
+    """把分页的游标解码成代理IP的排名，游标不合法时抛出ValueError"""
+    try:
+        negative_score, speed, ip = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except Exception:
+        raise ValueError('不合法的游标：{}'.format(cursor))
+    # 排名和代理IP的排名比较，类型不一致时比较会出错
+    if not (is_number(negative_score) and is_number(speed) and isinstance(ip, str)):
+        raise ValueError('不合法的游标：{}'.format(cursor))
+    return negative_score, speed, ip
+
+
+class CacheEntry(object):
+    """一个key缓存的代理IP列表"""
+
+    def __init__(self, proxies):
+        # 排好序的代理IP列表
+        self.proxies = sorted(proxies, key=get_rank_key)
+        # 每个代理IP的排名，用于按照游标分页
+        self.keys = [get_rank_key(proxy) for proxy in self.proxies]
+        # ip:port -> 在列表中的下标
+        self.ranks = {'{}:{}'.format(proxy.ip, proxy.port): rank for rank, proxy in enumerate(self.proxies)}
+        # 加载时间
+        self.loaded_at = time.time()
+        # 按照权重选择的别名表，代理IP列表变化时重新创建
+        self.sampler = AliasTable([get_weight(proxy) for proxy in self.proxies])
+        self.etag = None
+        self.update_etag()
+
+    def update_etag(self):
+        """根据代理IP列表的内容生成ETag，内容变化后需要重新生成"""
+        content = [[proxy.ip, proxy.port, proxy.protocol, proxy.nick_type, proxy.score, proxy.speed]
+                   for proxy in self.proxies]
+        self.etag = hashlib.md5(json.dumps(content).encode()).hexdigest()
+
+    def iter_proxies(self, cursor=None, excluded=None):
+        """
+        从游标之后开始，按照排名遍历代理IP
+        :param cursor: 分页的游标，None表示从头开始
+        :param excluded: 要过滤掉的IP集合，比如不能访问某个域名的IP
+        :return: 代理IP的生成器
+        """
+        start = bisect.bisect_right(self.keys, decode_cursor(cursor)) if cursor else 0
+        for i in range(start, len(self.proxies)):
+            proxy = self.proxies[i]
+            if not excluded or proxy.ip not in excluded:
+                yield proxy
+
+    def sample(self):
+        """按照权重随机选择一个代理IP，有一定概率在所有代理IP中等概率选择"""
+        if random.random() < RANDOM_EXPLORATION_RATE:
+            return random.choice(self.proxies)
+        return self.proxies[self.sampler.sample()]
+
+
+class ProxyCache(object):
+
+    def __init__(self, mongo_pool, refresh_interval=PROXY_CACHE_REFRESH_INTERVAL, max_size=PROXY_CACHE_MAX_SIZE):
+        self.mongo_pool = mongo_pool
+        self.refresh_interval = refresh_interval
+        # 每个key最多缓存的代理IP数量
+        self.max_size = max_size
+        # (协议类型, 匿名类型) -> CacheEntry
+        self.entries = {}
+        # 正在加载的key -> Event，用于合并并发加载
+        self.loading = {}
+        self.lock = Lock()
+        # 变更流通知需要刷新
+        self.changed = Event()
+        # 代理IP的不可用域名
+        self.exclusions = DomainExclusions()
+
+    @staticmethod
+    def get_key(protocol=None, nick_type=0):
+        """生成缓存的key，协议类型的处理和MongoPool.get_conditions一致"""
+        if protocol is not None:
+            protocol = 'http' if protocol.lower() == 'http' else 'https'
+        return protocol, nick_type
+
+    def load(self, key):
+        """从数据库中加载一个key的代理IP列表"""
+        protocol, nick_type = key
+        proxies = self.mongo_pool.get_proxies(protocol, count=self.max_size, nick_type=nick_type)
+        return CacheEntry(proxies)
+
+    def get_entry(self, key):
+        """获取一个key的缓存，没有缓存就加载；同一个key同时只有一个加载"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry
+            event = self.loading.get(key)
+            loader = event is None
+            if loader:
+                event = self.loading[key] = Event()
+
+        if not loader:
+            # 其他线程正在加载，等待加载完成
+            event.wait()
+            entry = self.entries.get(key)
+            return entry if entry is not None else self.load(key)
+
+        try:
+            entry = self.load(key)
+            with self.lock:
+                self.entries[key] = entry
+            return entry
+        finally:
+            with self.lock:
+                self.loading.pop(key)
+            event.set()
+
+    def get_proxies(self, protocol=None, domain=None, count=0, nick_type=0):
+        """
+        根据协议类型和要访问网站的域名，获取代理IP列表，和MongoPool.get_proxies的结果一致
+        :param protocol: 协议 比如http，https
+        :param domain: 域名 比如jd.com
+        :param count: 限制最多取出多少个代理IP，默认所有
+        :param nick_type: 匿名类型，默认高匿
+        :return: 满足条件的代理IP
+        """
+        proxies = self.get_entry(self.get_key(protocol, nick_type)).proxies
+        if domain:
+            excluded = self.exclusions.get_ips(domain)
+            if excluded:
+                proxies = [proxy for proxy in proxies if proxy.ip not in excluded]
+        if count:
+            proxies = proxies[:count]
+        return proxies
+
+    def random_proxy(self, protocol=None, domain=None, nick_type=0):
+        """
+        根据协议类型和要访问的域名，在所有缓存的代理IP中按照权重随机获取一个代理IP
+        :param protocol: 协议 比如http，https
+        :param domain: 域名 比如jd.com
+        :param nick_type: 匿名类型，默认高匿
+        :return: 满足条件的随机的一个代理IP
+        """
+        entry = self.get_entry(self.get_key(protocol, nick_type))
+        if entry.proxies:
+            now = time.time()
+            for i in range(MAX_SAMPLE_TRIES):
+                proxy = entry.sample()
+                if not domain or not self.exclusions.is_excluded(domain, proxy.ip, now):
+                    return proxy
+        # 大部分代理IP都不能访问这个域名，在过滤后的列表中等概率选择
+        proxy_list = self.get_proxies(protocol=protocol, domain=domain, nick_type=nick_type)
+        return random.choice(proxy_list)
+
+    def disable_domain(self, ip, domain):
+        """把域名添加到内存中指定IP的不可用域名中，不用等到下次刷新"""
+        self.exclusions.add(ip, domain)
+
+    def load_exclusions(self):
+        """从数据库中重新加载不可用域名，其他进程添加的和已经过期删除的都会同步"""
+        try:
+            self.exclusions.replace(self.mongo_pool.find_exclusions())
+        except Exception as ex:
+            # 加载失败继续使用旧的记录
+            logger.exception(ex)
+
+    def refresh(self):
+        """刷新所有已经加载的key和不可用域名"""
+        self.load_exclusions()
+        with self.lock:
+            keys = list(self.entries.keys())
+        for key in keys:
+            try:
+                entry = self.load(key)
+            except Exception as ex:
+                # 刷新失败继续使用旧的缓存
+                logger.exception(ex)
+                continue
+            with self.lock:
+                self.entries[key] = entry
+
+    def __refresh_loop(self):
+        """每隔refresh_interval秒刷新一次，收到变更通知时立即刷新"""
+        while True:
+            if self.changed.wait(self.refresh_interval):
+                # 检测模块是批量写入的，稍等一下再刷新，合并多次变更
+                time.sleep(1)
+            self.changed.clear()
+            self.refresh()
+
+    def __watch_loop(self):
+        """监听MongoDB的变更流，数据变化后通知刷新线程"""
+        try:
+            with self.mongo_pool.proxies.watch() as stream:
+                for change in stream:
+                    self.changed.set()
+        except Exception as ex:
+            # 单机版的MongoDB不支持变更流，只使用定时刷新
+            logger.warning("无法监听代理IP的变更，只使用定时刷新：{}".format(ex))
+
+    def start(self):
+        """加载不可用域名，启动后台刷新线程"""
+        self.load_exclusions()
+        Thread(target=self.__refresh_loop, daemon=True).start()
+        if PROXY_CACHE_WATCH:
+            Thread(target=self.__watch_loop, daemon=True).start()
@@ -0,0 +1,86 @@
+'''
+实现代理IP列表的紧凑编码
+
+目标：批量获取代理IP的消费者大多只需要 ip，port，protocol 和 score，
+      json需要把每个字段名都重复一遍，编码又慢，提供更小更快的格式.
+思路：
+    1. msgpack：和json的结构一样(字典列表)，二进制编码，需要安装msgpack
+    2. packed：每个代理IP固定8个字节，网络字节序
+        IPv4地址：4个字节
+        端口号：uint16
+        flags：1个字节，高4位是 protocol + 1，低4位是 nick_type + 1 (protocol和nick_type都可能是-1)
+        score：uint8
+       不是IPv4地址的代理IP跳过
+步骤：
+    1. 实现encode_msgpack方法，把代理IP列表编码成msgpack
+    2. 实现iter_packed方法，把代理IP列表分块编码成packed格式，可以流式返回
+    3. 实现unpack_proxies方法，把packed格式解码成代理IP列表
+'''
+
+import socket
+import struct
+
+from domain import Proxy
+
+# packed格式每个代理IP的结构：IPv4地址，端口号，flags，score
+PACKED_RECORD = struct.Struct('!4sHBB')
+# 流式返回时，每块包含的代理IP数量
+PACKED_CHUNK_SIZE = 1000
+
+
+def get_flags(proxy):
+    """protocol和nick_type编码成一个字节"""
+    return ((proxy.protocol + 1) & 0x0F) << 4 | ((proxy.nick_type + 1) & 0x0F)
+
+
+def pack_proxy(proxy):
+    """把一个代理IP编码成packed格式，不是IPv4地址或者端口号不合法时返回None"""
+    try:
+        return PACKED_RECORD.pack(socket.inet_pton(socket.AF_INET, proxy.ip), int(proxy.port),
+                                  get_flags(proxy), min(max(int(proxy.score), 0), 255))
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def iter_packed(proxies, chunk_size=PACKED_CHUNK_SIZE):
+    """
+    把代理IP列表分块编码成packed格式
+    :param proxies: 代理IP的可迭代对象
+    :param chunk_size: 每块包含的代理IP数量
+    :return: bytes的生成器
+    """
+    chunk = []
+    for proxy in proxies:
+        record = pack_proxy(proxy)
+        if record is None:
+            continue
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+    if chunk:
+        yield b''.join(chunk)
+
+
+def unpack_proxies(data):
+    """把packed格式解码成代理IP列表"""
+    proxies = []
+    for ip, port, flags, score in PACKED_RECORD.iter_unpack(data):
+        proxies.append(Proxy(socket.inet_ntop(socket.AF_INET, ip), str(port), protocol=(flags >> 4) - 1,
+                             nick_type=(flags & 0x0F) - 1, score=score))
+    return proxies
+
+
+def has_msgpack():
+    """msgpack是否已经安装"""
+    try:
+        import msgpack
+    except ImportError:
+        return False
+    return True
+
+
+def encode_msgpack(items):
+    """把字典列表编码成msgpack，msgpack是可选的依赖，使用时才导入"""
+    import msgpack
+    return msgpack.packb(items, use_bin_type=True)
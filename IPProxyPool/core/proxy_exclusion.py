@@ -0,0 +1,102 @@
+'''
+实现代理IP的不可用域名索引
+
+目标：按照域名过滤代理IP时，判断一个代理IP能不能访问这个域名是O(1)的，几千个域名也不会变慢；
+      不可用域名有过期时间，过期后代理IP自动恢复可用.
+思路：
+    1. 数据库中每个 (域名, IP) 是domain_exclusions集合的一条记录，使用TTL索引自动删除
+    2. API进程的内存中保存 域名 -> {IP: 过期时间}，判断时直接查字典
+    3. 使用过期时间的最小堆，及时从字典中删除已经过期的记录，内存不会无限增长
+    4. 每次变化都增加版本号，用于生成 /proxies 的ETag
+步骤：
+    1. 定义DomainExclusions类
+        实现add方法，添加一个不可用域名
+        实现is_excluded方法，判断代理IP能不能访问这个域名
+        实现get_expire_at方法，获取代理IP不能访问这个域名的过期时间
+        实现get_ips方法，获取不能访问这个域名的IP集合
+        实现replace方法，使用数据库中的记录替换内存中的记录
+'''
+
+from threading import Lock
+import heapq
+import time
+
+from settings import DOMAIN_EXCLUSION_TTL
+
+
+class DomainExclusions(object):
+
+    def __init__(self):
+        # 域名 -> {IP: 过期时间}
+        self.domains = {}
+        # 过期时间的最小堆：[过期时间, 域名, IP]
+        self.expire_heap = []
+        # 每次变化都增加版本号
+        self.version = 0
+        self.lock = Lock()
+
+    def __purge(self, now):
+        """删除已经过期的记录，调用前需要加锁"""
+        while self.expire_heap and self.expire_heap[0][0] <= now:
+            expire_at, domain, ip = heapq.heappop(self.expire_heap)
+            ips = self.domains.get(domain)
+            # 过期时间被延长过的，堆中是旧的元素，直接丢弃
+            if ips is None or ips.get(ip) != expire_at:
+                continue
+            ips.pop(ip)
+            if not ips:
+                self.domains.pop(domain)
+            self.version += 1
+
+    @staticmethod
+    def __add(domains, expire_heap, domain, ip, expire_at):
+        domains.setdefault(domain, {})[ip] = expire_at
+        heapq.heappush(expire_heap, [expire_at, domain, ip])
+
+    def add(self, ip, domain, ttl=DOMAIN_EXCLUSION_TTL):
+        """
+        添加一个不可用域名，已经存在时延长过期时间
+        :param ip: ip地址
+        :param domain: 域名
+        :param ttl: 不可用的时间，单位s
+        """
+        with self.lock:
+            self.__add(self.domains, self.expire_heap, domain, ip, time.time() + ttl)
+            self.version += 1
+
+    def is_excluded(self, domain, ip, now=None):
+        """判断指定IP是不是不能访问这个域名"""
+        return self.get_expire_at(domain, ip, now) > 0
+
+    def get_expire_at(self, domain, ip, now=None):
+        """获取指定IP不能访问这个域名的过期时间，可以访问时返回0"""
+        ips = self.domains.get(domain)
+        if not ips:
+            return 0
+        expire_at = ips.get(ip)
+        return expire_at if expire_at is not None and expire_at > (now or time.time()) else 0
+
+    def get_ips(self, domain):
+        """获取不能访问这个域名的IP集合，返回的是副本，遍历时不受后续修改的影响"""
+        with self.lock:
+            self.__purge(time.time())
+            return set(self.domains.get(domain, ()))
+
+    def get_version(self):
+        """获取当前的版本号，先删除已经过期的记录，过期也会改变版本号"""
+        with self.lock:
+            self.__purge(time.time())
+            return self.version
+
+    def replace(self, exclusions):
+        """
+        使用数据库中的记录替换内存中的记录
+        :param exclusions: (域名, IP, 过期时间戳) 的可迭代对象
+        """
+        # 先在新的字典中加载，加载失败时继续使用旧的记录
+        domains, expire_heap = {}, []
+        for domain, ip, expire_at in exclusions:
+            self.__add(domains, expire_heap, domain, ip, expire_at)
+        with self.lock:
+            self.domains, self.expire_heap = domains, expire_heap
+            self.version += 1
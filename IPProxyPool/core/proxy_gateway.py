@@ -0,0 +1,445 @@
+'''
+实现代理池的代理网关
+
+目标：爬虫不再先调用 /random 获取代理IP，再连接代理IP；只需要把http_proxy设置为网关的地址，
+      网关从代理池中选择代理IP转发请求，失败后自动换一个代理IP重试.
+思路：
+    1. 使用asyncio实现标准的HTTP代理：
+        普通的HTTP请求(请求行是完整的URL)，转发给上游代理IP，响应再转发给爬虫
+        CONNECT请求(HTTPS)，通过上游代理IP建立隧道，之后双向转发数据
+    2. 使用ProxyCache在内存中按照权重选择代理IP，和 /random 一样会过滤掉不能访问这个域名的代理IP
+    3. 和上游代理IP的连接使用keep-alive连接池，不用每个请求都重新建立连接
+    4. 连接失败、超时、上游代理IP返回502/503/504/407时，换一个代理IP重试，最多尝试 GATEWAY_MAX_TRIES 个代理IP；
+       已经开始给爬虫返回响应后不再重试
+    5. 开启 GATEWAY_AFFINITY_TTL 后，同一个域名在一段时间内继续使用上次成功的代理IP；
+       过期的域名定期清理，访问过很多不同域名时不会一直占用内存
+    6. 每个请求的结果(是否成功，延迟)通过ReportAggregator汇总后更新代理IP的分数和速度
+步骤：
+    1. 定义UpstreamPool类，管理和上游代理IP的空闲连接
+    2. 定义ProxyGateway类
+        实现handle_client方法，处理爬虫的一个连接，支持keep-alive
+        实现handle_request方法，转发普通的HTTP请求
+        实现handle_connect方法，转发CONNECT请求
+        实现start的类方法，用于通过类名，启动网关
+'''
+
+from urllib.parse import urlsplit
+import asyncio
+import time
+
+from core.db.mongo_pool import MongoPool
+from core.proxy_cache import ProxyCache
+from core.proxy_lease import get_proxy_key
+from core.proxy_report import ReportAggregator
+from settings import GATEWAY_HOST, GATEWAY_PORT, GATEWAY_MAX_TRIES, GATEWAY_CONNECT_TIMEOUT, GATEWAY_READ_TIMEOUT, \
+    GATEWAY_AFFINITY_TTL, GATEWAY_POOL_SIZE, GATEWAY_IDLE_TIMEOUT
+from utils.log import logger
+
+# 转发时需要删除的逐跳请求头
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-connection', 'proxy-authorization', 'te', 'upgrade'}
+# 上游代理IP返回这些状态码，说明代理IP本身有问题，换一个代理IP重试
+RETRY_STATUS = {407, 502, 503, 504}
+# 请求头的最大长度
+MAX_HEAD_SIZE = 64 * 1024
+# 转发数据时每次读取的大小
+BUFFER_SIZE = 64 * 1024
+
+
+class UpstreamError(Exception):
+    """上游代理IP不可用，需要换一个代理IP重试"""
+
+
+async def read_head(reader):
+    """
+    读取请求或者响应的头部
+    :return: (第一行, [(头名称, 头的值)])，连接已经关闭时返回 (None, None)
+    """
+    try:
+        data = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as ex:
+        if not ex.partial:
+            return None, None
+        raise
+    lines = data.decode('latin-1').split('\r\n')
+    headers = []
+    for line in lines[1:]:
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers.append((name.strip(), value.strip()))
+    return lines[0], headers
+
+
+def get_header(headers, name):
+    """获取一个头的值，名称不区分大小写"""
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def build_head(first_line, headers):
+    lines = [first_line] + ['{}: {}'.format(name, value) for name, value in headers]
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+def is_keep_alive(version, headers):
+    """判断连接是不是keep-alive，HTTP/1.1默认keep-alive，HTTP/1.0默认不是"""
+    connection = (get_header(headers, 'Proxy-Connection') or get_header(headers, 'Connection') or '').lower()
+    if version == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+
+async def read_request_body(reader, headers):
+    """读取请求体，重试时需要再发送一次，所以读取到内存中"""
+    if (get_header(headers, 'Transfer-Encoding') or '').lower() == 'chunked':
+        chunks = []
+        await relay_chunked(reader, chunks.append)
+        return b''.join(chunks)
+    length = int(get_header(headers, 'Content-Length') or 0)
+    return await reader.readexactly(length) if length else b''
+
+
+async def relay_chunked(reader, write):
+    """按照原样转发chunked编码的数据，直到最后一个chunk和trailer"""
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        write(line)
+        size = int(line.split(b';')[0].strip(), 16)
+        if size == 0:
+            break
+        await relay_length(reader, write, size + 2)
+    # trailer，以空行结束
+    while True:
+        line = await reader.readuntil(b'\r\n')
+        write(line)
+        if line == b'\r\n':
+            break
+
+
+async def relay_length(reader, write, length):
+    """转发指定长度的数据"""
+    while length > 0:
+        data = await reader.read(min(length, BUFFER_SIZE))
+        if not data:
+            raise asyncio.IncompleteReadError(b'', length)
+        write(data)
+        length -= len(data)
+
+
+async def pipe(reader, writer):
+    """单向转发数据，直到连接关闭"""
+    try:
+        while True:
+            data = await reader.read(BUFFER_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+class UpstreamPool(object):
+    """和上游代理IP的空闲keep-alive连接"""
+
+    def __init__(self, pool_size=GATEWAY_POOL_SIZE, idle_timeout=GATEWAY_IDLE_TIMEOUT):
+        # 每个代理IP最多保持的空闲连接数量
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        # ip:port -> [(reader, writer, 放回的时间)]
+        self.idle = {}
+
+    async def get(self, proxy):
+        """
+        获取一个到代理IP的连接，优先使用空闲连接
+        :return: (reader, writer, 是否是空闲连接)
+        """
+        connections = self.idle.get(get_proxy_key(proxy))
+        now = time.time()
+        while connections:
+            reader, writer, released_at = connections.pop()
+            if now - released_at < self.idle_timeout and not writer.is_closing() and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(proxy.ip, int(proxy.port)),
+                                                GATEWAY_CONNECT_TIMEOUT)
+        return reader, writer, False
+
+    def put(self, proxy, reader, writer):
+        """把连接放回连接池"""
+        connections = self.idle.setdefault(get_proxy_key(proxy), [])
+        if len(connections) >= self.pool_size or writer.is_closing():
+            writer.close()
+            return
+        connections.append((reader, writer, time.time()))
+
+    def close_idle(self):
+        """关闭超时的空闲连接"""
+        now = time.time()
+        for key in list(self.idle):
+            connections = self.idle[key]
+            alive = []
+            for reader, writer, released_at in connections:
+                if now - released_at < self.idle_timeout and not writer.is_closing():
+                    alive.append((reader, writer, released_at))
+                else:
+                    writer.close()
+            if alive:
+                self.idle[key] = alive
+            else:
+                self.idle.pop(key)
+
+
+class ProxyGateway(object):
+
+    def __init__(self, host=GATEWAY_HOST, port=GATEWAY_PORT, max_tries=GATEWAY_MAX_TRIES,
+                 affinity_ttl=GATEWAY_AFFINITY_TTL):
+        self.host = host
+        self.port = port
+        self.max_tries = max_tries
+        self.affinity_ttl = affinity_ttl
+        self.mongo_pool = MongoPool()
+        # 在内存中选择代理IP
+        self.proxy_cache = ProxyCache(self.mongo_pool)
+        # 汇总每个请求的结果
+        self.report_aggregator = ReportAggregator(self.mongo_pool, self.proxy_cache.exclusions)
+        self.upstream_pool = UpstreamPool()
+        # 域名 -> (代理IP, 过期时间)
+        self.affinity = {}
+
+    async def choose_proxy(self, protocol, domain, tried):
+        """
+        选择一个代理IP，跳过这个请求已经尝试过的代理IP
+        :param protocol: 协议 http或者https
+        :param domain: 要访问的域名
+        :param tried: 已经尝试过的代理IP的ip:port集合
+        :return: 代理IP，没有可用的代理IP时返回None
+        """
+        key = self.proxy_cache.get_key(protocol)
+        if key not in self.proxy_cache.entries:
+            # 第一次使用时从数据库中加载，不阻塞事件循环
+            await asyncio.get_event_loop().run_in_executor(None, self.proxy_cache.get_entry, key)
+
+        if self.affinity_ttl and domain in self.affinity:
+            proxy, expires_at = self.affinity[domain]
+            if expires_at > time.time() and get_proxy_key(proxy) not in tried:
+                return proxy
+            self.affinity.pop(domain, None)
+
+        for i in range(self.max_tries * 2):
+            try:
+                proxy = self.proxy_cache.random_proxy(protocol, domain)
+            except IndexError:
+                # 没有可用的代理IP
+                return None
+            if get_proxy_key(proxy) not in tried:
+                return proxy
+        return None
+
+    def report(self, proxy, domain, ok, latency=None):
+        """报告一个请求的结果，更新域名对应的代理IP"""
+        self.report_aggregator.add(proxy.ip, proxy.port, domain, ok, latency)
+        if not self.affinity_ttl or not domain:
+            return
+        if ok:
+            self.affinity[domain] = (proxy, time.time() + self.affinity_ttl)
+        elif self.affinity.get(domain, (None,))[0] is proxy:
+            self.affinity.pop(domain)
+
+    async def handle_client(self, reader, writer):
+        """处理爬虫的一个连接，keep-alive的连接上可以有多个请求"""
+        try:
+            while True:
+                request_line, headers = await asyncio.wait_for(read_head(reader), GATEWAY_IDLE_TIMEOUT)
+                if request_line is None:
+                    break
+                method, target, version = request_line.split(' ', 2)
+                if method == 'CONNECT':
+                    await self.handle_connect(reader, writer, target, version)
+                    return
+                if not await self.handle_request(reader, writer, method, target, version, headers):
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        except Exception as ex:
+            logger.exception(ex)
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer, method, target, version, headers):
+        """
+        转发普通的HTTP请求
+        :return: 爬虫的连接是否可以继续使用
+        """
+        url = urlsplit(target)
+        if not url.scheme or not url.hostname:
+            writer.write(b'HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\n\r\n')
+            return False
+        if (get_header(headers, 'Expect') or '').lower() == '100-continue':
+            # 网关先读取请求体，直接告诉爬虫继续发送
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        body = await read_request_body(reader, headers)
+        client_keep_alive = is_keep_alive(version, headers)
+
+        forward_headers = [(name, value) for name, value in headers
+                           if name.lower() not in HOP_BY_HOP_HEADERS and name.lower() != 'expect']
+        forward_headers.append(('Connection', 'keep-alive'))
+        request = build_head('{} {} HTTP/1.1'.format(method, target), forward_headers) + body
+
+        domain = url.hostname
+        tried = set()
+        for i in range(self.max_tries):
+            proxy = await self.choose_proxy(url.scheme, domain, tried)
+            if proxy is None:
+                break
+            tried.add(get_proxy_key(proxy))
+            start_time = time.time()
+            try:
+                upstream = await self.send_request(proxy, request)
+            except Exception:
+                self.report(proxy, domain, False)
+                continue
+            self.report(proxy, domain, True, round(time.time() - start_time, 2))
+            return await self.relay_response(proxy, upstream, writer, method, client_keep_alive)
+
+        writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+        return client_keep_alive
+
+    async def send_request(self, proxy, request):
+        """
+        把请求发送给代理IP，读取响应的头部
+        :return: (reader, writer, 状态码, 响应的第一行, 响应头)
+        """
+        reader, writer, reused = await self.upstream_pool.get(proxy)
+        try:
+            writer.write(request)
+            await writer.drain()
+            status_line, headers = await asyncio.wait_for(read_head(reader), GATEWAY_READ_TIMEOUT)
+            if status_line is None:
+                raise UpstreamError('代理IP关闭了连接')
+            parts = status_line.split(' ', 2)
+            if len(parts) < 2 or not parts[1].isdigit():
+                raise UpstreamError('响应的第一行不合法：{}'.format(status_line))
+            status = int(parts[1])
+        except Exception:
+            writer.close()
+            if not reused:
+                raise
+            # 空闲连接可能已经被代理IP关闭了，重新建立连接再试一次
+            return await self.send_request(proxy, request)
+
+        if status in RETRY_STATUS:
+            writer.close()
+            raise UpstreamError(status_line)
+        return reader, writer, status, status_line, headers
+
+    async def relay_response(self, proxy, upstream, writer, method, client_keep_alive):
+        """
+        把响应转发给爬虫，转发完成后把上游的连接放回连接池
+        :return: 爬虫的连接是否可以继续使用
+        """
+        reader, upstream_writer, status, status_line, headers = upstream
+        chunked = (get_header(headers, 'Transfer-Encoding') or '').lower() == 'chunked'
+        length = get_header(headers, 'Content-Length')
+        no_body = method == 'HEAD' or status < 200 or status in (204, 304)
+        # 没有长度的响应只能读到连接关闭，爬虫的连接也不能继续使用
+        until_eof = not no_body and not chunked and length is None
+        upstream_keep_alive = not until_eof and is_keep_alive(status_line.split(' ', 1)[0], headers)
+        keep_alive = client_keep_alive and not until_eof
+
+        response_headers = [(name, value) for name, value in headers if name.lower() not in HOP_BY_HOP_HEADERS]
+        response_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+        writer.write(build_head(status_line, response_headers))
+        try:
+            if no_body:
+                pass
+            elif chunked:
+                await relay_chunked(reader, writer.write)
+            elif length is not None:
+                await relay_length(reader, writer.write, int(length))
+            else:
+                while True:
+                    data = await reader.read(BUFFER_SIZE)
+                    if not data:
+                        break
+                    writer.write(data)
+                    await writer.drain()
+            await writer.drain()
+        except Exception:
+            upstream_writer.close()
+            raise
+
+        if upstream_keep_alive:
+            self.upstream_pool.put(proxy, reader, upstream_writer)
+        else:
+            upstream_writer.close()
+        return keep_alive
+
+    async def handle_connect(self, reader, writer, target, version):
+        """通过代理IP建立隧道，之后双向转发数据"""
+        domain = target.rsplit(':', 1)[0]
+        tried = set()
+        for i in range(self.max_tries):
+            proxy = await self.choose_proxy('https', domain, tried)
+            if proxy is None:
+                break
+            tried.add(get_proxy_key(proxy))
+            start_time = time.time()
+            upstream_writer = None
+            try:
+                upstream_reader, upstream_writer = await asyncio.wait_for(
+                    asyncio.open_connection(proxy.ip, int(proxy.port)), GATEWAY_CONNECT_TIMEOUT)
+                upstream_writer.write(build_head('CONNECT {} HTTP/1.1'.format(target), [('Host', target)]))
+                await upstream_writer.drain()
+                status_line, headers = await asyncio.wait_for(read_head(upstream_reader), GATEWAY_READ_TIMEOUT)
+                if status_line is None or status_line.split(' ', 2)[1] != '200':
+                    raise UpstreamError(status_line)
+            except Exception:
+                if upstream_writer is not None:
+                    upstream_writer.close()
+                self.report(proxy, domain, False)
+                continue
+
+            self.report(proxy, domain, True, round(time.time() - start_time, 2))
+            writer.write('{} 200 Connection Established\r\n\r\n'.format(version).encode())
+            await asyncio.gather(pipe(reader, upstream_writer), pipe(upstream_reader, writer))
+            return
+
+        writer.write('{} 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n'.format(version).encode())
+        await writer.drain()
+
+    def purge_affinity(self, now):
+        """清理过期的域名，只有再次访问同一个域名时才会删除过期的域名，不清理会一直增长"""
+        expired = [domain for domain, (proxy, expires_at) in self.affinity.items() if expires_at <= now]
+        for domain in expired:
+            del self.affinity[domain]
+
+    async def __cleanup_loop(self):
+        """定期关闭空闲的连接，清理过期的域名"""
+        while True:
+            await asyncio.sleep(GATEWAY_IDLE_TIMEOUT)
+            self.upstream_pool.close_idle()
+            self.purge_affinity(time.time())
+
+    async def serve(self):
+        """启动网关，一直运行"""
+        server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=MAX_HEAD_SIZE)
+        asyncio.ensure_future(self.__cleanup_loop())
+        logger.info("代理网关已启动：{}:{}".format(self.host, self.port))
+        async with server:
+            await server.serve_forever()
+
+    @classmethod
+    def start(cls):
+        gateway = cls()
+        gateway.proxy_cache.start()
+        gateway.report_aggregator.start()
+        asyncio.run(gateway.serve())
+
+
+if __name__ == '__main__':
+    ProxyGateway.start()
@@ -0,0 +1,281 @@
+'''
+实现代理IP的租用管理
+
+目标：爬虫租用代理IP，用完后归还并报告结果，防止很多爬虫同时使用同一个代理IP，把它用坏或者被封.
+思路：
+    所有状态都保存在API进程的内存中，不需要每次租用都访问数据库；
+    asgi方式运行多个工作进程时，每个进程的状态不同，限制不准确，归还时可能找不到租约，所以只能在单进程中使用
+    1. 每个代理IP同时被租用的数量不能超过 LEASE_MAX_CONCURRENCY
+    2. 代理IP归还后，在 LEASE_DOMAIN_COOLDOWN 秒内不能再用于访问同一个域名；如果报告访问失败，冷却时间为 LEASE_FAIL_COOLDOWN 秒
+    3. 租约超过有效时间没有归还，自动收回；有效时间必须是 (0, LEASE_MAX_TTL] 之间的有限值，超过上限时按照上限计算
+    4. 每个 (协议类型, 匿名类型) 使用一个最小堆，堆中的元素是 [租用数量, 代理IP在缓存中的排名]，
+       租用时取出租用数量最少、排名最靠前的代理IP，时间复杂度O(log n)；
+       租用数量变化后把新的元素放到堆中，旧的元素在取出时发现租用数量不一致就丢弃(延迟删除)
+    5. 代理IP缓存刷新后，重新创建对应的堆
+    6. 指定域名租用时，每个 (协议类型, 匿名类型, 域名) 单独使用一个DomainPool：可用的代理IP堆，
+       和暂停的代理IP堆 [可以再次使用的时间, 排名]；取出的代理IP在冷却中或者被排除时，移到暂停的堆中，
+       到时间后再放回可用的堆，每个代理IP每次冷却只被取出一次，租用的均摊时间复杂度O(log n)，
+       不会在每次租用时重复扫描冷却中的代理IP；
+       租用数量变化时需要更新所有包含该代理IP的堆，超过 LEASE_DOMAIN_POOL_TTL 秒没有使用的DomainPool定期删除
+步骤：
+    1. 定义Lease类，保存一个租约的信息
+    2. 定义DomainPool类，保存一个域名的可用和暂停的代理IP
+    3. 定义LeaseManager类
+        实现acquire方法，租用一个代理IP
+        实现release方法，归还一个代理IP
+        实现expire方法，收回过期的租约，清理过期的冷却时间
+'''
+
+from threading import Lock
+import heapq
+import math
+import time
+import uuid
+
+from settings import LEASE_MAX_CONCURRENCY, LEASE_DOMAIN_COOLDOWN, LEASE_FAIL_COOLDOWN, LEASE_TTL, LEASE_MAX_TTL, \
+    LEASE_DOMAIN_POOL_TTL
+
+
+def get_proxy_key(proxy):
+    return '{}:{}'.format(proxy.ip, proxy.port)
+
+
+class Lease(object):
+    """一个租约"""
+
+    def __init__(self, proxy, domain, expires_at):
+        self.id = uuid.uuid4().hex
+        self.proxy = proxy
+        self.domain = domain
+        self.expires_at = expires_at
+
+
+class DomainPool(object):
+    """一个(协议类型, 匿名类型, 域名)的代理IP"""
+
+    def __init__(self, entry, heap):
+        # 创建堆时使用的缓存
+        self.entry = entry
+        # 可用的代理IP的最小堆：[租用数量, 排名]
+        self.heap = heap
+        # 暂停的代理IP的最小堆：[可以再次使用的时间, 排名]
+        self.parked = []
+        # 暂停的代理IP的排名
+        self.parked_ranks = set()
+        # 最后一次使用的时间
+        self.used_at = 0
+
+
+class LeaseManager(object):
+
+    def __init__(self, proxy_cache, max_concurrency=LEASE_MAX_CONCURRENCY, cooldown=LEASE_DOMAIN_COOLDOWN,
+                 fail_cooldown=LEASE_FAIL_COOLDOWN):
+        self.proxy_cache = proxy_cache
+        # 每个代理IP同时被租用的最大数量
+        self.max_concurrency = max_concurrency
+        # 归还后不能访问同一个域名的时间
+        self.cooldown = cooldown
+        # 访问失败后不能访问同一个域名的时间
+        self.fail_cooldown = fail_cooldown
+        # 代理IP -> 租用数量
+        self.inflight = {}
+        # (协议类型, 匿名类型) -> (创建堆时使用的缓存, 堆)
+        self.pools = {}
+        # ((协议类型, 匿名类型), 域名) -> DomainPool
+        self.domain_pools = {}
+        # 上一次删除没有使用的DomainPool的时间
+        self.purged_at = time.time()
+        # 租约ID -> 租约
+        self.leases = {}
+        # 租约过期时间的最小堆：[过期时间, 租约ID]
+        self.expire_heap = []
+        # (代理IP, 域名) -> 冷却结束时间
+        self.cooldowns = {}
+        # 冷却结束时间的最小堆：[冷却结束时间, (代理IP, 域名)]
+        self.cooldown_heap = []
+        self.lock = Lock()
+
+    def __build_heap(self, entry, excluded_ranks=()):
+        """根据缓存中的代理IP和当前的租用数量创建堆，不包含excluded_ranks中的代理IP"""
+        heap = [[self.inflight.get(get_proxy_key(proxy), 0), rank] for rank, proxy in enumerate(entry.proxies)
+                if rank not in excluded_ranks]
+        heapq.heapify(heap)
+        return heap
+
+    def __get_pool(self, pool_key, entry):
+        """获取一个(协议类型, 匿名类型)的堆，缓存刷新后重新创建堆，调用前需要加锁"""
+        pool = self.pools.get(pool_key)
+        if pool is None or pool[0] is not entry:
+            pool = self.pools[pool_key] = (entry, self.__build_heap(entry))
+        return pool
+
+    def __get_domain_pool(self, pool_key, domain, entry):
+        """获取一个(协议类型, 匿名类型, 域名)的DomainPool，缓存刷新后重新创建，调用前需要加锁"""
+        pool = self.domain_pools.get((pool_key, domain))
+        if pool is None or pool.entry is not entry:
+            pool = self.domain_pools[(pool_key, domain)] = DomainPool(entry, self.__build_heap(entry))
+        return pool
+
+    def __push(self, key):
+        """代理IP的租用数量变化后，把新的元素放到包含它的堆中"""
+        count = self.inflight.get(key, 0)
+        for pool_key, (entry, heap) in self.pools.items():
+            rank = entry.ranks.get(key)
+            if rank is None:
+                continue
+            if len(heap) > 4 * len(entry.proxies) + 64:
+                # 旧的元素太多，重新创建堆
+                self.pools[pool_key] = (entry, self.__build_heap(entry))
+            else:
+                heapq.heappush(heap, [count, rank])
+
+        for pool in self.domain_pools.values():
+            rank = pool.entry.ranks.get(key)
+            if rank is None or rank in pool.parked_ranks:
+                # 暂停的代理IP放回可用的堆时再使用新的租用数量
+                continue
+            if len(pool.heap) > 4 * len(pool.entry.proxies) + 64:
+                pool.heap = self.__build_heap(pool.entry, pool.parked_ranks)
+            else:
+                heapq.heappush(pool.heap, [count, rank])
+
+    def __get_blocked_until(self, key, domain, ip, now):
+        """获取代理IP不能访问这个域名的结束时间(冷却或者被排除)，可以访问时返回0"""
+        until = self.cooldowns.get((key, domain), 0)
+        if until <= now:
+            until = 0
+        return max(until, self.proxy_cache.exclusions.get_expire_at(domain, ip, now))
+
+    def acquire(self, protocol=None, domain=None, nick_type=0, ttl=LEASE_TTL):
+        """
+        租用一个代理IP
+        :param protocol: 协议 比如http，https
+        :param domain: 要访问的域名 比如jd.com
+        :param nick_type: 匿名类型，默认高匿
+        :param ttl: 租约的有效时间，单位s，超过 LEASE_MAX_TTL 时按照 LEASE_MAX_TTL 计算
+        :return: 租约，没有可用的代理IP时返回None
+        """
+        if not math.isfinite(ttl) or ttl <= 0:
+            raise ValueError('租约的有效时间必须是大于0的数字：{}'.format(ttl))
+        ttl = min(ttl, LEASE_MAX_TTL)
+        pool_key = self.proxy_cache.get_key(protocol, nick_type)
+        # 获取缓存可能需要查询数据库，在加锁之前获取
+        entry = self.proxy_cache.get_entry(pool_key)
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            if domain:
+                proxy = self.__pop_domain_pool(pool_key, domain, entry, now)
+            else:
+                proxy = self.__pop_pool(pool_key, entry)
+            if proxy is None:
+                return None
+
+            key = get_proxy_key(proxy)
+            self.inflight[key] = self.inflight.get(key, 0) + 1
+            self.__push(key)
+            lease = Lease(proxy, domain, now + ttl)
+            self.leases[lease.id] = lease
+            heapq.heappush(self.expire_heap, [lease.expires_at, lease.id])
+            return lease
+
+    def __pop_pool(self, pool_key, entry):
+        """从(协议类型, 匿名类型)的堆中取出租用数量最少的代理IP，没有可用的代理IP时返回None"""
+        entry, heap = self.__get_pool(pool_key, entry)
+        while heap:
+            count, rank = heap[0]
+            proxy = entry.proxies[rank]
+            if count != self.inflight.get(get_proxy_key(proxy), 0):
+                # 租用数量已经变化，丢弃旧的元素
+                heapq.heappop(heap)
+                continue
+            if count >= self.max_concurrency:
+                # 租用数量最少的代理IP也达到了上限
+                return None
+            # 元素留在堆中，租用数量变化后在取出时丢弃
+            return proxy
+        return None
+
+    def __pop_domain_pool(self, pool_key, domain, entry, now):
+        """
+        从(协议类型, 匿名类型, 域名)的堆中取出租用数量最少、可以访问这个域名的代理IP，没有时返回None
+        冷却中或者被排除的代理IP移到暂停的堆中，到时间后再放回，均摊时间复杂度O(log n)
+        """
+        pool = self.__get_domain_pool(pool_key, domain, entry)
+        pool.used_at = now
+        # 暂停时间已经结束的代理IP放回可用的堆
+        while pool.parked and pool.parked[0][0] <= now:
+            until, rank = heapq.heappop(pool.parked)
+            pool.parked_ranks.discard(rank)
+            heapq.heappush(pool.heap, [self.inflight.get(get_proxy_key(pool.entry.proxies[rank]), 0), rank])
+
+        heap = pool.heap
+        while heap:
+            count, rank = heap[0]
+            if rank in pool.parked_ranks:
+                heapq.heappop(heap)
+                continue
+            proxy = pool.entry.proxies[rank]
+            key = get_proxy_key(proxy)
+            if count != self.inflight.get(key, 0):
+                heapq.heappop(heap)
+                continue
+            if count >= self.max_concurrency:
+                return None
+            until = self.__get_blocked_until(key, domain, proxy.ip, now)
+            if until > now:
+                # 冷却中或者被排除，暂停到可以访问的时间
+                heapq.heappop(heap)
+                heapq.heappush(pool.parked, [until, rank])
+                pool.parked_ranks.add(rank)
+                continue
+            return proxy
+        return None
+
+    def release(self, lease_id, ok=True):
+        """
+        归还一个代理IP，开始该代理IP对这个域名的冷却时间
+        :param lease_id: 租约ID
+        :param ok: 使用这个代理IP访问是否成功
+        :return: 归还的租约，租约不存在或者已经过期时返回None
+        """
+        with self.lock:
+            self.expire(time.time())
+            return self.__release(lease_id, ok)
+
+    def __release(self, lease_id, ok=True):
+        lease = self.leases.pop(lease_id, None)
+        if lease is None:
+            return None
+        key = get_proxy_key(lease.proxy)
+        count = self.inflight.get(key, 0) - 1
+        if count > 0:
+            self.inflight[key] = count
+        else:
+            self.inflight.pop(key, None)
+        self.__push(key)
+
+        cooldown = self.cooldown if ok else self.fail_cooldown
+        if lease.domain and cooldown > 0:
+            until = time.time() + cooldown
+            self.cooldowns[(key, lease.domain)] = until
+            heapq.heappush(self.cooldown_heap, [until, (key, lease.domain)])
+        return lease
+
+    def expire(self, now):
+        """收回过期的租约，清理过期的冷却时间，调用前需要加锁"""
+        while self.expire_heap and self.expire_heap[0][0] <= now:
+            expires_at, lease_id = heapq.heappop(self.expire_heap)
+            self.__release(lease_id)
+
+        while self.cooldown_heap and self.cooldown_heap[0][0] <= now:
+            until, cooldown_key = heapq.heappop(self.cooldown_heap)
+            if self.cooldowns.get(cooldown_key) == until:
+                self.cooldowns.pop(cooldown_key)
+
+        if now - self.purged_at >= LEASE_DOMAIN_POOL_TTL:
+            # 删除没有使用的DomainPool，减少租用数量变化时需要更新的堆
+            self.purged_at = now
+            for pool_key in [pool_key for pool_key, pool in self.domain_pools.items()
+                             if now - pool.used_at >= LEASE_DOMAIN_POOL_TTL]:
+                del self.domain_pools[pool_key]
@@ -0,0 +1,154 @@
+'''
+实现爬虫使用代理IP的结果汇总
+
+目标：爬虫通过代理IP发送了大量请求，知道哪些代理IP失败了，哪些代理IP很慢；
+      把这些结果汇总后更新到代理IP的score和speed，不需要额外的检测请求，路由就能反映代理IP的实时情况.
+思路：
+    1. 爬虫批量报告使用结果：(ip, port, domain, ok, latency)
+    2. 在内存中按照代理IP汇总：成功次数，失败次数，延迟之和
+       每个 (代理IP, 域名) 的失败次数单独保存，写入数据库后不清空，按照 REPORT_DOMAIN_FAILS_HALF_LIFE 秒的半衰期衰减，
+       缓慢但是持续的失败也能累计到阈值；衰减到 MIN_DOMAIN_FAILS 以下的删除，防止一直增长
+    3. 后台线程每隔 REPORT_FLUSH_INTERVAL 秒，把汇总结果使用批量写入更新到数据库
+        score：加上 成功次数*REPORT_SUCCESS_SCORE - 失败次数*REPORT_FAIL_SCORE，限制在 [1, MAX_SCORE]，
+               减到0的删除仍然由检测模块负责
+        speed：和平均延迟按照 REPORT_SPEED_WEIGHT 加权平均
+        不可用域名：一个域名衰减后的失败次数达到 REPORT_DISABLE_DOMAIN_FAILS，添加到domain_exclusions集合，
+                    过期后自动恢复；同时添加到API进程内存中的不可用域名，清空这个域名的失败次数
+步骤：
+    1. 定义ProxyReport类，保存一个代理IP的汇总结果
+    2. 定义ReportAggregator类
+        实现add方法，添加一个使用结果
+        实现flush方法，把汇总结果写入数据库
+        实现start方法，启动后台写入线程
+'''
+
+from threading import Lock, Thread
+from pymongo import UpdateOne
+import time
+
+from core.db.mongo_pool import BulkWriter
+from settings import MAX_SCORE, REPORT_FLUSH_INTERVAL, REPORT_SUCCESS_SCORE, REPORT_FAIL_SCORE, \
+    REPORT_SPEED_WEIGHT, REPORT_DISABLE_DOMAIN_FAILS, REPORT_DOMAIN_FAILS_HALF_LIFE
+from utils.log import logger
+
+# 衰减后的失败次数低于这个值时删除
+MIN_DOMAIN_FAILS = 0.5
+
+
+def get_decayed_fails(fails, updated_at, now):
+    """按照半衰期衰减后的失败次数"""
+    return fails * 0.5 ** (max(now - updated_at, 0) / REPORT_DOMAIN_FAILS_HALF_LIFE)
+
+
+class ProxyReport(object):
+    """一个代理IP的汇总结果"""
+
+    def __init__(self):
+        self.ok_count = 0
+        self.fail_count = 0
+        # 成功请求的延迟之和和数量
+        self.latency_sum = 0
+        self.latency_count = 0
+
+    def get_operation(self, ip, port):
+        """生成更新数据库的操作，使用聚合管道更新，可以限制分数的范围"""
+        delta = self.ok_count * REPORT_SUCCESS_SCORE - self.fail_count * REPORT_FAIL_SCORE
+        fields = {
+            'score': {'$max': [1, {'$min': [MAX_SCORE, {'$add': ['$score', delta]}]}]},
+        }
+        if self.latency_count:
+            latency = self.latency_sum / self.latency_count
+            # 检测失败的代理IP速度是-1，直接使用平均延迟
+            fields['speed'] = {'$round': [{'$cond': [
+                {'$gt': ['$speed', 0]},
+                {'$add': [{'$multiply': ['$speed', 1 - REPORT_SPEED_WEIGHT]}, latency * REPORT_SPEED_WEIGHT]},
+                latency,
+            ]}, 2]}
+        return UpdateOne({'_id': ip, 'port': port}, [{'$set': fields}])
+
+
+class ReportAggregator(object):
+
+    def __init__(self, mongo_pool, exclusions=None, flush_interval=REPORT_FLUSH_INTERVAL):
+        self.mongo_pool = mongo_pool
+        self.bulk_writer = BulkWriter(mongo_pool.proxies)
+        # 不可用域名写入另一个集合
+        self.exclusion_writer = BulkWriter(mongo_pool.exclusions)
+        # 内存中的不可用域名，比如ProxyCache.exclusions，可以为None
+        self.exclusions = exclusions
+        self.flush_interval = flush_interval
+        # (ip, port) -> ProxyReport，每次写入数据库后清空
+        self.reports = {}
+        # (ip, port, 域名) -> [失败次数, 更新时间]，写入数据库后不清空，按照半衰期衰减
+        self.domain_fails = {}
+        self.lock = Lock()
+
+    def add(self, ip, port, domain=None, ok=True, latency=None):
+        """
+        添加一个使用结果
+        :param ip: 代理IP
+        :param port: 代理IP的端口号
+        :param domain: 访问的域名
+        :param ok: 访问是否成功
+        :param latency: 访问的延迟，单位s
+        """
+        # 爬虫存入数据库的端口号是字符串
+        key = (ip, str(port))
+        with self.lock:
+            report = self.reports.get(key)
+            if report is None:
+                report = self.reports[key] = ProxyReport()
+            if ok:
+                report.ok_count += 1
+                if latency is not None and latency >= 0:
+                    report.latency_sum += latency
+                    report.latency_count += 1
+            else:
+                report.fail_count += 1
+                if domain:
+                    now = time.time()
+                    item = self.domain_fails.get(key + (domain,))
+                    fails = get_decayed_fails(item[0], item[1], now) if item else 0
+                    self.domain_fails[key + (domain,)] = [fails + 1, now]
+
+    def flush(self):
+        """把汇总结果写入数据库"""
+        with self.lock:
+            reports, self.reports = self.reports, {}
+            disabled = self.__take_disabled_domains(time.time())
+        for (ip, port), report in reports.items():
+            self.bulk_writer.add(report.get_operation(ip, port))
+        for ip, domain in disabled:
+            self.exclusion_writer.add(self.mongo_pool.get_exclusion_operation(ip, domain))
+            if self.exclusions is not None:
+                self.exclusions.add(ip, domain)
+        self.bulk_writer.flush()
+        self.exclusion_writer.flush()
+
+    def __take_disabled_domains(self, now):
+        """
+        取出衰减后的失败次数达到 REPORT_DISABLE_DOMAIN_FAILS 的 (ip, 域名)，删除衰减到 MIN_DOMAIN_FAILS 以下的失败次数，
+        调用前需要加锁
+        """
+        disabled = set()
+        for key, (fails, updated_at) in list(self.domain_fails.items()):
+            fails = get_decayed_fails(fails, updated_at, now)
+            if fails >= REPORT_DISABLE_DOMAIN_FAILS:
+                ip, port, domain = key
+                disabled.add((ip, domain))
+                del self.domain_fails[key]
+            elif fails < MIN_DOMAIN_FAILS:
+                del self.domain_fails[key]
+        return disabled
+
+    def __flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as ex:
+                logger.exception(ex)
+
+    def start(self):
+        """启动后台写入线程"""
+        Thread(target=self.__flush_loop, daemon=True).start()
@@ -16,15 +16,73 @@
 4.对外提供一个获取代理IP的方法
     遍历URL列表，获取URL
     根据发送请求，获取页面数据
+        同时请求concurrency个页面，每个网站(host)按照rate限速，代替以前每个爬虫在请求之前固定sleep
+        所有爬虫共享一个有连接池的session，请求有超时时间
     解析页面，提取数据，封装为Proxy对象
+        XPATH在第一次使用时编译成etree.XPath，按照XPATH缓存，每个爬虫类只编译一次
+        爬虫可以提供row_pattern正则表达式(命名分组ip，port，area)，不解析HTML，直接从页面文本中提取
+        ip不是合法的IPv4地址或者端口号不合法的行直接丢弃，不创建Proxy对象
     返回Proxy对象列表
+    传入已知的代理IP集合时，一页中没有新的代理IP，说明后面的页面都是以前爬取过的，不再请求后面的页面
+    设置了页面缓存(page_cache)时，发送条件请求，页面没有变化时不再解析，也看作没有新的代理IP；统计缓存命中的页面数量
+        页面返回了代理IP之后才更新页面缓存，提前结束时已经下载但是没有解析的页面不更新缓存，下次运行时还会解析
+        解析不到代理IP的页面(反爬虫页面，网站改版)不更新缓存，否则下次运行时会被当作没有变化的页面提前结束
 '''
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import re
 import requests
+from requests.adapters import HTTPAdapter
 from lxml import etree
 
 from utils.http import get_request_headers
+from utils.log import logger
+from utils.rate_limiter import HostRateLimiter
 from domain import Proxy
+from settings import SPIDER_HOST_RATE, SPIDER_HOST_BURST, SPIDER_CONCURRENCY, SPIDER_TIMEOUT, SPIDER_POOL_SIZE
+
+# 所有爬虫共享的限速器，同一个网站的请求一起限速
+rate_limiter = HostRateLimiter()
+
+
+def create_session():
+    """创建有连接池的session，所有爬虫共享，同一个网站的页面复用连接"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=SPIDER_POOL_SIZE, pool_maxsize=SPIDER_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+session = create_session()
+
+# 合法的IPv4地址和端口号
+IP_PATTERN = re.compile(r'^(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)(\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)){3}$')
+PORT_PATTERN = re.compile(r'^\d{1,5}$')
+
+# 页面没有变化时，get_page_from_url的返回值
+PAGE_UNCHANGED = object()
+
+# 编译好的XPATH：(分组XPATH, 详情XPATH) -> (etree.XPath, {字段: etree.XPath})
+extractor_cache = {}
+
+
+def is_valid_proxy(ip, port):
+    """ip是合法的IPv4地址，端口号在1~65535之间"""
+    return IP_PATTERN.match(ip) is not None and PORT_PATTERN.match(port) is not None and 0 < int(port) < 65536
+
+
+def get_extractor(group_xpath, detail_xpath):
+    """获取编译好的XPATH，第一次使用时编译"""
+    key = (group_xpath, tuple(sorted(detail_xpath.items())))
+    extractor = extractor_cache.get(key)
+    if extractor is None:
+        extractor = extractor_cache[key] = (
+            etree.XPath(group_xpath),
+            {field: etree.XPath(xpath) for field, xpath in detail_xpath.items()},
+        )
+    return extractor
 
 class BaseSpider(object):
 
@@ -34,7 +92,17 @@ class BaseSpider(object):
     group_xpath = ''
     # detail_xpath：组内XPATH，获取代理IP详情的信息XPATH，格式为：{"ip':'xx'，'port'：'xx'，‘area'：'xx'}
     detail_xpath = {}
-
+    # rate：每秒最多请求这个网站的页面数量，burst：最多连续请求的页面数量
+    rate = SPIDER_HOST_RATE
+    burst = SPIDER_HOST_BURST
+    # concurrency：同时请求的页面数量
+    concurrency = SPIDER_CONCURRENCY
+    # row_pattern：可选，每个代理IP一次匹配的正则表达式，命名分组ip，port，area；提供时不解析HTML
+    row_pattern = None
+    # encoding：使用row_pattern时，页面的编码
+    encoding = 'utf-8'
+    # stop_on_known_page：一页中没有新的代理IP时，不再请求后面的页面；页面不是按照时间排序的网站需要关闭
+    stop_on_known_page = True
 
     def __init__(self, urls = [], group_xpath = '', detail_xpath = {}):
         """提供初始方法，传入爬虫URL列表，分组XPATH，详情（组内）XPATH"""
@@ -44,43 +112,136 @@ class BaseSpider(object):
             self.group_xpath = group_xpath
         if detail_xpath:
             self.detail_xpath = detail_xpath
+        # 页面缓存，由RunSpider设置，None表示不使用
+        self.page_cache = None
+        # URL -> 已经下载，还没有更新页面缓存的响应
+        self.uncached_responses = {}
+        # 最近一次get_proxies请求的页面数量，其中没有变化的页面数量，是否提前结束
+        self.page_count = 0
+        self.unchanged_count = 0
+        self.stopped_early = False
 
     def get_page_from_url(self, url):
-        """根据发送的URL请求，获取页面数据"""
-        page = requests.get(url, headers=get_request_headers())
-        return page.content
+        """根据发送的URL请求，获取页面数据，超过网站的限速时等待；页面没有变化时返回PAGE_UNCHANGED"""
+        rate_limiter.acquire(url, self.rate, self.burst)
+        headers = get_request_headers()
+        if self.page_cache is None:
+            return session.get(url, headers=headers, timeout=SPIDER_TIMEOUT).content
+        # 带上条件请求的请求头
+        headers.update(self.page_cache.get_headers(url))
+        response = session.get(url, headers=headers, timeout=SPIDER_TIMEOUT)
+        if self.page_cache.is_unchanged(url, response):
+            return PAGE_UNCHANGED
+        # 返回这一页的代理IP之后才更新缓存
+        self.uncached_responses[url] = response
+        return response.content
+
+    def update_page_cache(self, url):
+        """这一页的代理IP已经返回，更新页面缓存"""
+        response = self.uncached_responses.pop(url, None)
+        if response is not None:
+            self.page_cache.update(url, response)
+
+    def fetch_page(self, url):
+        """获取页面数据，一个页面出错不影响其他页面，出错时返回None"""
+        try:
+            return self.get_page_from_url(url)
+        except Exception as ex:
+            logger.warning("获取页面失败：{} {}".format(url, ex))
+            return None
 
     def get_first_from_list(self, lis):
-        """如果列表有元素就返回第一个，否则返回空"""
-        return lis[0] if len(lis)!=0 else ''
+        """如果列表有元素就返回第一个(去掉两边的空白)，否则返回空"""
+        return lis[0].strip() if len(lis)!=0 else ''
 
     def get_proxies_from_page(self, page):
-        """解析页面，提取数据，封装为Proxy对象"""
+        """解析页面，提取数据，封装为Proxy对象，丢弃ip或者端口号不合法的行"""
+        if self.row_pattern:
+            yield from self.get_proxies_from_text(page)
+            return
         element = etree.HTML(page)
+        if element is None:
+            # 空页面
+            return
+        group, details = get_extractor(self.group_xpath, self.detail_xpath)
         # 获取包含代理IP信息的标签列表
-        trs = element.xpath(self.group_xpath)
+        trs = group(element)
         # 遍历trs，获取代理IP相关信息
         for tr in trs:
-            ip = self.get_first_from_list(tr.xpath(self.detail_xpath["ip"]))
-            port = self.get_first_from_list(tr.xpath(self.detail_xpath["port"]))
-            area = self.get_first_from_list(tr.xpath(self.detail_xpath["area"]))
-            proxy = Proxy(ip, port, area=area)
+            ip = self.get_first_from_list(details["ip"](tr))
+            port = self.get_first_from_list(details["port"](tr))
+            if not is_valid_proxy(ip, port):
+                continue
+            area = self.get_first_from_list(details["area"](tr)) if "area" in details else None
             # 使用yield返回提取到的数据（生成器用法）
-            yield proxy
+            yield Proxy(ip, port, area=area)
 
+    def get_proxies_from_text(self, page):
+        """使用row_pattern从页面文本中提取代理IP"""
+        pattern = re.compile(self.row_pattern) if isinstance(self.row_pattern, str) else self.row_pattern
+        text = page.decode(self.encoding, 'ignore') if isinstance(page, bytes) else page
+        for match in pattern.finditer(text):
+            fields = match.groupdict()
+            ip, port = fields['ip'].strip(), fields['port'].strip()
+            if is_valid_proxy(ip, port):
+                area = fields.get('area')
+                yield Proxy(ip, port, area=area.strip() if area else None)
 
-    def get_proxies(self):
-        """对外提供一个获取代理IP的方法"""
 
-        # 遍历URL列表，获取URL
-        for url in self.urls:
-            print(url)
-            # 根据发送请求，获取页面数据
-            page = self.get_page_from_url(url)
-            # 解析页面，提取数据，封装为Proxy对象
-            proxies = self.get_proxies_from_page(page)
-            # 返回Proxy对象列表：上面的proxies是一个生成器对象，怎么把生成器中的proxy对象返回呢？如下， 加from即可
-            yield from proxies
+    def get_proxies(self, known_proxies=None):
+        """
+        对外提供一个获取代理IP的方法
+        :param known_proxies: 已知的代理IP的 ip 集合，一页中没有新的代理IP时不再请求后面的页面
+        """
+        self.page_count = 0
+        self.unchanged_count = 0
+        self.stopped_early = False
+        self.uncached_responses = {}
+        urls = iter(self.urls)
+        # 同时请求concurrency个页面，按照URL列表的顺序返回；提前结束时，只浪费已经开始请求的页面
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            pending = deque()
+            for url in urls:
+                pending.append((url, executor.submit(self.fetch_page, url)))
+                if len(pending) >= self.concurrency:
+                    break
+            while pending:
+                # 遍历URL列表，获取URL，根据发送请求，获取页面数据
+                url, future = pending.popleft()
+                page = future.result()
+                logger.info(url)
+                if page is not None:
+                    self.page_count += 1
+                    if page is PAGE_UNCHANGED:
+                        # 页面没有变化，不再解析，上次已经爬取过这一页的代理IP
+                        self.unchanged_count += 1
+                        proxies = []
+                    else:
+                        # 解析页面，提取数据，封装为Proxy对象
+                        proxies = list(self.get_proxies_from_page(page))
+                    # 在返回之前判断，返回后爬虫任务会把这一页的代理IP添加到已知集合中；
+                    # 解析不到代理IP的页面(反爬虫页面，网站改版)不能说明后面的页面都爬取过，不提前结束
+                    if known_proxies is not None and self.stop_on_known_page and \
+                            (proxies or page is PAGE_UNCHANGED) and \
+                            all(proxy.ip in known_proxies for proxy in proxies):
+                        self.stopped_early = True
+                    # 返回Proxy对象列表
+                    yield from proxies
+                    if proxies:
+                        self.update_page_cache(url)
+                    else:
+                        # 解析不到代理IP的页面不缓存
+                        self.uncached_responses.pop(url, None)
+                    if self.stopped_early:
+                        for url, future in pending:
+                            future.cancel()
+                        break
+                # 补充一个页面的请求
+                url = next(urls, None)
+                if url is not None:
+                    pending.append((url, executor.submit(self.fetch_page, url)))
+        # 提前结束时丢弃的页面没有解析，不更新缓存
+        self.uncached_responses = {}
 
 
 if __name__ == '__main__':
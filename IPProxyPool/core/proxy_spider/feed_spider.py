@@ -0,0 +1,232 @@
+'''
+实现数据源爬虫
+
+目标：很多代理IP网站直接提供 ip:port 的文本列表或者json接口，一个响应就有几万个代理IP；
+      流式读取响应，边读取边解析，不需要把整个响应保存在内存中.
+思路：
+    1. 定义FeedSpider类，继承通用爬虫类（BaseSpider），可以直接配置到PROXIES_SPIDERS中，由RunSpider运行
+    2. 使用stream=True请求，每次读取 FEED_CHUNK_SIZE 字节，先完整的下载到临时文件(SpooledTemporaryFile，
+       超过 FEED_SPOOL_MAX_SIZE 字节后写入磁盘)，关闭连接后再从临时文件中分块解析，使用增量解码器解码；
+       下载的速度和检测的速度无关，返回的代理IP等待检测时不会一直占用连接；下载中途出错时整个数据源都不返回，
+       也不更新页面缓存，下次运行时重新下载
+    3. 文本格式：使用正则表达式row_pattern匹配，每块文本只处理到最后一个分隔符(换行，空格，逗号，分号)，
+       后面不完整的部分和下一块一起处理
+    4. json格式：使用JsonItemStream扫描json的结构，提取嵌套深度为json_item_depth的对象，
+       只保存当前正在读取的对象；对象中的字段按照json_fields转换成代理IP
+       比如 [{"ip": ..}, ..] 的深度是1，{"data": [{"ip": ..}, ..]} 的深度是2
+    5. 支持页面缓存：发送条件请求，返回304时不再解析；下载时计算内容的hash，返回所有代理IP后更新缓存，
+       解析不到代理IP的数据源不更新缓存
+    6. 和通用爬虫一样，丢弃ip或者端口号不合法的代理IP
+步骤：
+    1. 定义JsonItemStream类，从分块的json文本中增量的提取对象
+    2. 定义FeedSpider类
+        实现parse_text方法，从分块的文本中提取代理IP
+        实现parse_json方法，从分块的json中提取代理IP
+        实现download_feed方法，下载数据源到临时文件
+        重写get_proxies方法，依次下载和解析每个URL
+'''
+
+import codecs
+import hashlib
+import json
+import re
+import tempfile
+
+from core.proxy_spider.base_spider import BaseSpider, is_valid_proxy, rate_limiter, session
+from domain import Proxy
+from settings import FEED_CHUNK_SIZE, FEED_SPOOL_MAX_SIZE, SPIDER_TIMEOUT
+from utils.http import get_request_headers
+from utils.log import logger
+
+# 文本格式默认的正则表达式：ip:port
+TEXT_ROW_PATTERN = r'(?P<ip>\d{1,3}(?:\.\d{1,3}){3})\s*:\s*(?P<port>\d{1,5})'
+# 文本格式中，代理IP之间的分隔符
+TEXT_SEPARATORS = '\n ,;'
+
+
+class JsonItemStream(object):
+    """从分块的json文本中，增量的提取嵌套深度为item_depth的对象"""
+
+    # 需要处理的字符：对象和数组的开始结束，字符串的引号，转义符
+    TOKEN = re.compile(r'[{}\[\]"\\]')
+
+    def __init__(self, item_depth=1):
+        self.item_depth = item_depth
+        # 还没有处理完的文本：当前正在读取的对象
+        self.buffer = ''
+        # 当前的嵌套深度，是否在字符串中
+        self.depth = 0
+        self.in_string = False
+        # 被转义的字符在buffer中的下标
+        self.skip = -1
+        # 当前正在读取的对象在buffer中的开始下标
+        self.start = None
+
+    def feed(self, text):
+        """
+        处理一块文本
+        :param text: json文本的一块
+        :return: 这一块中读取完成的对象列表
+        """
+        offset = len(self.buffer)
+        self.buffer += text
+        items = []
+        for match in self.TOKEN.finditer(self.buffer, offset):
+            i = match.start()
+            if i == self.skip:
+                continue
+            char = match.group()
+            if self.in_string:
+                if char == '\\':
+                    self.skip = i + 1
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in '{[':
+                if char == '{' and self.depth == self.item_depth:
+                    self.start = i
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if char == '}' and self.depth == self.item_depth and self.start is not None:
+                    try:
+                        items.append(json.loads(self.buffer[self.start:i + 1]))
+                    except ValueError:
+                        pass
+                    self.start = None
+
+        # 丢弃已经处理完的文本，只保留当前正在读取的对象
+        keep = self.start if self.start is not None else len(self.buffer)
+        self.buffer = self.buffer[keep:]
+        self.skip -= keep
+        if self.start is not None:
+            self.start = 0
+        return items
+
+
+class FeedSpider(BaseSpider):
+
+    # feed_format：数据源的格式，text或者json
+    feed_format = 'text'
+    # row_pattern：文本格式使用的正则表达式，命名分组ip，port，area
+    row_pattern = TEXT_ROW_PATTERN
+    # json_item_depth：json格式中代理IP对象的嵌套深度
+    json_item_depth = 1
+    # json_fields：代理IP的字段 -> json对象中的字段
+    json_fields = {'ip': 'ip', 'port': 'port', 'area': 'area'}
+    # chunk_size：每次读取的大小
+    chunk_size = FEED_CHUNK_SIZE
+
+    def get_proxy_from_fields(self, ip, port, area=None):
+        """校验ip和端口号，合法时返回代理IP，否则返回None"""
+        ip, port = str(ip or '').strip(), str(port or '').strip()
+        if not is_valid_proxy(ip, port):
+            return None
+        return Proxy(ip, port, area=str(area).strip() if area else None)
+
+    def parse_text(self, texts):
+        """从分块的文本中提取代理IP"""
+        pattern = re.compile(self.row_pattern) if isinstance(self.row_pattern, str) else self.row_pattern
+        rest = ''
+        for text in texts:
+            text = rest + text
+            # 最后一个分隔符之后可能是不完整的代理IP，和下一块一起处理
+            cut = max(text.rfind(separator) for separator in TEXT_SEPARATORS) + 1
+            rest = text[cut:]
+            yield from self.__parse_rows(pattern, text[:cut])
+        yield from self.__parse_rows(pattern, rest)
+
+    def __parse_rows(self, pattern, text):
+        for match in pattern.finditer(text):
+            fields = match.groupdict()
+            proxy = self.get_proxy_from_fields(fields['ip'], fields['port'], fields.get('area'))
+            if proxy is not None:
+                yield proxy
+
+    def parse_json(self, texts):
+        """从分块的json中提取代理IP"""
+        stream = JsonItemStream(self.json_item_depth)
+        for text in texts:
+            for item in stream.feed(text):
+                if not isinstance(item, dict):
+                    continue
+                proxy = self.get_proxy_from_fields(*(item.get(self.json_fields.get(field, field))
+                                                     for field in ('ip', 'port', 'area')))
+                if proxy is not None:
+                    yield proxy
+
+    def parse(self, texts):
+        """根据数据源的格式，从分块的文本中提取代理IP"""
+        if self.feed_format == 'json':
+            return self.parse_json(texts)
+        return self.parse_text(texts)
+
+    def download_feed(self, url):
+        """
+        流式下载一个URL到临时文件，下载完成后关闭连接
+        :return: (响应, 临时文件, 内容的hash)，数据源没有变化或者请求失败时返回None；下载中途出错时抛出异常
+        """
+        rate_limiter.acquire(url, self.rate, self.burst)
+        headers = get_request_headers()
+        if self.page_cache is not None:
+            headers.update(self.page_cache.get_headers(url))
+        with session.get(url, headers=headers, timeout=SPIDER_TIMEOUT, stream=True) as response:
+            self.page_count += 1
+            if self.page_cache is not None and self.page_cache.is_unchanged(url, response, check_hash=False):
+                # 数据源没有变化，不再解析
+                self.unchanged_count += 1
+                return None
+            if response.status_code != 200:
+                logger.warning("获取数据源失败：{} {}".format(url, response.status_code))
+                return None
+
+            spool = tempfile.SpooledTemporaryFile(FEED_SPOOL_MAX_SIZE)
+            content_hash = hashlib.md5()
+            try:
+                for chunk in response.iter_content(self.chunk_size):
+                    content_hash.update(chunk)
+                    spool.write(chunk)
+            except Exception:
+                spool.close()
+                raise
+        spool.seek(0)
+        return response, spool, content_hash.hexdigest()
+
+    def get_proxies_from_feed(self, url):
+        """下载一个URL到临时文件，再从临时文件中分块解析"""
+        result = self.download_feed(url)
+        if result is None:
+            return
+        response, spool, content_hash = result
+        with spool:
+            decoder = codecs.getincrementaldecoder(self.encoding)('ignore')
+
+            def iter_texts():
+                for chunk in iter(lambda: spool.read(self.chunk_size), b''):
+                    yield decoder.decode(chunk)
+                yield decoder.decode(b'', final=True)
+
+            count = 0
+            for proxy in self.parse(iter_texts()):
+                count += 1
+                yield proxy
+        # 解析不到代理IP的数据源不缓存
+        if self.page_cache is not None and count:
+            self.page_cache.update(url, response, content_hash)
+
+    def get_proxies(self, known_proxies=None):
+        """
+        依次下载和解析每个URL，获取代理IP
+        :param known_proxies: 数据源不是按照时间排序的，不使用已知的代理IP提前结束
+        """
+        self.page_count = 0
+        self.unchanged_count = 0
+        self.stopped_early = False
+        for url in self.urls:
+            logger.info(url)
+            try:
+                yield from self.get_proxies_from_feed(url)
+            except Exception as ex:
+                # 一个URL出错不影响其他URL
+                logger.warning("读取数据源失败：{} {}".format(url, ex))
@@ -0,0 +1,89 @@
+'''
+实现爬虫的页面缓存
+
+目标：很多代理IP网站的页面在两次爬取之间没有变化，没有变化的页面不再下载，解析和检测.
+思路：
+    1. 每个URL保存响应的ETag，Last-Modified和页面内容的hash，保存在数据库的page_cache集合中，重启后继续使用
+    2. 请求页面时带上If-None-Match和If-Modified-Since请求头，网站返回304说明页面没有变化
+    3. 网站不支持条件请求时，比较页面内容的hash，hash相同也说明页面没有变化
+    4. 页面有变化时更新缓存，批量写入数据库；没有变化时只更新时间，超过 PAGE_CACHE_EXPIRE 秒没有更新的缓存自动删除
+步骤：
+    1. 定义PageCache类
+        实现load方法，从数据库中加载所有页面的缓存
+        实现get_headers方法，获取条件请求的请求头
+        实现is_unchanged方法，判断页面有没有变化
+        实现update方法，更新页面的缓存
+        实现flush方法，把缓冲区中的修改写入数据库
+'''
+
+from datetime import datetime
+from threading import Lock
+from pymongo import UpdateOne
+import hashlib
+
+from core.db.mongo_pool import BulkWriter
+
+
+def get_content_hash(content):
+    return hashlib.md5(content).hexdigest()
+
+
+class PageCache(object):
+
+    def __init__(self, mongo_pool):
+        self.collection = mongo_pool.page_cache
+        self.bulk_writer = BulkWriter(self.collection)
+        # URL -> {'etag': ..., 'last_modified': ..., 'hash': ...}
+        self.pages = {}
+        self.lock = Lock()
+
+    def load(self):
+        """从数据库中加载所有页面的缓存"""
+        pages = {item['_id']: item for item in self.collection.find()}
+        with self.lock:
+            self.pages = pages
+
+    def get_headers(self, url):
+        """获取条件请求的请求头，没有缓存时返回空字典"""
+        page = self.pages.get(url)
+        headers = {}
+        if page:
+            if page.get('etag'):
+                headers['If-None-Match'] = page['etag']
+            if page.get('last_modified'):
+                headers['If-Modified-Since'] = page['last_modified']
+        return headers
+
+    def is_unchanged(self, url, response, check_hash=True):
+        """
+        判断页面有没有变化，没有变化时更新缓存的时间
+        :param url: 页面的URL
+        :param response: requests的响应
+        :param check_hash: 是否比较页面内容的hash，流式读取的响应不能提前读取内容，只根据304判断
+        :return: True，页面没有变化
+        """
+        page = self.pages.get(url)
+        if page is None:
+            return False
+        if response.status_code == 304 or (check_hash and page.get('hash') == get_content_hash(response.content)):
+            self.bulk_writer.add(UpdateOne({'_id': url}, {'$set': {'updated_at': datetime.utcnow()}}))
+            return True
+        return False
+
+    def update(self, url, response, content_hash=None):
+        """页面有变化时更新缓存，流式读取的响应需要传入读取时计算的hash"""
+        if response.status_code != 200:
+            return
+        page = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'hash': content_hash or get_content_hash(response.content),
+        }
+        with self.lock:
+            self.pages[url] = page
+        self.bulk_writer.add(UpdateOne({'_id': url}, {'$set': dict(page, updated_at=datetime.utcnow())},
+                                       upsert=True))
+
+    def flush(self):
+        """把缓冲区中的修改写入数据库"""
+        self.bulk_writer.flush()
@@ -1,12 +1,7 @@
 from core.proxy_spider.base_spider import BaseSpider
+from core.proxy_spider.feed_spider import FeedSpider
 from domain import Proxy
 
-import time
-import random
-import requests
-
-from utils.http import get_request_headers
-
 '''
 实现ip3366代理爬虫：http://www.ip3366.net/free/?stype=1&page=1
 
@@ -26,12 +21,6 @@ class Ip3366Spider(BaseSpider):
         'area': './td[5]/text()'
     }
 
-    def get_page_from_url(self, url):
-        """当我们两个页面的访问时间间隔太短的时候，就报错；这是一种反爬虫手段"""
-        time.sleep(random.uniform(1,3))
-        # 调用父类的方法，发送请求，获取响应数据
-        return super().get_page_from_url(url)
-
 
 '''
 实现快代理爬虫：https://www.kuaidaili.com/free/inha/1/
@@ -52,12 +41,6 @@ class KuaiSpider(BaseSpider):
         'area': './td[5]/text()'
     }
 
-    def get_page_from_url(self, url):
-        """当我们两个页面的访问时间间隔太短的时候，就报错；这是一种反爬虫手段"""
-        time.sleep(random.uniform(1,3))
-        # 调用父类的方法，发送请求，获取响应数据
-        return super().get_page_from_url(url)
-
 
 '''
 实现 proxylistplus代理爬虫：https://list.proxylistplus.com/Fresh-HTTP-Proxy-List-1
@@ -78,12 +61,6 @@ class ProxylistplusSpider(BaseSpider):
         'area': './td[5]/text()'
     }
 
-    def get_page_from_url(self, url):
-        """当我们两个页面的访问时间间隔太短的时候，就报错；这是一种反爬虫手段"""
-        time.sleep(random.uniform(1,3))
-        # 调用父类的方法，发送请求，获取响应数据
-        return super().get_page_from_url(url)
-
 
 '''
 实现66ip爬虫：http://www.66ip.cn/1.html
@@ -106,12 +83,6 @@ class Ip66Spider(BaseSpider):
         'area': './td[3]/text()'
     }
 
-    def get_page_from_url(self, url):
-        """当我们两个页面的访问时间间隔太短的时候，就报错；这是一种反爬虫手段"""
-        time.sleep(random.uniform(1,3))
-        # 调用父类的方法，发送请求，获取响应数据
-        return super().get_page_from_url(url)
-
     # def get_page_from_url(self, url):
     #     """当我们两个页面的访问时间间隔太短的时候，就报错；这是一种反爬虫手段"""
     #     time.sleep(random.uniform(1,3))
@@ -123,6 +94,33 @@ class Ip66Spider(BaseSpider):
     #         # 观察发现：这个cookie信息不是通过服务器响应设置过来的，那么就是js生成的
 
 
+'''
+实现TheSpeedX代理IP列表爬虫：https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/http.txt
+
+    定义一个类，继承数据源爬虫类（FeedSpider）
+    提供urls，文本格式每行一个 ip:port，使用默认的row_pattern
+'''
+class SpeedXSpider(FeedSpider):
+
+    urls = ['https://raw.githubusercontent.com/TheSpeedX/PROXY-List/master/http.txt']
+    feed_format = 'text'
+
+
+'''
+实现geonode代理IP接口爬虫：https://proxylist.geonode.com/api/proxy-list?limit=500&page=1
+
+    定义一个类，继承数据源爬虫类（FeedSpider）
+    提供urls，json格式为 {"data": [{"ip": .., "port": .., "country": ..}, ..]}，代理IP对象的深度是2
+'''
+class GeonodeSpider(FeedSpider):
+
+    urls = ['https://proxylist.geonode.com/api/proxy-list?limit=500&page={}&sort_by=lastChecked&sort_type=desc'
+            .format(i) for i in range(1, 6)]
+    feed_format = 'json'
+    json_item_depth = 2
+    json_fields = {'ip': 'ip', 'port': 'port', 'area': 'country'}
+
+
 if __name__ == '__main__':
     # print(Ip3366Spider.urls)
 
@@ -6,20 +6,31 @@
 思路：
 1. 在run_spider.py中，创建RunSpider类
 2. 提供一个运行爬虫的run方法，作为运行爬虫的入口，实现核心的处理逻辑
-    2.1. 根据配置文件信息，获取爬虫对象列表.
-    2.2. 遍历爬虫对象列表，获取爬虫对象，遍历爬虫对象的get_proxies方法，获取代理IP
-    2.3. 检测代理IP（代理IP检测模块）
-    2.4. 如果可用，写入数据库（数据库模块）
+    2.1. 根据配置文件信息，获取爬虫对象列表，只运行到期的爬虫来源.
+    2.2. 爬取，检测，写入分成三个阶段，阶段之间使用有界队列连接，队列满了前一个阶段就等待，内存占用稳定
+         爬取阶段：同时运行 SPIDER_WORKERS 个爬虫，遍历爬虫对象的get_proxies方法，获取代理IP，放到待检测队列中；
+                   爬虫只负责爬取和解析，不用等待检测完成就可以爬取下一页
+                   在检测之前去重：运行开始时从数据库中加载已有的 ip 集合(数据库中ip是主键)，所有爬虫共享，已知的代理IP不再检测；
+                   一页中都是已知的代理IP时，爬虫不再爬取后面的页面
+         检测阶段：从待检测队列中取出一批代理IP(最多 SPIDER_VALIDATE_BATCH_SIZE 个，凑不满时最多等待 SPIDER_VALIDATE_BATCH_WAIT 秒)，
+                   分阶段检测（代理IP检测模块），同时检测 SPIDER_VALIDATE_CONCURRENCY 个，可用的放到待写入队列中；
+                   asyncio的事件循环同一时间只能运行一个，所以检测阶段只有一个协程，并发在异步校验器内部
+         写入阶段：从待写入队列中取出代理IP，批量写入数据库（数据库模块），使用upsert，已经存在的代理IP不会重复插入
+         爬虫全部完成后，依次给下一个阶段放结束标记，等待所有阶段完成
+    2.3. 每隔 SPIDER_METRICS_INTERVAL 秒输出每个阶段的数量和队列长度
+         记录每个爬虫来源的页面数量，页面缓存命中的数量，代理IP数量，新的代理IP数量，可用数量和耗时，运行结束后更新来源的统计和运行间隔
+    2.4. 开启 SPIDER_PAGE_CACHE 时，每次运行开始时加载页面缓存，爬虫发送条件请求，没有变化的页面不再解析和检测；
+         运行结束后把页面缓存的修改写入数据库
     2.5. 处理异常，防止一个爬虫内部出错了，影响其他的爬虫.
 3. 使用异步来执行每一个爬虫任务，以提高抓取代理IP效率
     - 在init 方法中创建协程池对象
     - 把处理一个代理爬虫的代码抽到一个方法
     - 使用异步执行这个方法
     - 调用协程的join方法，让当前线程等待队列任务的完成.
-4. 使用schedule模块，实现每隔一定的时间，执行一次爬取任务
+4. 按照每个爬虫来源的运行间隔调度爬取任务(爬虫来源的统计和调度模块)
     定义一个start的类方法
-    创建当前类的对象，调用run方法
-    使用schedule模块，每隔一定的时间，执行当前对象的run方法
+    创建当前类的对象
+    循环：获取到期的爬虫来源，调用run方法运行这些爬虫；等待到最早的下次运行时间(最长SOURCE_CHECK_INTERVAL秒)
 '''
 
 # 打猴子补丁
@@ -27,93 +38,243 @@ from gevent import monkey
 monkey.patch_all()
 # 导入协程池
 from gevent.pool import Pool
+from gevent.queue import Queue, Empty
+import gevent
 
-from settings import PROXIES_SPIDERS, RUN_SPIDERS_INTERVAL
-from core.proxy_validate.httpbin_validator import check_proxy
+from settings import PROXIES_SPIDERS, SPIDER_WORKERS, SPIDER_CANDIDATE_QUEUE_SIZE, \
+    SPIDER_STORE_QUEUE_SIZE, SPIDER_VALIDATE_BATCH_SIZE, SPIDER_VALIDATE_BATCH_WAIT, SPIDER_VALIDATE_CONCURRENCY, \
+    SPIDER_METRICS_INTERVAL, SOURCE_CHECK_INTERVAL, SPIDER_PAGE_CACHE
+from core.proxy_spider.page_cache import PageCache
+from core.proxy_spider.source_scheduler import SourceRun, SourceScheduler
+from core.proxy_validate.staged_validator import StagedValidator
 from core.db.mongo_pool import MongoPool
 from utils.log import logger
 
 import importlib
-import schedule
 import time
 
 
+class PipelineStats(object):
+    """流水线每个阶段的统计信息"""
+
+    def __init__(self):
+        # 爬虫爬取到的代理IP数量，其中重复的数量
+        self.crawled = 0
+        self.duplicated = 0
+        # 检测的代理IP数量和批次数量，其中可用的数量
+        self.validated = 0
+        self.batches = 0
+        self.passed = 0
+        # 写入数据库的代理IP数量
+        self.stored = 0
+
+    def __str__(self):
+        return '爬取{}个(重复{}个)，检测{}个({}批，可用{}个)，写入{}个'.format(
+            self.crawled, self.duplicated, self.validated, self.batches, self.passed, self.stored)
+
+
 class RunSpider(object):
 
     def __init__(self):
-        # 创建MongoPool对象
-        self.mongo_pool = MongoPool()
-        # 创建协程池对象
-        self.coroutine_pool = Pool()
+        # 创建MongoPool对象，批量写入
+        self.mongo_pool = MongoPool(buffered=True)
+        # 创建协程池对象，爬取阶段使用
+        self.coroutine_pool = Pool(SPIDER_WORKERS)
+        # 创建分阶段校验器对象，检测阶段使用
+        self.validator = StagedValidator(concurrency=SPIDER_VALIDATE_CONCURRENCY)
+        # 待检测队列和待写入队列
+        self.candidate_queue = None
+        self.store_queue = None
+        self.stats = PipelineStats()
+        # 页面缓存，所有爬虫共享
+        self.page_cache = PageCache(self.mongo_pool) if SPIDER_PAGE_CACHE else None
+        # 本次运行中已知的代理IP的 ip 集合，所有爬虫共享；ip是数据库的主键，已有的ip换一个端口号也不会插入
+        self.known_proxies = set()
+        # 爬虫来源名称 -> 本次运行的统计
+        self.source_runs = {}
+        # 待检测的代理IP的 ip:port -> 爬虫来源名称，用于统计每个来源的可用数量
+        self.candidate_sources = {}
 
-    def get_spider_from_settings(self):
-        """根据配置文件信息，获取爬虫对象列表"""
+    def get_spider_from_settings(self, names=None):
+        """根据配置文件信息，获取爬虫对象列表，names不为None时只获取这些爬虫来源(爬虫类名)"""
         # 遍历配置文件中的爬虫信息，获得每个爬虫的全类名
         for full_class_name in PROXIES_SPIDERS:
             # core.proxy_spider.proxy_spiders.Ip3366Spider
             # 获取模块名 和 类名
             # print(full_class_name.rsplit(".", maxsplit=1))
             module_name, class_name = full_class_name.rsplit('.',maxsplit=1)
+            if names is not None and class_name not in names:
+                continue
             # 根据模块名导入模块
             module = importlib.import_module(module_name)
             # 根据类名，从模块中，获取类
             cls = getattr(module, class_name)
             # 创建爬虫对象
             spider = cls()
+            spider.page_cache = self.page_cache
             # print(spider)
             yield spider
 
 
-    def run(self):
+    def run(self, names=None):
+        """
+        运行一次爬取任务
+        :param names: 要运行的爬虫来源(爬虫类名)，默认所有
+        :return: 爬虫来源名称 -> 本次运行的统计
+        """
+        # 从数据库中加载已有的代理IP，用于去重
+        self.known_proxies = self.mongo_pool.get_proxy_ips()
+        self.source_runs = {}
+        self.candidate_sources = {}
+        if self.page_cache is not None:
+            self.page_cache.load()
+        self.candidate_queue = Queue(maxsize=SPIDER_CANDIDATE_QUEUE_SIZE)
+        self.store_queue = Queue(maxsize=SPIDER_STORE_QUEUE_SIZE)
+        self.stats = PipelineStats()
+
+        # 启动检测阶段，写入阶段和统计输出
+        validate_greenlet = gevent.spawn(self.__validate_stage)
+        store_greenlet = gevent.spawn(self.__store_stage)
+        metrics_greenlet = gevent.spawn(self.__metrics_loop)
+
         # 根据配置文件信息，获取爬虫对象列表.
-        spiders = self.get_spider_from_settings()
+        spiders = self.get_spider_from_settings(names)
         # 遍历爬虫对象列表，获取爬虫对象，遍历爬虫对象的get_proxies方法，获取代理IP
         for spider in spiders:
             # self.__execute_one_spider_task(spider)
-            # 使用异步执行这个方法
-            self.coroutine_pool.apply_async(self.__execute_one_spider_task, args=(spider, ))
+            # 使用异步执行这个方法，协程池满了就等待
+            self.coroutine_pool.spawn(self.__execute_one_spider_task, spider)
 
         # 调用协程的join方法，让当前线程等待队列任务的完成
         self.coroutine_pool.join()
+        # 爬虫全部完成，依次结束检测阶段和写入阶段
+        self.candidate_queue.put(None)
+        validate_greenlet.join()
+        store_greenlet.join()
+        metrics_greenlet.kill()
+        if self.page_cache is not None:
+            self.page_cache.flush()
+        logger.info("爬取完成：{}；{}；{}；写入统计：{}".format(self.stats, self.validator.connect_stats,
+                                                     self.validator.probe_stats, self.mongo_pool.bulk_writer.get_stats()))
+        return self.source_runs
 
     def __execute_one_spider_task(self, spider):
-        """用于处理一个爬虫任务"""
+        """爬取阶段：用于处理一个爬虫任务"""
         # 把处理一个代理爬虫的代码抽到一个方法
+        name = type(spider).__name__
+        run = self.source_runs[name] = SourceRun()
+        start_time = time.time()
         try:
-            # 遍历爬虫对象的get_proxies方法
-            for proxy in spider.get_proxies():
-                # 检测代理IP（代理IP检测模块）
-                proxy = check_proxy(proxy)
-                # 如果可用，写入数据库（数据库模块）,speed不为-1即可用
-                if proxy.speed != -1:
-                    # 如果可用，写入数据库（数据库模块）
-                    self.mongo_pool.insert_one(proxy)
+            # 遍历爬虫对象的get_proxies方法，把代理IP放到待检测队列中，队列满了就等待
+            # 传入已知的代理IP集合，一页中都是已知的代理IP时，爬虫不再爬取后面的页面
+            for proxy in spider.get_proxies(self.known_proxies):
+                self.stats.crawled += 1
+                run.candidates += 1
+                # 已知的代理IP不再检测
+                if proxy.ip in self.known_proxies:
+                    self.stats.duplicated += 1
+                    continue
+                self.known_proxies.add(proxy.ip)
+                run.new += 1
+                self.candidate_sources['{}:{}'.format(proxy.ip, proxy.port)] = name
+                self.candidate_queue.put(proxy)
         except Exception as ex:
             logger.exception(ex)
+        finally:
+            run.pages = spider.page_count
+            run.unchanged = spider.unchanged_count
+            run.stopped_early = spider.stopped_early
+            run.elapsed = time.time() - start_time
+
+    def __get_batch(self):
+        """从待检测队列中取出一批代理IP，返回 (代理IP列表, 是否取到了结束标记)"""
+        proxy = self.candidate_queue.get()
+        if proxy is None:
+            return [], True
+        batch = [proxy]
+        deadline = time.time() + SPIDER_VALIDATE_BATCH_WAIT
+        while len(batch) < SPIDER_VALIDATE_BATCH_SIZE:
+            try:
+                proxy = self.candidate_queue.get(timeout=max(deadline - time.time(), 0))
+            except Empty:
+                break
+            if proxy is None:
+                return batch, True
+            batch.append(proxy)
+        return batch, False
+
+    def __validate_stage(self):
+        """检测阶段：分批检测代理IP，可用的放到待写入队列中，取到结束标记后结束写入阶段"""
+        finished = False
+        while not finished:
+            batch, finished = self.__get_batch()
+            if not batch:
+                continue
+            try:
+                proxies = self.validator.validate(batch)
+            except Exception as ex:
+                logger.exception(ex)
+                continue
+            self.stats.validated += len(batch)
+            self.stats.batches += 1
+            for proxy in proxies:
+                name = self.candidate_sources.pop('{}:{}'.format(proxy.ip, proxy.port), None)
+                # speed不为-1即可用
+                if proxy.speed != -1:
+                    self.stats.passed += 1
+                    if name in self.source_runs:
+                        self.source_runs[name].survivors += 1
+                    self.store_queue.put(proxy)
+        self.store_queue.put(None)
+
+    def __store_stage(self):
+        """写入阶段：把可用的代理IP批量写入数据库，取到结束标记后把缓冲区中剩余的操作写入数据库"""
+        while True:
+            proxy = self.store_queue.get()
+            if proxy is None:
+                break
+            try:
+                # 刚检测过，等到下次检测时间再由检测模块检测
+                proxy.next_check_at = time.time() + proxy.check_interval
+                self.mongo_pool.insert_one(proxy)
+                self.stats.stored += 1
+            except Exception as ex:
+                logger.exception(ex)
+        self.mongo_pool.flush()
+
+    def __metrics_loop(self):
+        """每隔一段时间输出每个阶段的数量和队列长度"""
+        while True:
+            gevent.sleep(SPIDER_METRICS_INTERVAL)
+            logger.info("爬取流水线：{}，待检测队列{}/{}，待写入队列{}/{}".format(
+                self.stats, self.candidate_queue.qsize(), self.candidate_queue.maxsize,
+                self.store_queue.qsize(), self.store_queue.maxsize))
 
     @classmethod
     def start(self):
-        # 创建当前类的对象，调用run方法
+        # 创建当前类的对象
         rs = RunSpider()
-        rs.run()
+        names = [full_class_name.rsplit('.', maxsplit=1)[1] for full_class_name in PROXIES_SPIDERS]
+        scheduler = SourceScheduler(rs.mongo_pool, names)
 
-        # 使用schedule模块，每隔一定的时间，执行当前对象的run方法
-        schedule.every(RUN_SPIDERS_INTERVAL).hours.do(rs.run)
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            # 获取到期的爬虫来源，运行这些爬虫，更新来源的统计和运行间隔
+            due = scheduler.get_due(time.time())
+            if due:
+                try:
+                    source_runs = rs.run(due)
+                except Exception as ex:
+                    logger.exception(ex)
+                    source_runs = {}
+                now = time.time()
+                for name in due:
+                    # 出错没有运行的来源按照没有产出处理
+                    scheduler.update(name, source_runs.get(name, SourceRun()), now)
+            # 等待到最早的下次运行时间
+            time.sleep(min(max(scheduler.get_next_run_at() - time.time(), 1), SOURCE_CHECK_INTERVAL))
 
 
 if __name__ == '__main__':
 
     RunSpider.start()
     # run = RunSpider().run()
-
-    # # 测试 schedule
-    # def task():
-    #     print("哈哈")
-    #
-    # schedule.every(2).seconds.do(task)
-    # while True:
-    #     schedule.run_pending()
-    #     time.sleep(1)
@@ -0,0 +1,132 @@
+'''
+实现爬虫来源的统计和调度
+
+目标：以前所有爬虫每隔 RUN_SPIDERS_INTERVAL 小时一起运行，每次爬取所有页面；
+      按照每个来源实际产出的可用新代理IP调度，产出多的来源多运行，一直没有产出的来源少运行.
+思路：
+    1. 每个爬虫(类名)是一个来源，每次运行统计：爬取的页面数量，其中没有变化的页面数量(页面缓存命中)，
+       爬取到的代理IP数量，其中新的代理IP数量，检测后可用的数量，爬取耗时
+    2. 统计累加后保存到数据库的source_stats集合中，重启后继续使用
+    3. 每次运行后调整这个来源的运行间隔：
+        有产出时，运行间隔乘以 SOURCE_TARGET_YIELD / 可用数量，产出越多间隔越短
+        没有产出时，运行间隔乘以 SOURCE_BACKOFF_FACTOR
+        每次最多缩短或者延长 SOURCE_MAX_ADJUST 倍(退避除外)，限制在 [SOURCE_MIN_INTERVAL, SOURCE_MAX_INTERVAL]
+    4. 只运行到期(next_run_at小于等于当前时间)的来源
+步骤：
+    1. 定义SourceRun类，一个来源一次运行的统计
+    2. 定义SourceStats类，一个来源的累计统计和调度信息
+        实现update方法，累加一次运行的统计，调整运行间隔
+    3. 定义SourceScheduler类
+        实现get_due方法，获取到期的来源
+        实现get_next_run_at方法，获取最早的下次运行时间
+        实现update方法，更新一个来源的统计并保存到数据库
+'''
+
+import time
+
+from settings import RUN_SPIDERS_INTERVAL, SOURCE_TARGET_YIELD, SOURCE_MAX_ADJUST, SOURCE_BACKOFF_FACTOR, \
+    SOURCE_MIN_INTERVAL, SOURCE_MAX_INTERVAL
+from utils.log import logger
+
+
+class SourceRun(object):
+    """一个来源一次运行的统计"""
+
+    def __init__(self):
+        # 爬取的页面数量，其中没有变化的页面数量
+        self.pages = 0
+        self.unchanged = 0
+        # 爬取到的代理IP数量
+        self.candidates = 0
+        # 其中数据库和本次运行中都没有的代理IP数量
+        self.new = 0
+        # 检测后可用的数量
+        self.survivors = 0
+        # 爬取耗时，单位s
+        self.elapsed = 0
+        # 是否因为一页中都是已知的代理IP提前结束
+        self.stopped_early = False
+
+    @property
+    def hit_rate(self):
+        """页面缓存的命中率"""
+        return self.unchanged / self.pages if self.pages else 0
+
+    def __str__(self):
+        return '页面{}个{}，缓存命中率{:.0%}，代理IP{}个，新的{}个，可用{}个，耗时{:.1f}s'.format(
+            self.pages, '(提前结束)' if self.stopped_early else '', self.hit_rate, self.candidates, self.new,
+            self.survivors, self.elapsed)
+
+
+class SourceStats(object):
+    """一个来源的累计统计和调度信息"""
+
+    def __init__(self, name, interval=RUN_SPIDERS_INTERVAL * 3600, next_run_at=0, runs=0, empty_runs=0,
+                 pages=0, unchanged=0, candidates=0, new=0, survivors=0, elapsed=0, last_run_at=0, **kwargs):
+        self.name = name
+        # 运行间隔，单位s，下次运行时间
+        self.interval = interval
+        self.next_run_at = next_run_at
+        # 运行次数，连续没有产出的次数
+        self.runs = runs
+        self.empty_runs = empty_runs
+        # 累计的统计
+        self.pages = pages
+        self.unchanged = unchanged
+        self.candidates = candidates
+        self.new = new
+        self.survivors = survivors
+        self.elapsed = elapsed
+        self.last_run_at = last_run_at
+
+    def update(self, run, now):
+        """累加一次运行的统计，调整运行间隔"""
+        self.runs += 1
+        self.pages += run.pages
+        self.unchanged += run.unchanged
+        self.candidates += run.candidates
+        self.new += run.new
+        self.survivors += run.survivors
+        self.elapsed += run.elapsed
+        self.last_run_at = now
+
+        if run.survivors:
+            self.empty_runs = 0
+            factor = min(max(SOURCE_TARGET_YIELD / run.survivors, 1 / SOURCE_MAX_ADJUST), SOURCE_MAX_ADJUST)
+        else:
+            self.empty_runs += 1
+            factor = SOURCE_BACKOFF_FACTOR
+        self.interval = min(max(self.interval * factor, SOURCE_MIN_INTERVAL), SOURCE_MAX_INTERVAL)
+        self.next_run_at = now + self.interval
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class SourceScheduler(object):
+
+    def __init__(self, mongo_pool, names):
+        """
+        :param mongo_pool: MongoPool对象，用于加载和保存统计
+        :param names: 所有来源的名称(爬虫类名)
+        """
+        self.mongo_pool = mongo_pool
+        saved = mongo_pool.find_source_stats()
+        # 来源名称 -> SourceStats，新的来源立即运行
+        self.sources = {name: SourceStats(**saved[name]) if name in saved else SourceStats(name) for name in names}
+
+    def get_due(self, now):
+        """获取到期的来源名称列表"""
+        return [name for name, stats in self.sources.items() if stats.next_run_at <= now]
+
+    def get_next_run_at(self):
+        """获取最早的下次运行时间"""
+        return min((stats.next_run_at for stats in self.sources.values()), default=time.time())
+
+    def update(self, name, run, now=None):
+        """更新一个来源的统计并保存到数据库"""
+        stats = self.sources[name]
+        stats.update(run, now or time.time())
+        logger.info("爬虫来源 {}：{}；下次运行间隔{:.1f}小时，连续没有产出{}次".format(
+            name, run, stats.interval / 3600, stats.empty_runs))
+        self.mongo_pool.save_source_stats(name, stats.to_dict())
@@ -3,107 +3,143 @@
 目的：检查代理IP可用性，保证代理池中代理IP基本可用
 思路
 1.在proxy_test.py中，创建ProxyTester类
-2.提供一个run 方法，用于处理检测代理命核心逻辑
-    从数据库中获取所有代理IP
+2.提供一个run 方法，用于处理一轮检测的核心逻辑
+    从数据库中获取到期(next_check_at小于等于当前时间)的代理IP，最早到期的在前面
     遍历代理IP列表
     检查代理可用性
-    如果代理不可用，让代理分数-1，如果代理分数等于0就从数据库中删除该代理，否则更新该代理IP
-    如果代理可用，就恢复该代理的分数，更新到数据库中
-3.为了提高检查的速度，使用异步来执行检测任务
-    在init方法中，创建队列和协程池
-    把要检测的代理IP，放到队列中
-        i.把检查一个代理可用性的代码，抽取到一个方法中；从队列中获取代理IP，进行检查；检查完毕，调度队列的task_done方法
-        ii.通过异步回调，使用死循环不断执行这个方法，
-        iii.开启多个一个异步任务，来处理代理IP的检测；可以通过配置文件指定异步数量
-    调用队列的join方法，让当前线程等待队列任务完成
-4.使用schedule模块，每隔一定的时间，执行一次检测任务
+    如果代理不可用，让代理分数-1，缩短检测间隔；连续失败时按指数退避；
+        如果连续失败次数达到上限，就从数据库中删除该代理，否则更新该代理IP，分数减到0时删除
+    如果代理可用，就给该代理加 TEST_SUCCESS_SCORE 分(最多MAX_SCORE)，延长检测间隔，更新到数据库中
+    分数和速度在数据库中的值的基础上调整，不覆盖检测期间使用结果报告(/report)对分数和速度的修改
+3.为了提高检查的速度，使用异步来执行检测任务，并且不管数据库中有多少代理IP，内存占用都保持稳定
+    在init方法中，创建固定大小的协程池
+    生产者：分页读取到期的代理IP，放到有界队列中；队列满了就等待
+    消费者：开启固定数量的协程，从队列中获取代理IP进行检查，获取到结束标记就退出
+    生产者读取完毕后，给每个消费者放一个结束标记，等待所有消费者退出，本轮检测结束
+    使用锁防止同时执行多轮检测
+    检测结果批量写入数据库，本轮检测结束后，把缓冲区中剩余的操作写入数据库
+4.持续调度检测任务，代替每隔固定时间检测所有代理IP
     定义类方法start，用于启动检测模块
     在start方法中
         i.创建本类对象
-        ii.调用run方法
-        iii.每间隔一定时间，执行一下，run方法
+        ii.循环调用run方法
+        iii.如果没有到期的代理IP，等待到最早的下次检测时间(最长TEST_IDLE_SLEEP秒)
 '''
 
 from core.db.mongo_pool import MongoPool
 from core.proxy_validate.httpbin_validator import check_proxy
-from settings import MAX_SCORE, TEST_PROXIES_ASYNC_COUNT, RUN_TEST_PROXIES_INTERVAL
+from settings import TEST_PROXIES_ASYNC_COUNT, TEST_MIN_INTERVAL, TEST_MAX_INTERVAL, \
+    TEST_INTERVAL_FACTOR, TEST_MAX_FAIL_COUNT, TEST_BATCH_SIZE, TEST_QUEUE_SIZE, TEST_IDLE_SLEEP
+from utils.log import logger
 
 from gevent import monkey
 monkey.patch_all()
 from gevent.pool import  Pool
-from queue import Queue
-import schedule
+from gevent.queue import Queue
+from threading import Lock
 import time
 
 class ProxyTester(object):
 
     def __init__(self):
-        # 创建操作数据库的MongoPool对象
-        self.mongo_pool = MongoPool()
-        # 创建队列和协程池
-        self.coroutine_pool = Pool()
-        self.queue = Queue()
-
-    def __check_callback(self, temp):
-        self.coroutine_pool.apply_async(self.__check_one_proxy, callback=self.__check_callback)
+        # 创建操作数据库的MongoPool对象，检测结果批量写入
+        self.mongo_pool = MongoPool(buffered=True)
+        # 创建固定大小的协程池
+        self.coroutine_pool = Pool(TEST_PROXIES_ASYNC_COUNT)
+        # 防止同时执行多轮检测
+        self.lock = Lock()
 
     def run(self):
-        # 从数据库中获取所有代理IP
-        proxies = self.mongo_pool.find_all()
-        # 遍历代理IP列表
-        for proxy in proxies:
-            # 检查代理可用性
-            # self.__check_one_proxy(proxy)
-            # 把要检测的代理IP，放到队列中
-            self.queue.put(proxy)
-
-        # 开启多个一个异步任务，来处理代理IP的检测
-        for i in range(TEST_PROXIES_ASYNC_COUNT):
-            # 通过异步回调，使用死循环不断执行这个方法
-            self.coroutine_pool.apply_async(self.__check_one_proxy, callback=self.__check_callback)
-
-        self.queue.join()
-
-    def __check_one_proxy(self):
+        """
+        执行一轮检测
+        :return: 本轮检测的代理IP数量，正在执行检测时返回0
+        """
+        if not self.lock.acquire(blocking=False):
+            logger.warning("上一轮检测还没有完成")
+            return 0
+        try:
+            # 创建有界队列
+            queue = Queue(maxsize=TEST_QUEUE_SIZE)
+            # 开启固定数量的消费者
+            for i in range(TEST_PROXIES_ASYNC_COUNT):
+                self.coroutine_pool.spawn(self.__check_worker, queue)
+
+            count = 0
+            try:
+                # 分页读取到期的代理IP，放到队列中；队列满了就等待
+                for proxy in self.mongo_pool.iter_due(time.time(), batch_size=TEST_BATCH_SIZE):
+                    queue.put(proxy)
+                    count += 1
+            finally:
+                # 给每个消费者放一个结束标记，等待所有消费者退出
+                for i in range(TEST_PROXIES_ASYNC_COUNT):
+                    queue.put(None)
+                self.coroutine_pool.join()
+                # 把缓冲区中剩余的操作写入数据库
+                self.mongo_pool.flush()
+            if count:
+                logger.info("本轮检测{}个代理IP，写入统计：{}".format(count, self.mongo_pool.bulk_writer.get_stats()))
+            return count
+        finally:
+            self.lock.release()
+
+    def __check_worker(self, queue):
+        """消费者：从队列中获取代理IP进行检查，获取到结束标记就退出"""
+        while True:
+            proxy = queue.get()
+            if proxy is None:
+                break
+            try:
+                self.__check_one_proxy(proxy)
+            except Exception as ex:
+                logger.exception(ex)
+
+    def __check_one_proxy(self, proxy):
         """检测一个代理IP的可用性"""
-
-        # 从队列中获取代理IP，进行检查
-        proxy = self.queue.get()
-
         proxy = check_proxy(proxy)
-        if proxy.speed == -1:
-            # 如果代理不可用，让代理分数 - 1，
-            proxy.score -= 1
-            if proxy.score == 0:
-                # 如果代理分数等于0就从数据库中删除该代理，
+        ok = proxy.speed != -1
+        if not ok:
+            # 如果代理不可用，让代理分数 - 1(在数据库中调整)，
+            proxy.fail_count += 1
+            if proxy.fail_count >= TEST_MAX_FAIL_COUNT:
+                # 如果连续失败次数达到上限，就从数据库中删除该代理，
                 self.mongo_pool.delete_one(proxy)
-            else:
-                # 否则更新该代理IP
-                self.mongo_pool.update_one(proxy)
+                return
+            # 缩短检测间隔，连续失败时按指数退避
+            proxy.check_interval = min(TEST_MIN_INTERVAL * TEST_INTERVAL_FACTOR ** (proxy.fail_count - 1),
+                                       TEST_MAX_INTERVAL)
         else:
-            # 如果代理可用，就恢复该代理的分数，更新到数据库中
-            proxy.score = MAX_SCORE
-            self.mongo_pool.update_one(proxy)
+            # 如果代理可用，就给该代理加分(在数据库中调整)，延长检测间隔
+            if proxy.fail_count:
+                proxy.fail_count = 0
+                proxy.check_interval = TEST_MIN_INTERVAL
+            else:
+                proxy.check_interval = min(proxy.check_interval * TEST_INTERVAL_FACTOR, TEST_MAX_INTERVAL)
 
-        # 检查完毕，调度队列的task_done方法
-        self.queue.task_done()
+        # 更新该代理IP，只修改检测模块负责的字段
+        proxy.next_check_at = time.time() + proxy.check_interval
+        self.mongo_pool.save_check_result(proxy, ok)
 
     @classmethod
     def start(cls):
         # 创建本类对象
         pt = ProxyTester()
-        # 调用run方法
-        pt.run()
+        pt.mongo_pool.init_next_check_at()
+        pt.mongo_pool.migrate_disable_domains()
 
-        # 每间隔一定时间，执行一下，run方法
-        schedule.every(RUN_TEST_PROXIES_INTERVAL).hours.do(pt.run)
+        # 持续调度检测任务
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            # 调用run方法
+            if pt.run():
+                continue
+            # 没有到期的代理IP，等待到最早的下次检测时间
+            next_check_at = pt.mongo_pool.get_next_check_at()
+            sleep = TEST_IDLE_SLEEP if next_check_at is None else next_check_at - time.time()
+            time.sleep(min(max(sleep, 1), TEST_IDLE_SLEEP))
 
 
 if __name__ == '__main__':
     # pt = ProxyTester()
     # pt.run()
 
-    ProxyTester.start()
\ No newline at end of file
+    ProxyTester.start()
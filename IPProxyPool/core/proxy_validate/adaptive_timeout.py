@@ -0,0 +1,49 @@
+'''
+实现代理IP的自适应超时
+
+目标：根据每个代理IP的历史响应速度，计算该代理IP的检测超时时间，不再所有代理IP都使用同一个TEST_TIMEOUT.
+思路：
+    一个平时0.3s就能响应的代理IP，开始卡住的时候，没有必要等待10s才判定为不可用.
+    1. 有历史响应速度的代理IP：超时时间 = 历史响应速度的百分位数 * 倍数，并限制在 [ADAPTIVE_TIMEOUT_FLOOR, TEST_TIMEOUT] 之间
+    2. 新爬取的代理IP没有历史响应速度，使用单独的更短的超时时间 NEW_PROXY_TIMEOUT
+步骤：
+    1. 实现get_proxy_timeout方法，计算一个代理IP的检测超时时间
+    2. 实现add_speed_history方法，检测成功后记录响应速度，只保留最近SPEED_HISTORY_SIZE次
+'''
+
+import math
+
+from settings import TEST_TIMEOUT, ADAPTIVE_TIMEOUT_PERCENTILE, ADAPTIVE_TIMEOUT_MULTIPLE, \
+    ADAPTIVE_TIMEOUT_FLOOR, NEW_PROXY_TIMEOUT, SPEED_HISTORY_SIZE
+
+
+def get_percentile(values, percentile):
+    """使用最近秩方法计算百分位数"""
+    values = sorted(values)
+    index = max(math.ceil(percentile / 100 * len(values)) - 1, 0)
+    return values[index]
+
+
+def get_proxy_timeout(proxy, ceiling=TEST_TIMEOUT):
+    """
+    计算一个代理IP的检测超时时间
+    :param proxy: 代理IP模型对象
+    :param ceiling: 超时时间的最大值
+    :return: 超时时间，单位s
+    """
+    history = proxy.speed_history
+    # 以前存入数据库的代理IP没有历史响应速度，使用最近一次的响应速度
+    if not history and proxy.speed > 0:
+        history = [proxy.speed]
+
+    if not history:
+        # 新爬取的代理IP
+        return min(NEW_PROXY_TIMEOUT, ceiling)
+
+    timeout = get_percentile(history, ADAPTIVE_TIMEOUT_PERCENTILE) * ADAPTIVE_TIMEOUT_MULTIPLE
+    return min(max(timeout, ADAPTIVE_TIMEOUT_FLOOR), ceiling)
+
+
+def add_speed_history(proxy, speed):
+    """记录一次检测成功的响应速度，只保留最近SPEED_HISTORY_SIZE次"""
+    proxy.speed_history = (proxy.speed_history + [speed])[-SPEED_HISTORY_SIZE:]
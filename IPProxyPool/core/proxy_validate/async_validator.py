@@ -0,0 +1,121 @@
+'''
+实现代理池的异步校验模块
+
+目标：在一个事件循环中并发检测成千上万的代理IP，检测结果和 httpbin_validator.check_proxy 完全一致.
+思路：
+    httpbin_validator 中的 check_proxy 先检测http，再检测https，使用的是阻塞的requests；
+    一个不可用的代理IP最多要花费 2*TEST_TIMEOUT 的时间.
+    这里使用 asyncio + aiohttp 实现：
+    1. 一个代理IP的http和https检测同时发出，最多只花费 1*TEST_TIMEOUT 的时间
+    2. 使用信号量限制同时检测的代理IP数量
+    3. 匿名程度的判断和协议类型的合并，复用 httpbin_validator 中的 get_nick_type 和 set_check_result
+步骤：
+    1. 创建AsyncValidator对象，可以指定并发数量和最大超时时间，每个代理IP的超时时间根据历史响应速度计算
+    2. 在异步代码中：使用 async with 打开校验器，调用 check_proxy 检测一个代理IP
+    3. 在同步代码中：调用 check_proxies 方法，传入代理IP列表，返回检测后的代理IP列表
+'''
+
+import asyncio
+import json
+import time
+
+import aiohttp
+
+from core.proxy_validate.httpbin_validator import get_nick_type, set_check_result
+from core.proxy_validate.adaptive_timeout import get_proxy_timeout
+from settings import TEST_TIMEOUT, ASYNC_VALIDATE_CONCURRENCY, TEST_HTTP_URL, TEST_HTTPS_URL
+from utils.http import get_request_headers
+from domain import Proxy
+
+
+class AsyncValidator(object):
+
+    def __init__(self, concurrency=ASYNC_VALIDATE_CONCURRENCY, timeout=TEST_TIMEOUT):
+        # 同时检测的代理IP的最大数量
+        self.concurrency = concurrency
+        # 检测一个代理IP的最大超时时间
+        self.timeout = timeout
+        self.session = None
+        self.semaphore = None
+
+    async def __aenter__(self):
+        # 每个代理IP的连接都不一样，连接没有复用的意义，检测完就关闭
+        connector = aiohttp.TCPConnector(limit=self.concurrency * 2, force_close=True)
+        self.session = aiohttp.ClientSession(connector=connector)
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+        self.session = None
+
+    async def __check_http_proxies(self, proxy_url, test_url, timeout):
+        """检测一个协议，返回值和 httpbin_validator 中的 __check_http_proxies 相同"""
+        # 匿名类型: 高匿:0, 匿名:1, 透明:2
+        nick_type = -1
+        # 响应速度, 单位s
+        speed = -1
+
+        try:
+            start_time = time.time()
+            async with self.session.get(test_url, headers=get_request_headers(), proxy=proxy_url,
+                                        timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.ok:
+                    text = await response.text()
+                    # 计算响应时间
+                    speed = round(time.time() - start_time, 2)
+                    # 匿名程度
+                    nick_type = get_nick_type(json.loads(text))
+                    return True, nick_type, speed
+            return False, nick_type, speed
+        except Exception:
+            # 代理IP不稳定不能用的太多了,这里就不必要记录太多没有用的错误日志
+            return False, nick_type, speed
+
+    async def check_proxy(self, proxy, timeout=None):
+        """
+        异步检查指定 代理IP 响应速度, 匿名程度, 支持协议类型
+        :param proxy: 代理IP模型对象
+        :param timeout: 超时时间，默认根据代理IP的历史响应速度计算
+        :return: 检查后的代理IP模型对象
+        """
+        timeout = timeout or get_proxy_timeout(proxy, self.timeout)
+        # aiohttp只支持http代理，访问https的网站时通过CONNECT建立隧道
+        proxy_url = 'http://{}:{}'.format(proxy.ip, proxy.port)
+
+        async with self.semaphore:
+            # http和https同时检测
+            http_result, https_result = await asyncio.gather(
+                self.__check_http_proxies(proxy_url, TEST_HTTP_URL, timeout),
+                self.__check_http_proxies(proxy_url, TEST_HTTPS_URL, timeout),
+            )
+
+        return set_check_result(proxy, http_result, https_result)
+
+    async def check_proxies_async(self, proxies):
+        """异步检测多个代理IP，返回检测后的代理IP列表"""
+        async with self:
+            return await asyncio.gather(*[self.check_proxy(proxy) for proxy in proxies])
+
+    def check_proxies(self, proxies):
+        """
+        提供给同步代码使用的检测接口
+        :param proxies: 代理IP模型对象的列表
+        :return: 检查后的代理IP模型对象列表
+        """
+        return asyncio.run(self.check_proxies_async(proxies))
+
+
+def check_proxies(proxies, concurrency=ASYNC_VALIDATE_CONCURRENCY):
+    """对外提供一个批量检测的接口，检测结果和check_proxy相同"""
+    return AsyncValidator(concurrency=concurrency).check_proxies(proxies)
+
+
+if __name__ == '__main__':
+    proxies = [
+        Proxy('163.125.250.131', port='8118'),
+        Proxy('122.234.92.213', port='9000'),
+        Proxy('117.69.200.125', port='9000'),
+    ]
+    for proxy in check_proxies(proxies):
+        print("result:", proxy)
@@ -3,9 +3,10 @@ import requests
 import json
 
 from utils.http import get_request_headers
-from settings import TEST_TIMEOUT
+from settings import TEST_TIMEOUT, TEST_HTTP_URL, TEST_HTTPS_URL
 from utils.log import logger
 from domain import Proxy
+from core.proxy_validate.adaptive_timeout import get_proxy_timeout, add_speed_history
 """
  实现代理池的校验模块
 目标: 检查代理IP速度,匿名程度以及支持的协议类型.
@@ -13,7 +14,7 @@ from domain import Proxy
 检查代理IP速度 和 匿名程度;
     1. 代理IP速度: 就是从发送请求到获取响应的时间间隔
     2. 匿名程度检查:
-        1. 对 http://httpbin.org/get 或 https://httpbin.org/get 发送请求
+        1. 对 http://httpbin.org/get 或 https://httpbin.org/get 发送请求(可以在settings.py中指向内置的judge服务)
         2. 如果 响应的origin 中有','分割的两个IP就是透明代理IP
         3. 如果 响应的headers 中包含 Proxy-Connection 说明是匿名代理IP
         4. 否则就是高匿代理IP
@@ -22,22 +23,42 @@ from domain import Proxy
     如果 https://httpbin.org/get 发送请求可以成功, 说明支持https协议
 """
 
+def get_nick_type(dic):
+    """
+    根据httpbin响应的字典，判断代理IP的匿名程度
+    :param dic: 响应的json转换成的字典，包含origin和headers
+    :return: 匿名类型: 高匿:0, 匿名:1, 透明:2
+    """
+    origin = dic['origin']
+    proxy_conection = dic['headers'].get('Proxy-Connection', None)
+    # 1. 对 http://httpbin.org/get 或 https://httpbin.org/get 发送请求
+    # 2. 如果 响应的origin 中有','分割的两个IP就是透明代理IP
+    if ',' in origin:
+        return 2
+    # 3. 如果 响应的headers 中包含 Proxy-Connection 说明是匿名代理IP
+    elif proxy_conection:
+        return 1
+    # 4. 否则就是高匿代理IP
+    else:
+        return 0
+
+
 # 内部封装一个私有方法：测试方法
 # 默认的 是检测http的，如需检测https需要传入false
-def __check_http_proxies(proxies, isHttp=True):
+def __check_http_proxies(proxies, isHttp=True, timeout=TEST_TIMEOUT):
     # 匿名类型: 高匿:0, 匿名:1, 透明:2
     nick_type = -1
     # 响应速度, 单位s
     speed = -1
 
     if isHttp:
-        test_url = 'http://httpbin.org/get'
+        test_url = TEST_HTTP_URL
     else:
-        test_url= 'https://httpbin.org/get'
+        test_url= TEST_HTTPS_URL
 
     try:
         start_time = time.time()
-        response = requests.get(test_url, headers=get_request_headers(), timeout=TEST_TIMEOUT, proxies=proxies)
+        response = requests.get(test_url, headers=get_request_headers(), timeout=timeout, proxies=proxies)
 
 
         if response.ok:
@@ -48,18 +69,7 @@ def __check_http_proxies(proxies, isHttp=True):
             # 匿名程度
             # 把响应的json字符串转换成字典
             dic = json.loads(response.text)
-            origin = dic['origin']
-            proxy_conection = dic['headers'].get('Proxy-Connection', None)
-            # 1. 对 http://httpbin.org/get 或 https://httpbin.org/get 发送请求
-            # 2. 如果 响应的origin 中有','分割的两个IP就是透明代理IP
-            if ',' in origin:
-                nick_type = 2
-            # 3. 如果 响应的headers 中包含 Proxy-Connection 说明是匿名代理IP
-            elif proxy_conection:
-                nick_type = 1
-            # 4. 否则就是高匿代理IP
-            else:
-                nick_type = 0
+            nick_type = get_nick_type(dic)
             return True, nick_type, speed
         return False, nick_type, speed
     except Exception as e:
@@ -69,12 +79,14 @@ def __check_http_proxies(proxies, isHttp=True):
 
 
 # 对外提供一个检测接口，需要接收一个代理IP的对象参数
-def check_proxy(proxy):
+def check_proxy(proxy, timeout=None):
     """
     用于检查指定 代理IP 响应速度, 匿名程度, 支持协议类型
     :param proxy: 代理IP模型对象
+    :param timeout: 超时时间，默认根据代理IP的历史响应速度计算
     :return: 检查后的代理IP模型对象
     """
+    timeout = timeout or get_proxy_timeout(proxy)
 
     # 准备代理IP字典
     proxies = {
@@ -83,8 +95,22 @@ def check_proxy(proxy):
     }
 
     # 测试该代理IP
-    http, http_nick_type, http_speed = __check_http_proxies(proxies)
-    https, https_nick_type, https_speed = __check_http_proxies(proxies, False)
+    http_result = __check_http_proxies(proxies, timeout=timeout)
+    https_result = __check_http_proxies(proxies, False, timeout)
+
+    return set_check_result(proxy, http_result, https_result)
+
+
+def set_check_result(proxy, http_result, https_result):
+    """
+    根据http和https的检测结果，设置代理IP的协议类型，匿名程度和响应速度
+    :param proxy: 代理IP模型对象
+    :param http_result: http检测结果 (是否可用, 匿名类型, 响应速度)
+    :param https_result: https检测结果 (是否可用, 匿名类型, 响应速度)
+    :return: 检查后的代理IP模型对象
+    """
+    http, http_nick_type, http_speed = http_result
+    https, https_nick_type, https_speed = https_result
     # 代理IP支持的协议类型, http是0, https是1, https和http都支持是2
     if http and https:
         proxy.protocol = 2
@@ -103,6 +129,10 @@ def check_proxy(proxy):
         proxy.nick_type = -1
         proxy.speed = -1
 
+    # 记录检测成功的响应速度，用于计算下次检测的超时时间
+    if proxy.speed != -1:
+        add_speed_history(proxy, proxy.speed)
+
     return proxy
 
 
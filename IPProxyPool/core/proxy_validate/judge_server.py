@@ -0,0 +1,105 @@
+'''
+实现代理池内置的判断服务(judge)
+
+目标：代替 httpbin.org/get，在本机房提供一个轻量的回显服务，减少检测代理IP时的外网延迟，也方便离线测试校验模块.
+思路：
+    校验模块根据 httpbin 响应中的 origin 和 headers 判断代理IP的匿名程度，
+    judge服务以相同的格式返回：{"args": {}, "headers": {...}, "origin": "...", "url": "..."}
+    1. origin：如果请求中带有 X-Forwarded-For 等请求头，就把其中的IP和客户端的IP用', '拼接，和httpbin一致
+    2. headers：请求头的名称统一转换成首字母大写的格式，比如 proxy-connection 转换成 Proxy-Connection
+步骤：
+    1. 定义JudgeHandler类，继承BaseHTTPRequestHandler，实现do_GET方法
+    2. 定义JudgeServer类
+        实现run方法，启动http服务；如果配置了证书，同时启动https服务
+        实现start的类方法，用于通过类名，启动服务
+    3. 在settings.py中，把 TEST_HTTP_URL 和 TEST_HTTPS_URL 指向judge服务即可
+'''
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import json
+import ssl
+
+from settings import JUDGE_HOST, JUDGE_PORT, JUDGE_SSL_PORT, JUDGE_SSL_CERTFILE, JUDGE_SSL_KEYFILE
+from utils.log import logger
+
+# 会暴露客户端真实IP的请求头
+FORWARDED_HEADERS = ['X-Forwarded-For', 'X-Real-Ip']
+
+
+def format_header_name(name):
+    """把请求头的名称转换成首字母大写的格式，和httpbin一致"""
+    return '-'.join(part.capitalize() for part in name.split('-'))
+
+
+class JudgeHandler(BaseHTTPRequestHandler):
+
+    # 使用HTTP/1.1，支持keep-alive
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # 请求头
+        headers = {}
+        for name, value in self.headers.items():
+            headers[format_header_name(name)] = value
+
+        # 客户端IP，如果经过了透明代理，请求头中会带有客户端的真实IP
+        origins = []
+        for name in FORWARDED_HEADERS:
+            if name in headers:
+                origins.extend(ip.strip() for ip in headers[name].split(','))
+        origins.append(self.client_address[0])
+        # 去重，保持顺序
+        origin = ', '.join(dict.fromkeys(origins))
+
+        scheme = 'https' if isinstance(self.connection, ssl.SSLSocket) else 'http'
+        dic = {
+            'args': {},
+            'headers': headers,
+            'origin': origin,
+            'url': '{}://{}{}'.format(scheme, headers.get('Host', ''), self.path),
+        }
+
+        body = json.dumps(dic).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 每次检测都会请求一次，不必要记录访问日志
+        pass
+
+
+class JudgeServer(object):
+
+    def __init__(self, host=JUDGE_HOST, port=JUDGE_PORT, ssl_port=JUDGE_SSL_PORT,
+                 certfile=JUDGE_SSL_CERTFILE, keyfile=JUDGE_SSL_KEYFILE):
+        # 创建http服务
+        self.http_server = ThreadingHTTPServer((host, port), JudgeHandler)
+        # 如果配置了证书，创建https服务
+        self.https_server = None
+        if certfile:
+            self.https_server = ThreadingHTTPServer((host, ssl_port), JudgeHandler)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(certfile, keyfile)
+            self.https_server.socket = context.wrap_socket(self.https_server.socket, server_side=True)
+
+    def run(self):
+        """启动judge服务"""
+        if self.https_server:
+            Thread(target=self.https_server.serve_forever, daemon=True).start()
+            logger.info("judge服务https端口：{}".format(self.https_server.server_address[1]))
+        logger.info("judge服务http端口：{}".format(self.http_server.server_address[1]))
+        self.http_server.serve_forever()
+
+    @classmethod
+    def start(cls):
+        """用于通过类名，启动服务"""
+        judge_server = cls()
+        judge_server.run()
+
+
+if __name__ == '__main__':
+    JudgeServer.start()
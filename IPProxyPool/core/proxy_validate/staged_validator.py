@@ -0,0 +1,119 @@
+'''
+实现代理池的分阶段校验模块
+
+目标：爬取到的免费代理IP大部分都是不可用的，先用代价很小的TCP连接过滤掉，只有连接成功的代理IP才进行完整的http/https检测.
+思路：
+    阶段1(connect)：对所有代理IP并发的建立TCP连接，超时时间很短(TCP_CONNECT_TIMEOUT)，连接不上的代理IP直接标记为不可用
+    阶段2(probe)：对连接成功的代理IP，使用AsyncValidator检测协议类型，匿名程度和响应速度
+    每个阶段统计检测数量，通过数量，通过率和耗时
+步骤：
+    1. 定义StageStats类，记录一个阶段的统计信息
+    2. 定义StagedValidator类
+        实现tcp_connect方法，检测能否和代理IP建立TCP连接
+        实现validate_async方法，依次执行两个阶段，返回检测后的代理IP列表
+        实现validate方法，提供给同步代码使用
+'''
+
+import asyncio
+import time
+
+from core.proxy_validate.async_validator import AsyncValidator
+from core.proxy_validate.httpbin_validator import set_check_result
+from settings import TEST_TIMEOUT, ASYNC_VALIDATE_CONCURRENCY, TCP_CONNECT_TIMEOUT, TCP_CONNECT_CONCURRENCY
+from utils.log import logger
+from domain import Proxy
+
+# 检测失败的结果 (是否可用, 匿名类型, 响应速度)
+FAILED_RESULT = (False, -1, -1)
+
+
+class StageStats(object):
+    """一个阶段的统计信息"""
+
+    def __init__(self, name):
+        self.name = name
+        # 进入该阶段的代理IP数量
+        self.total = 0
+        # 通过该阶段的代理IP数量
+        self.passed = 0
+        # 该阶段累计耗时，单位s
+        self.elapsed = 0
+
+    @property
+    def pass_rate(self):
+        return self.passed / self.total if self.total else 0
+
+    def __str__(self):
+        return '{}: 检测{}个, 通过{}个, 通过率{:.1%}, 耗时{:.2f}s'.format(
+            self.name, self.total, self.passed, self.pass_rate, self.elapsed)
+
+
+class StagedValidator(object):
+
+    def __init__(self, concurrency=ASYNC_VALIDATE_CONCURRENCY, timeout=TEST_TIMEOUT,
+                 connect_concurrency=TCP_CONNECT_CONCURRENCY, connect_timeout=TCP_CONNECT_TIMEOUT):
+        # 阶段2使用的异步校验器
+        self.validator = AsyncValidator(concurrency=concurrency, timeout=timeout)
+        # 阶段1同时建立连接的最大数量和超时时间
+        self.connect_concurrency = connect_concurrency
+        self.connect_timeout = connect_timeout
+        # 每个阶段的统计信息
+        self.connect_stats = StageStats('connect')
+        self.probe_stats = StageStats('probe')
+
+    async def tcp_connect(self, proxy, semaphore):
+        """检测能否和代理IP建立TCP连接"""
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(
+                    asyncio.open_connection(proxy.ip, int(proxy.port)), self.connect_timeout)
+            except Exception:
+                return False
+            writer.close()
+            return True
+
+    async def validate_async(self, proxies):
+        """
+        分阶段检测多个代理IP
+        :param proxies: 代理IP模型对象的列表
+        :return: 检查后的代理IP模型对象列表，不可用的代理IP的speed为-1
+        """
+        proxies = list(proxies)
+
+        # 阶段1：建立TCP连接
+        start_time = time.time()
+        semaphore = asyncio.Semaphore(self.connect_concurrency)
+        connected = await asyncio.gather(*[self.tcp_connect(proxy, semaphore) for proxy in proxies])
+        survivors = []
+        for proxy, ok in zip(proxies, connected):
+            if ok:
+                survivors.append(proxy)
+            else:
+                set_check_result(proxy, FAILED_RESULT, FAILED_RESULT)
+        self.connect_stats.total += len(proxies)
+        self.connect_stats.passed += len(survivors)
+        self.connect_stats.elapsed += time.time() - start_time
+
+        # 阶段2：对连接成功的代理IP进行http/https检测
+        start_time = time.time()
+        if survivors:
+            survivors = await self.validator.check_proxies_async(survivors)
+        self.probe_stats.total += len(survivors)
+        self.probe_stats.passed += len([proxy for proxy in survivors if proxy.speed != -1])
+        self.probe_stats.elapsed += time.time() - start_time
+
+        logger.info('分阶段检测 {}；{}'.format(self.connect_stats, self.probe_stats))
+        return proxies
+
+    def validate(self, proxies):
+        """提供给同步代码使用的检测接口"""
+        return asyncio.run(self.validate_async(proxies))
+
+
+if __name__ == '__main__':
+    proxies = [
+        Proxy('163.125.250.131', port='8118'),
+        Proxy('122.234.92.213', port='9000'),
+    ]
+    for proxy in StagedValidator().validate(proxies):
+        print("result:", proxy)
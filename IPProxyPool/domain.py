@@ -1,4 +1,4 @@
-from settings import MAX_SCORE
+from settings import MAX_SCORE, TEST_MIN_INTERVAL
 
 '''
 定义 代理IP模型类 Proxy类，继承object
@@ -9,15 +9,21 @@ from settings import MAX_SCORE
         nick_type：代理IP的匿名程度，高匿：0，匿名：1，透明：2
         speed：代理IP的响应速度，单位s
         area：代理IP所在地区
-        score：代理IP的评分，用于衡量代理的可用性；默认分值可以通过配置文件进行配置.在进行代理可用性检查的时候，每遇到一次请求失败就减1份，减到0的时候从池中删除.如果检查代理可用，就恢复默认分值
+        score：代理IP的评分，用于衡量代理的可用性；默认分值可以通过配置文件进行配置.在进行代理可用性检查的时候，每遇到一次请求失败就减1份，减到0的时候从池中删除.如果检查代理可用，就加TEST_SUCCESS_SCORE分，最多加到默认分值
             在配置文件：settings.py中定义MAX_SCORE=50，表示代理IP的默认最高分数
         disable_domains：不可用域名列表，有些代理IP在某些域名下不可用，但是在其他域名下可用
+            不可用域名现在保存在domain_exclusions集合中，这个字段只用于兼容以前的数据
+        speed_history：最近几次检测成功时的响应速度列表，用于计算该代理IP的检测超时时间
+        next_check_at：下次检测该代理IP的时间戳，检测模块按照这个时间调度检测任务
+        check_interval：当前的检测间隔时间，单位s；检测成功后变长，检测失败后变短
+        fail_count：连续检测失败的次数
         
     提供_str方法，返回数据字符串
 '''
 
 class Proxy(object):
-    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains = []):
+    def __init__(self, ip, port, protocol=-1, nick_type=-1, speed=-1, area=None, score=MAX_SCORE, disable_domains = [], speed_history=None,
+                 next_check_at=0, check_interval=TEST_MIN_INTERVAL, fail_count=0):
         self.ip = ip
         self.port = port
         self.protocol = protocol
@@ -26,6 +32,10 @@ class Proxy(object):
         self.area = area
         self.score = score
         self.disable_domains = disable_domains
+        self.speed_history = speed_history or []
+        self.next_check_at = next_check_at
+        self.check_interval = check_interval
+        self.fail_count = fail_count
 
     def __str__(self):
         return str(self.__dict__)
\ No newline at end of file
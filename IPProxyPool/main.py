@@ -10,7 +10,9 @@
         创建启动爬虫的进程，添加到列表中
         创建启动检测的进程，添加到列表中
         创建启动提供API服务的进程，添加到列表中
-        遍历进程列表，启动所有进程
+        如果配置了启动内置的judge服务，创建启动judge服务的进程，添加到列表中
+        如果配置了启动代理网关，创建启动代理网关的进程，添加到列表中
+        遍历进程列表，启动所有进程；asgi方式的API服务进程不是守护进程，uvicorn需要创建工作进程
         遍历进程列表，让主进程等待子进程的完成
 在if__name__=='__main__'：中调用run方法
 '''
@@ -20,6 +22,9 @@ from multiprocessing import Process
 from core.proxy_spider.run_spiders import RunSpider
 from core.proxy_test import ProxyTester
 from core.proxy_api import ProxyApi
+from core.proxy_validate.judge_server import JudgeServer
+from core.proxy_gateway import ProxyGateway
+from settings import RUN_JUDGE_SERVER, RUN_GATEWAY, API_SERVER
 
 def run():
     """用于启动动代理池"""
@@ -31,11 +36,18 @@ def run():
     # 创建启动检测的进程，添加到列表中
     process_list.append(Process(target=ProxyTester.start))
     # 创建启动提供API服务的进程，添加到列表中
-    process_list.append(Process(target=ProxyApi.start))
+    api_process = Process(target=ProxyApi.start)
+    process_list.append(api_process)
+    # 如果配置了启动内置的judge服务，创建启动judge服务的进程，添加到列表中
+    if RUN_JUDGE_SERVER:
+        process_list.append(Process(target=JudgeServer.start))
+    # 如果配置了启动代理网关，创建启动代理网关的进程，添加到列表中
+    if RUN_GATEWAY:
+        process_list.append(Process(target=ProxyGateway.start))
     # 遍历进程列表，启动所有进程
     for process in process_list:
-        # 设置守护进程
-        process.daemon = True
+        # 设置守护进程；守护进程不能创建子进程，asgi方式的API服务由uvicorn启动API_WORKERS个工作进程
+        process.daemon = not (process is api_process and API_SERVER == 'asgi')
         process.start()
     # 遍历进程列表，让主进程等待子进程的完成
     for process in process_list:
@@ -16,9 +16,47 @@ LOG_FILENAME = '1og.log'
 # 测试代理IP的过期时间
 TEST_TIMEOUT = 10
 
+# 自适应超时：根据代理IP历史响应速度的百分位数乘以倍数，计算该代理IP的检测超时时间
+ADAPTIVE_TIMEOUT_PERCENTILE = 90
+ADAPTIVE_TIMEOUT_MULTIPLE = 3
+# 自适应超时的最小值，单位s；最大值为TEST_TIMEOUT
+ADAPTIVE_TIMEOUT_FLOOR = 1
+# 新爬取的代理IP没有历史响应速度，使用更短的超时时间，单位s
+NEW_PROXY_TIMEOUT = 5
+# 每个代理IP保留的历史响应速度的数量
+SPEED_HISTORY_SIZE = 10
+
+# 检测代理IP时请求的判断服务(judge)地址，响应格式和 httpbin.org/get 相同
+# 每个检测节点可以指向本机房部署的judge服务(core/proxy_validate/judge_server.py)，例如 'http://10.0.0.2:16889/get'
+TEST_HTTP_URL = 'http://httpbin.org/get'
+TEST_HTTPS_URL = 'https://httpbin.org/get'
+
+# 是否在main.py中启动内置的judge服务
+RUN_JUDGE_SERVER = False
+# 内置judge服务监听的地址和端口
+JUDGE_HOST = '0.0.0.0'
+JUDGE_PORT = 16889
+# 内置judge服务的https端口，只有配置了证书文件才会启动；证书需要被检测节点信任
+JUDGE_SSL_PORT = 16890
+JUDGE_SSL_CERTFILE = None
+JUDGE_SSL_KEYFILE = None
+
+# 异步检测代理IP时，同时检测的最大数量
+ASYNC_VALIDATE_CONCURRENCY = 500
+
+# 分阶段检测时，第一阶段建立TCP连接的超时时间，单位s
+TCP_CONNECT_TIMEOUT = 3
+# 分阶段检测时，第一阶段同时建立TCP连接的最大数量
+TCP_CONNECT_CONCURRENCY = 1000
+
 # MongoDB数据库的URL
 MONGO_URL = 'mongodb://127.0.0.1:27017'
 
+# 批量写入数据库时，缓冲区中的操作达到这个数量就写入
+WRITE_BATCH_SIZE = 500
+# 批量写入数据库时，距离上次写入超过这个时间就写入，单位s
+WRITE_FLUSH_INTERVAL = 1
+
 # 爬虫的全类名/路径：模块.类名
 PROXIES_SPIDERS = [
 
@@ -26,16 +64,145 @@ PROXIES_SPIDERS = [
     'core.proxy_spider.proxy_spiders.Ip3366Spider',
     'core.proxy_spider.proxy_spiders.ProxylistplusSpider',
     'core.proxy_spider.proxy_spiders.Ip66Spider',
+    'core.proxy_spider.proxy_spiders.SpeedXSpider',
+    'core.proxy_spider.proxy_spiders.GeonodeSpider',
 ]
 
-# 爬虫运行的间隔时间，单位为小时h
+# 爬虫运行的间隔时间，单位为小时h；现在是每个爬虫来源第一次运行时的间隔，之后按照产出调整
 RUN_SPIDERS_INTERVAL = 12
+# 爬虫来源调度：每次运行期望得到的可用新代理IP数量，产出越多运行间隔越短，产出越少运行间隔越长
+SOURCE_TARGET_YIELD = 20
+# 爬虫来源调度：每次调整运行间隔最多缩短或者延长的倍数
+SOURCE_MAX_ADJUST = 2
+# 爬虫来源调度：没有产出时，运行间隔延长的倍数
+SOURCE_BACKOFF_FACTOR = 2
+# 爬虫来源调度：运行间隔的范围，单位s
+SOURCE_MIN_INTERVAL = 30 * 60
+SOURCE_MAX_INTERVAL = 48 * 3600
+# 爬虫来源调度：检查有没有到期的爬虫来源的最长间隔，单位s
+SOURCE_CHECK_INTERVAL = 60
+# 爬虫对每个网站(host)的限速：每秒最多请求的页面数量，和最多连续请求的页面数量(令牌桶的容量)
+SPIDER_HOST_RATE = 0.5
+SPIDER_HOST_BURST = 2
+# 每个爬虫同时请求的页面数量，实际的速度仍然受网站的限速限制
+SPIDER_CONCURRENCY = 4
+# 爬虫请求页面的超时时间，单位s
+SPIDER_TIMEOUT = 10
+# 爬虫共享的连接池中，每个网站保持的连接数量
+SPIDER_POOL_SIZE = 10
+# 数据源爬虫(文本列表或者json接口)流式读取响应时，每次读取的大小，单位字节
+FEED_CHUNK_SIZE = 64 * 1024
+# 数据源爬虫下载到临时文件时，保存在内存中的最大字节数，超过后写入磁盘
+FEED_SPOOL_MAX_SIZE = 4 * 1024 * 1024
+# 爬虫是否使用页面缓存：发送条件请求(ETag/Last-Modified)，页面没有变化时不再解析和检测
+SPIDER_PAGE_CACHE = True
+# 页面缓存超过这个时间没有更新就删除，单位s
+PAGE_CACHE_EXPIRE = 7 * 24 * 3600
+
+# 爬取流水线：爬取 -> 检测 -> 写入，阶段之间使用有界队列，队列满了前一个阶段就等待
+# 爬取阶段：同时运行的爬虫数量
+SPIDER_WORKERS = 4
+# 待检测队列和待写入队列的大小
+SPIDER_CANDIDATE_QUEUE_SIZE = 2000
+SPIDER_STORE_QUEUE_SIZE = 2000
+# 检测阶段：每批检测的代理IP数量，凑不满一批时最多等待的时间，单位s
+SPIDER_VALIDATE_BATCH_SIZE = 500
+SPIDER_VALIDATE_BATCH_WAIT = 2
+# 检测阶段：同时检测的代理IP数量
+SPIDER_VALIDATE_CONCURRENCY = 500
+# 每隔多长时间输出一次各个阶段的统计和队列长度，单位s
+SPIDER_METRICS_INTERVAL = 10
 
-# 检测代理IP模块运行的间隔时间，单位为小时h
-RUN_TEST_PROXIES_INTERVAL = 2
+# 检测代理IP的调度：每个代理IP都有自己的下次检测时间
+# 检测成功后，检测间隔乘以TEST_INTERVAL_FACTOR，最长为TEST_MAX_INTERVAL
+# 检测失败后，检测间隔缩短为TEST_MIN_INTERVAL，连续失败时按TEST_INTERVAL_FACTOR指数退避
+# 连续失败TEST_MAX_FAIL_COUNT次或者分数减到0，就从数据库中删除，单位为秒s
+TEST_MIN_INTERVAL = 60
+TEST_MAX_INTERVAL = 6 * 3600
+TEST_INTERVAL_FACTOR = 2
+TEST_MAX_FAIL_COUNT = 6
+# 检测成功时加的分数，最多加到MAX_SCORE；检测失败时减1分
+# 检测结果只调整分数，不直接恢复到MAX_SCORE，不覆盖使用结果报告(/report)对分数的调整
+TEST_SUCCESS_SCORE = 10
+# 检测成功时，检测的响应速度和数据库中的speed加权平均的权重，和使用结果报告更新的speed一起反映代理IP的实际速度
+TEST_SPEED_WEIGHT = 0.5
+# 每次从数据库中读取到期代理IP的数量
+TEST_BATCH_SIZE = 1000
+# 检测队列的最大长度，队列满了就暂停从数据库中读取代理IP
+TEST_QUEUE_SIZE = 100
+# 没有到期的代理IP时，最长的空闲等待时间，单位s
+TEST_IDLE_SLEEP = 10
 
 # 配置检测代理IP的异步数量
 TEST_PROXIES_ASYNC_COUNT = 10
 
+# API服务监听的地址和端口
+API_HOST = '0.0.0.0'
+API_PORT = 16888
+# API服务的运行方式：'flask' 使用Flask自带的开发服务器；'asgi' 使用uvicorn多进程异步服务器，适合生产环境
+API_SERVER = 'flask'
+# asgi方式运行时的进程数量，每个进程有自己的代理IP缓存
+API_WORKERS = 4
+# asgi方式运行时keep-alive连接的超时时间，单位s
+API_KEEP_ALIVE_TIMEOUT = 30
+
 # 配置获取代理IP的最大数量，这个值越小可用性越高随机性越差
-MAX_PROXIES_COUNT = 50
\ No newline at end of file
+MAX_PROXIES_COUNT = 50
+
+# /proxies每页最多返回的代理IP数量
+PROXIES_PAGE_MAX_SIZE = 5000
+
+# 租用代理IP：每个代理IP同时被租用的最大数量
+# 租用的状态保存在API进程的内存中，asgi方式运行时API_WORKERS需要设置为1，否则租用接口返回501
+LEASE_MAX_CONCURRENCY = 2
+# 租用代理IP：归还后多长时间内不能再用于访问同一个域名，单位s
+LEASE_DOMAIN_COOLDOWN = 5
+# 租用代理IP：报告访问失败后多长时间内不能再用于访问同一个域名，单位s
+LEASE_FAIL_COOLDOWN = 60
+# 租用代理IP：租约的默认有效时间和最长有效时间，超时没有归还自动收回，单位s
+LEASE_TTL = 60
+LEASE_MAX_TTL = 600
+# 租用代理IP：每个(协议类型, 匿名类型, 域名)的堆超过这个时间没有使用就删除，单位s
+LEASE_DOMAIN_POOL_TTL = 600
+
+# 使用结果报告：汇总后写入数据库的间隔，单位s
+REPORT_FLUSH_INTERVAL = 10
+# 使用结果报告：每次访问成功加的分数，每次访问失败减的分数
+REPORT_SUCCESS_SCORE = 1
+REPORT_FAIL_SCORE = 2
+# 使用结果报告：平均延迟在更新speed时的权重
+REPORT_SPEED_WEIGHT = 0.3
+# 使用结果报告：一个代理IP访问一个域名失败这么多次(按照半衰期衰减后)，把域名添加到不可用域名列表
+REPORT_DISABLE_DOMAIN_FAILS = 5
+# 使用结果报告：每个代理IP访问每个域名的失败次数跨越多次写入累计，按照这个半衰期衰减，单位s
+REPORT_DOMAIN_FAILS_HALF_LIFE = 3600
+# 使用结果报告：一次请求最多报告的结果数量
+REPORT_MAX_EVENTS = 10000
+
+# 代理IP的不可用域名过期的时间，过期后代理IP可以再用于访问这个域名，单位s
+DOMAIN_EXCLUSION_TTL = 6 * 3600
+
+# API进程内代理IP缓存的刷新间隔，单位s
+PROXY_CACHE_REFRESH_INTERVAL = 10
+# 每个(协议类型, 匿名类型)最多缓存的代理IP数量
+PROXY_CACHE_MAX_SIZE = 10000
+# /random按照分数和响应速度加权选择代理IP，有这个概率在所有代理IP中等概率选择，让排名靠后的代理IP也能分到流量
+RANDOM_EXPLORATION_RATE = 0.1
+# 是否监听MongoDB的变更流(需要副本集)，代理IP变化后立即刷新缓存
+PROXY_CACHE_WATCH = False
+
+# 是否启动代理网关，爬虫把http_proxy设置为网关的地址，网关从代理池中选择代理IP转发请求
+RUN_GATEWAY = False
+# 代理网关监听的地址和端口号
+GATEWAY_HOST = '0.0.0.0'
+GATEWAY_PORT = 16891
+# 代理网关：一个请求最多尝试的代理IP数量，失败后换一个代理IP重试
+GATEWAY_MAX_TRIES = 3
+# 代理网关：连接代理IP的超时时间，等待代理IP响应的超时时间，单位s
+GATEWAY_CONNECT_TIMEOUT = 5
+GATEWAY_READ_TIMEOUT = 30
+# 代理网关：同一个域名在这段时间内继续使用上次成功的代理IP，0表示不使用，单位s
+GATEWAY_AFFINITY_TTL = 60
+# 代理网关：每个代理IP最多保持的空闲keep-alive连接数量，空闲连接的超时时间，单位s
+GATEWAY_POOL_SIZE = 10
+GATEWAY_IDLE_TIMEOUT = 30
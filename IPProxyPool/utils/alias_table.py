@@ -0,0 +1,59 @@
+import random
+
+'''
+## 别名表(Alias Method)
+- 按照权重随机选择元素，建表的时间复杂度是O(n)，每次选择的时间复杂度是O(1).
+- 步骤：
+  1.把每个权重缩放到平均值为1
+  2.权重小于1的格子，用一个权重大于1的元素补满，记录补的元素(别名)
+  3.选择时，先等概率选择一个格子，再按照格子中的概率决定返回格子本身还是别名
+'''
+
+
+class AliasTable(object):
+
+    def __init__(self, weights):
+        self.n = len(weights)
+        # 每个格子返回格子本身的概率
+        self.prob = [1.0] * self.n
+        # 每个格子的别名
+        self.alias = list(range(self.n))
+
+        total = sum(weights)
+        if total <= 0:
+            # 权重都为0时，等概率选择
+            return
+
+        # 1.把每个权重缩放到平均值为1
+        scaled = [weight * self.n / total for weight in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+
+        # 2.权重小于1的格子，用一个权重大于1的元素补满
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1 - scaled[s]
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        # 剩下的格子由于浮点误差，概率都看作1
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def sample(self):
+        """按照权重随机选择一个元素的下标"""
+        # 3.先等概率选择一个格子，再按照格子中的概率决定返回格子本身还是别名
+        i = random.randrange(self.n)
+        return i if random.random() < self.prob[i] else self.alias[i]
+
+
+if __name__ == '__main__':
+    table = AliasTable([1, 2, 7])
+    counts = [0, 0, 0]
+    for i in range(100000):
+        counts[table.sample()] += 1
+    print(counts)
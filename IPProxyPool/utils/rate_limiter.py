@@ -0,0 +1,71 @@
+from threading import Lock
+from urllib.parse import urlsplit
+import time
+
+'''
+## 限速模块
+- 爬虫请求代理IP网站太快会被封，以前每个爬虫在请求之前固定sleep 1~3秒，所有页面只能一个一个请求.
+- 目标：按照网站(host)限速，同一个网站的请求不超过允许的速度，不同网站之间，同一个网站的多个页面之间可以并发请求.
+  步骤：
+  1.定义TokenBucket类，令牌桶：每秒放入rate个令牌，最多保存capacity个令牌，每个请求取出一个令牌
+    令牌可以预支(令牌数量为负数)，请求按照到达的顺序排队，每个请求只需要sleep一次
+  2.定义HostRateLimiter类，每个host使用一个令牌桶，所有爬虫共享
+'''
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, capacity=1):
+        # 每秒放入的令牌数量
+        self.rate = rate
+        # 最多保存的令牌数量
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        """取出一个令牌，没有令牌时等待，返回等待的时间"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class HostRateLimiter(object):
+
+    def __init__(self):
+        # host -> TokenBucket
+        self.buckets = {}
+        self.lock = Lock()
+
+    def get_bucket(self, host, rate, capacity):
+        """获取host的令牌桶，第一次使用时按照传入的速度创建"""
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket is None:
+                bucket = self.buckets[host] = TokenBucket(rate, capacity)
+            return bucket
+
+    def acquire(self, url, rate, capacity=1):
+        """
+        请求url之前调用，超过网站的限速时等待
+        :param url: 要请求的url
+        :param rate: 网站的限速，每秒请求的数量
+        :param capacity: 最多连续请求的数量
+        :return: 等待的时间
+        """
+        return self.get_bucket(urlsplit(url).hostname, rate, capacity).acquire()
+
+
+if __name__ == '__main__':
+    limiter = HostRateLimiter()
+    start_time = time.monotonic()
+    for i in range(5):
+        limiter.acquire('http://www.66ip.cn/{}.html'.format(i), rate=2, capacity=2)
+        print(i, round(time.monotonic() - start_time, 2))